@@ -7,6 +7,22 @@ UNIT_TYPES = {
     "sampling": ("Hz", "kHz", "MHz")  # *1, *1000, *100000, *1
 }
 
+# factors to convert a value in a given unit into the base unit of its type
+UNIT_SCALES = {
+    "s": 1.0, "ms": 1e-3, "us": 1e-6,
+    "V": 1.0, "mV": 1e-3, "uV": 1e-6,
+    "Hz": 1.0, "kHz": 1e3, "MHz": 1e6
+}
+
+
+def rescale(value, from_unit, to_unit):
+    """ converts value between two units of the same type, like 'ms' -> 's' """
+    for unit in (from_unit, to_unit):
+        if not unit in UNIT_SCALES:
+            raise ValueError("Unit provided is not supported: %s. Use: %s." %
+                             (unit, UNIT_TYPES))
+    return value * UNIT_SCALES[from_unit] / UNIT_SCALES[to_unit]
+
 
 class UnitField(models.CharField):
     """
@@ -0,0 +1,400 @@
+import os
+import math
+import threading
+import h5py
+import numpy as np
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from gndata_api import settings
+
+# max number of array elements to keep in memory while processing a file
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def open_file(path, chunk_cache=None):
+    """ opens an HDF5 file with array data for reading """
+    return h5py.File(path, 'r', rdcc_nbytes=chunk_cache)
+
+
+class FilePool(object):
+    """
+    Per-process pool of open read-only HDF5 files, so that repeated reads from
+    the same file do not re-open it and re-parse its metadata. Files are keyed
+    by path and GUID of the object version they belong to. The pool is bounded,
+    least recently used files are closed first; a file that is in use is
+    closed when the last reader releases it.
+    """
+
+    def __init__(self, size, chunk_cache):
+        """
+        :param size:        max number of open files
+        :param chunk_cache: size of the raw data chunk cache of every file,
+                            in bytes
+        """
+        self.size = size
+        self.chunk_cache = chunk_cache
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key: [file, readers, evicted]
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+
+    @contextmanager
+    def open(self, path, guid=None):
+        """ use as 'with pool.open(path, guid) as f:' """
+        entry = self._acquire(path, guid)
+        try:
+            yield entry[0]
+        finally:
+            self._release(entry)
+
+    def _acquire(self, path, guid):
+        key = (path, guid)
+        with self._lock:
+            if self._pid != os.getpid():  # forked, handles are not ours
+                self._entries = OrderedDict()
+                self._pid = os.getpid()
+
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry = [open_file(path, self.chunk_cache), 0, False]
+
+            self._entries[key] = entry  # move to the most recent position
+            entry[1] += 1
+
+            while len(self._entries) > self.size:
+                self._evict(self._entries.popitem(last=False)[1])
+
+            return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry[1] -= 1
+            if entry[2] and entry[1] == 0:
+                entry[0].close()
+
+    def _evict(self, entry):
+        entry[2] = True
+        if entry[1] == 0:
+            entry[0].close()
+
+    def invalidate(self, path):
+        """ closes all handles of the file at a given path, must be called when
+        a file is replaced or removed """
+        with self._lock:
+            for key in [k for k in self._entries.keys() if k[0] == path]:
+                self._evict(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            for entry in self._entries.values():
+                self._evict(entry)
+            self._entries = OrderedDict()
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'open': len(self._entries)}
+
+
+file_pool = FilePool(
+    settings.DATA_CONFIG['file_pool_size'],
+    settings.DATA_CONFIG['chunk_cache_size']
+)
+
+
+def get_dataset(h5file):
+    """ returns the array stored in a given HDF5 file. Every data file holds a
+    single dataset at the root level; the name of the dataset is arbitrary. """
+    for name, item in h5file.items():
+        if isinstance(item, h5py.Dataset):
+            return item
+
+    raise ValueError("File %s does not contain any datasets" % h5file.filename)
+
+
+def parse_channels(value, count):
+    """ parses a list of channel indexes and index ranges like '0,3,5-8' into
+    a list of integers [0, 3, 5, 6, 7, 8]. Ranges are inclusive. Indexes are
+    checked against the number of channels 'count' before ranges are
+    expanded. """
+    channels = []
+    for item in [x.strip() for x in value.split(',') if x.strip()]:
+        try:
+            if '-' in item:
+                first, last = [int(x) for x in item.split('-')]
+            else:
+                first = last = int(item)
+        except ValueError:
+            raise ValueError("Channels should be given as indexes or ranges "
+                             "like '0,3,5-8', got %s" % value)
+
+        if not 0 <= first <= last < count:
+            raise ValueError("Channel indexes should be in [0:%d), got %s" %
+                             (count, item))
+        channels += range(first, last + 1)
+
+    if not channels:
+        raise ValueError("No channels selected")
+    return channels
+
+
+def select(dataset, start=None, stop=None, columns=None):
+    """ reads rows [start:stop] of a dataset, optionally only given columns
+    (channels of a 2-dimensional signal). Columns are read as an HDF5
+    selection, so that other columns are not transferred at all. """
+    if columns is None:
+        return dataset[start:stop, ...]
+
+    if len(dataset.shape) != 2:
+        raise ValueError("Channels can be selected in 2-dimensional arrays only")
+
+    if min(columns) < 0 or max(columns) >= dataset.shape[1]:
+        raise ValueError("Channel indexes should be in [0:%d)" %
+                         dataset.shape[1])
+
+    # HDF5 requires an increasing list of indexes without duplicates
+    unique = sorted(set(columns))
+    data = dataset[start:stop, unique]
+    if unique != columns:
+        data = data[:, [unique.index(x) for x in columns]]
+    return data
+
+
+def read_slice(path, start=None, stop=None, columns=None, guid=None):
+    """ reads rows [start:stop] (optionally only given columns) of the dataset
+    stored in a file at a given path. Only the requested hyperslab is read from
+    disk. The file is taken from the pool of open files.
+
+    :returns: numpy array
+    """
+    with file_pool.open(path, guid) as f:
+        return select(get_dataset(f), start, stop, columns)
+
+
+def read_layout(path, guid=None):
+    """ returns shape and dtype of the dataset stored in a file """
+    with file_pool.open(path, guid) as f:
+        dataset = get_dataset(f)
+        return dataset.shape, dataset.dtype
+
+
+def inspect_dataset(path):
+    """ returns the layout of the dataset stored in a file: shape, dtype, shape
+    of HDF5 chunks (None if contiguous) and compression filter (or None) """
+    with open_file(path) as f:
+        dataset = get_dataset(f)
+        return {
+            'shape': dataset.shape,
+            'dtype': dataset.dtype.str,
+            'chunks': dataset.chunks,
+            'compression': dataset.compression
+        }
+
+
+def iter_rows(path, guid=None):
+    """ generator over consecutive blocks of rows of the dataset stored in a
+    file, to process a dataset of any size in bounded memory """
+    with file_pool.open(path, guid) as f:
+        dataset = get_dataset(f)
+        row_size = int(np.prod(dataset.shape[1:])) or 1
+        rows = max(1, BLOCK_SIZE // row_size)
+
+        for start in range(0, len(dataset), rows):
+            yield dataset[start:start + rows]
+
+
+def chunk_shape(shape, itemsize, chunk_bytes):
+    """ shape of HDF5 chunks for time-window reads: whole rows (all channels)
+    along the time axis, as many as fit into 'chunk_bytes' """
+    row_size = (int(np.prod(shape[1:])) or 1) * itemsize
+    rows = max(1, min(shape[0], chunk_bytes // row_size))
+    return (rows,) + tuple(shape[1:])
+
+
+def normalise_dataset(src, dst, chunk_bytes, compression='lzf', shuffle=True):
+    """
+    Rewrites the dataset stored in a file at 'src' into a new file at 'dst'
+    with chunks of about 'chunk_bytes' along the time axis and a given
+    compression filter, so that reading a time window touches few chunks and
+    less data is read from disk. Attributes are kept. Data is copied block by
+    block, in bounded memory.
+
+    :returns: False if the dataset has the requested layout already (or is
+              empty) and nothing was written, True otherwise
+    """
+    with open_file(src) as f:
+        dataset = get_dataset(f)
+        if not dataset.shape or not len(dataset):
+            return False
+
+        chunks = chunk_shape(dataset.shape, dataset.dtype.itemsize, chunk_bytes)
+        if dataset.chunks == chunks and dataset.compression == compression:
+            return False
+
+        with h5py.File(dst, 'w') as out:
+            for key, value in f.attrs.items():
+                out.attrs[key] = value
+
+            target = out.create_dataset(
+                os.path.basename(dataset.name), dataset.shape, dataset.dtype,
+                chunks=chunks, compression=compression,
+                shuffle=shuffle and compression is not None
+            )
+            for key, value in dataset.attrs.items():
+                target.attrs[key] = value
+
+            # write whole chunks at once
+            row_size = int(np.prod(dataset.shape[1:])) or 1
+            rows = max(chunks[0], BLOCK_SIZE // row_size // chunks[0] * chunks[0])
+            for start in range(0, len(dataset), rows):
+                target[start:start + rows] = dataset[start:start + rows]
+
+    return True
+
+
+#===============================================================================
+# min / max pyramids: decimated envelopes of a signal for zoomed-out views
+#===============================================================================
+
+
+def pyramid_path(path):
+    """ pyramid of a data file is stored next to it """
+    return path + '.pyramid'
+
+
+def envelope(mins, maxs, factor):
+    """ reduces arrays of minimums and maximums by a given factor along the
+    first axis (time), every 'factor' rows are merged into one """
+    if len(mins) == 0:
+        return mins, maxs
+
+    idx = np.arange(0, len(mins), factor)
+    return np.minimum.reduceat(mins, idx, axis=0), \
+        np.maximum.reduceat(maxs, idx, axis=0)
+
+
+def _reduce_level(src_min, src_max, dst_min, dst_max, factor):
+    """ fills the next pyramid level from the previous one block by block, so
+    that memory usage does not depend on the size of the signal """
+    row_size = int(np.prod(src_min.shape[1:])) or 1
+    rows = max(factor, BLOCK_SIZE // row_size // factor * factor)
+
+    for start in range(0, len(src_min), rows):
+        block_min = src_min[start:start + rows]
+        if src_max is src_min:  # raw signal, read only once
+            block_max = block_min
+        else:
+            block_max = src_max[start:start + rows]
+
+        mins, maxs = envelope(block_min, block_max, factor)
+        first = start // factor
+        dst_min[first:first + len(mins)] = mins
+        dst_max[first:first + len(maxs)] = maxs
+
+
+def build_pyramid(path, base=10):
+    """
+    Builds a min / max pyramid for the signal stored in a file at a given path.
+    Every level 'min_<factor>' / 'max_<factor>' holds minimums and maximums of
+    every 'factor' consecutive samples, factors are powers of 'base'. Levels
+    are built from each other, the raw signal is read only once.
+
+    The pyramid is written to a temporary file first and then moved in place,
+    so readers never see a partially built pyramid.
+    """
+    target = pyramid_path(path)
+    temp = target + '.tmp'
+
+    with open_file(path) as src:
+        with h5py.File(temp, 'w') as dst:
+            raw = get_dataset(src)
+            lower_min = lower_max = raw
+            factor = base
+            factors = []
+
+            while factor < len(raw):
+                shape = (int(math.ceil(len(lower_min) / float(base))),) + \
+                    raw.shape[1:]
+                level_min = dst.create_dataset('min_%d' % factor, shape, raw.dtype)
+                level_max = dst.create_dataset('max_%d' % factor, shape, raw.dtype)
+                _reduce_level(lower_min, lower_max, level_min, level_max, base)
+
+                factors.append(factor)
+                lower_min, lower_max = level_min, level_max
+                factor *= base
+
+            dst.attrs['factors'] = np.array(factors, dtype='int64')
+
+    os.rename(temp, target)
+
+
+def read_envelope_blocks(dataset, start, stop, factor, columns=None):
+    """ minimums and maximums of every 'factor' rows of [start:stop] of a
+    dataset, read block by block, so that memory usage depends on the number
+    of buckets only """
+    row_size = int(np.prod(dataset.shape[1:])) or 1
+    rows = max(factor, BLOCK_SIZE // row_size // factor * factor)
+
+    mins, maxs = [], []
+    for first in range(start, stop, rows):
+        block = select(dataset, first, min(first + rows, stop), columns)
+        block_min, block_max = envelope(block, block, factor)
+        mins.append(block_min)
+        maxs.append(block_max)
+    return np.concatenate(mins), np.concatenate(maxs)
+
+
+def read_envelope(path, start, stop, max_points, columns=None, guid=None):
+    """
+    Reads minimums and maximums of rows [start:stop] (optionally only given
+    columns) of the signal stored in a file at a given path, decimated to at
+    most 'max_points' buckets. Uses the smallest sufficient level of the
+    pyramid, if it is built. Otherwise the envelope is computed from blocks of
+    the raw signal, in bounded memory. If the pyramid is not deep enough, its
+    top level is reduced further in memory.
+
+    :returns: (factor, mins, maxs) - number of samples merged in one bucket
+              and arrays of bucket minimums and maximums
+    """
+    with file_pool.open(path, guid) as f:
+        size = len(get_dataset(f))
+
+    start, stop, step = slice(start, stop).indices(size)
+    count = max(stop - start, 0)
+    needed = lambda factor: int(math.ceil(count / float(factor)))
+
+    if count <= max_points:
+        data = read_slice(path, start, stop, columns, guid)
+        return 1, data, data
+
+    factor = 1
+    if os.path.exists(pyramid_path(path)):
+        with file_pool.open(pyramid_path(path), guid) as f:
+            factors = list(f.attrs['factors'])
+            if factors:
+                fits = [x for x in factors if needed(x) <= max_points]
+                factor = fits[0] if fits else factors[-1]
+
+                first = start // factor
+                last = int(math.ceil(stop / float(factor)))
+                mins = select(f['min_%d' % factor], first, last, columns)
+                maxs = select(f['max_%d' % factor], first, last, columns)
+
+    if factor == 1:  # no pyramid available, the slice is reduced by blocks
+        factor = int(math.ceil(count / float(max_points)))
+        with file_pool.open(path, guid) as f:
+            mins, maxs = read_envelope_blocks(get_dataset(f), start, stop,
+                                              factor, columns)
+
+    # reduce further in memory if needed
+    extra = int(math.ceil(len(mins) / float(max_points)))
+    if extra > 1:
+        mins, maxs = envelope(mins, maxs, extra)
+        factor *= extra
+
+    return factor, mins, maxs
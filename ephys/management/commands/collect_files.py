@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from ephys.models import fs
+
+
+class Command(BaseCommand):
+    help = "Removes stored files without references, like those released " \
+           "within a transaction or replaced by normalised arrays. Meant to " \
+           "run periodically, like from cron."
+
+    def handle(self, *args, **options):
+        collected = fs.collect_garbage()
+        self.stdout.write("%d stored files removed" % collected)
@@ -1,26 +1,40 @@
-from django.db import models
-from django.core.files import storage
+import os
+import bisect
+import math
+import numpy as np
+
+from django.db import models, transaction
 from state_machine.models import BaseGnodeObject
 from state_machine.versioning.models import VersionedM2M
 from state_machine.versioning.descriptors import VersionedForeignKey
 from metadata.models import Section
 from ephys.security import BlockBasedPermissionsMixin
 from ephys.fields import TimeUnitField, SignalUnitField, SamplingUnitField
+from ephys.fields import rescale
+from ephys.hdf5 import file_pool, get_dataset, read_slice, parse_channels
+from ephys.hdf5 import build_pyramid, read_envelope, pyramid_path
+from ephys.hdf5 import read_layout, iter_rows, inspect_dataset
+from ephys.hdf5 import normalise_dataset
+from ephys.tasks import run_task
+from ephys.storage import ContentAddressedStorage
 from permissions.models import BasePermissionsMixin
 from gndata_api import settings
 
-# TODO implement proper slicing
-
 # TODO create data and metadata connection
 
-# TODO make nicer upload paths?
-
 
 def make_upload_path(self, filename):
-    """ Generates upload path for FileField """
-    return "%s/%s" % (self.owner.username, filename)
+    """ Generates upload path for FileField. Files are stored by content (see
+    ContentAddressedStorage), only the extension of the name is kept. """
+    return filename
+
+fs = ContentAddressedStorage(location=settings.FILE_MEDIA_ROOT)
+
+
+def layout_text(values):
+    """ text form of an array shape like '1000,8', None if not set """
+    return None if values is None else ",".join([str(x) for x in values])
 
-fs = storage.FileSystemStorage(location=settings.FILE_MEDIA_ROOT)
 
 DEFAULTS = {
     "name_max_length": 100,
@@ -76,10 +90,44 @@ class BaseInfo(BaseGnodeObject):
         raise NotImplementedError()
 
 
+class FileBlob(models.Model):
+    """
+    A file in the content-addressed storage. Counts how many times the file
+    was stored to file fields (new versions of an object share the reference
+    of the object), the file is removed with the last reference.
+
+    Note: blobs are NOT version controlled.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    size = models.BigIntegerField(default=0)
+    references = models.IntegerField(default=0)
+    # name of the file that replaced this one (like a normalised array)
+    replaced_by = models.CharField(max_length=100, blank=True, null=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.name
+
+
 class DataObject(models.Model):
     """ implements methods and attributes for objects containing array data """
     data_size = models.IntegerField(blank=True, null=True)
 
+    # layout of the main array of an object, recorded when a file is uploaded
+    data_length = models.BigIntegerField(blank=True, null=True, editable=False)
+    data_shape = models.CharField(max_length=100, blank=True, null=True, editable=False)
+    data_dtype = models.CharField(max_length=20, blank=True, null=True, editable=False)
+    data_chunks = models.CharField(max_length=100, blank=True, null=True, editable=False)
+    data_compression = models.CharField(max_length=20, blank=True, null=True, editable=False)
+
+    # size of the file with the main array as uploaded and as stored after
+    # normalisation of its layout, bytes
+    data_uploaded_size = models.BigIntegerField(blank=True, null=True, editable=False)
+    data_stored_size = models.BigIntegerField(blank=True, null=True, editable=False)
+
+    # name of the file field with the main array of an object
+    data_field = None
+
     class Meta:
         abstract = True
 
@@ -101,6 +149,222 @@ class DataObject(models.Model):
         self.data_size = self.compute_size()
         super(DataObject, self).save(*args, **kwargs)
 
+    def update_layout(self, attr_name):
+        """ reads shape, dtype, chunks and compression of the array, uploaded
+        to a given file field, if this is the main array of an object. The file
+        should already be in the storage. Does not save the object.
+
+        :raises: ValueError if the file is not an HDF5 file with a dataset
+        """
+        if not attr_name == self.data_field:
+            return
+
+        path = getattr(self, attr_name).path
+        try:
+            layout = inspect_dataset(path)
+        except (IOError, KeyError) as e:
+            raise ValueError("File is not a valid HDF5 file: %s" % e)
+
+        self.data_length = layout['shape'][0] if layout['shape'] else 1
+        self.data_shape = layout_text(layout['shape'])
+        self.data_dtype = layout['dtype']
+        self.data_chunks = layout_text(layout['chunks'])
+        self.data_compression = layout['compression']
+        self.data_uploaded_size = self.data_stored_size = os.path.getsize(path)
+
+    def get_index_range(self, start_time=None, end_time=None, unit=None):
+        """
+        Converts a time window into a [start:stop] range of array indexes.
+
+        :return: (start, stop) - stop is exclusive, None means unbounded
+        """
+        raise ValueError("Time slicing is not supported for %s" % self.get_type)
+
+    def get_indexes(self, start_index=None, end_index=None, start_time=None,
+                    end_time=None, time__unit=None):
+        """
+        Resolves a selection of array rows, given either by a range of indexes
+        or by a time window, for which the indexes are computed from the time
+        axis of the object. Values may be given as strings (query parameters).
+
+        :return: (start, stop) - stop is exclusive, None means unbounded
+        """
+        to_number = lambda x, cast: None if x is None else cast(x)
+
+        if start_time is not None or end_time is not None:
+            if start_index is not None or end_index is not None:
+                raise ValueError("Use either time or index range, not both")
+
+            return self.get_index_range(
+                to_number(start_time, float), to_number(end_time, float),
+                time__unit
+            )
+
+        return to_number(start_index, int), to_number(end_index, int)
+
+    def get_columns(self, path, channels):
+        """ column indexes of 'channels' like '0,3,5-8' in the 2-dimensional
+        array stored in a file, None if no channels are given """
+        if channels is None:
+            return None
+
+        shape, dtype = read_layout(path, self.guid)
+        if len(shape) != 2:
+            raise ValueError("Channels can be selected in 2-dimensional "
+                             "arrays only")
+        return parse_channels(channels, shape[1])
+
+    def get_slice(self, attr_name, channels=None, **selection):
+        """
+        Reads a part of the array stored in a given file field, selected as
+        described in 'get_indexes'. For 2-dimensional arrays 'channels' like
+        '0,3,5-8' select columns. Only the selected hyperslab is read.
+
+        :return: numpy array
+        """
+        start, stop = self.get_indexes(**selection)
+        path = getattr(self, attr_name).path
+        columns = self.get_columns(path, channels)
+        return read_slice(path, start, stop, columns, self.guid)
+
+    def get_blocks(self, attr_name):
+        """
+        Gives access to the whole array stored in a given file field as
+        consecutive blocks of rows, to stream it in formats other than HDF5.
+
+        :return: (shape, dtype, blocks) - blocks is a generator of numpy arrays
+        """
+        path = getattr(self, attr_name).path
+        shape, dtype = read_layout(path, self.guid)
+        return shape, dtype, iter_rows(path, self.guid)
+
+    def get_envelope(self, attr_name, max_points, channels=None, **selection):
+        """
+        Reads minimums and maximums of the selected part of the array (and
+        selected 'channels'), reduced to at most 'max_points' buckets along the
+        time axis. Served from the min / max pyramid of the file, if one was
+        built.
+
+        :return: (factor, array) - number of samples in one bucket and an array
+                 of shape (buckets, 2, ...) with bucket minimums and maximums.
+                 If no reduction is needed (factor = 1), the raw slice.
+        """
+        max_points = int(max_points)
+        if max_points < 1:
+            raise ValueError("max_points should be a positive number")
+
+        start, stop = self.get_indexes(**selection)
+        path = getattr(self, attr_name).path
+        columns = self.get_columns(path, channels)
+        factor, mins, maxs = read_envelope(
+            path, start, stop, max_points, columns, self.guid
+        )
+
+        if factor == 1:
+            return factor, mins
+        return factor, np.stack([mins, maxs], axis=1)
+
+    def process_upload(self, attr_name, previous=None):
+        """ called when a new file is uploaded to a given file field, for any
+        post-processing of the data. Open handles of the replaced file (with
+        the 'previous' name in the storage) are closed. """
+        if previous:
+            path = self._meta.get_field(attr_name).storage.path(previous)
+            file_pool.invalidate(path)
+            file_pool.invalidate(pyramid_path(path))
+
+        run_task(self.prepare_data, attr_name)
+
+    def prepare_data(self, attr_name):
+        """ post-processing of an uploaded file, runs in background """
+        if attr_name == self.data_field and settings.DATA_CONFIG['normalise']:
+            self.normalise_data(attr_name)
+
+    def normalise_data(self, attr_name):
+        """
+        Rewrites the array, uploaded to a given file field, with the server
+        chunk layout and compression (see DATA_CONFIG). The normalised file is
+        saved in a new version of the object, only if no other version was
+        saved since this one. Works with content-addressed storage only.
+        """
+        storage = self._meta.get_field(attr_name).storage
+        if not hasattr(storage, 'replace'):
+            return
+
+        name = getattr(self, attr_name).name
+        temp = storage.temporary_path()
+        try:
+            changed = normalise_dataset(
+                storage.path(name), temp,
+                settings.DATA_CONFIG['chunk_bytes'],
+                settings.DATA_CONFIG['compression']
+            )
+            if not changed:
+                return
+            new_name = storage.store(temp, name)
+
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+        layout = inspect_dataset(storage.path(new_name))
+        values = {
+            attr_name: new_name,
+            'data_chunks': layout_text(layout['chunks']),
+            'data_compression': layout['compression'],
+            'data_stored_size': os.path.getsize(storage.path(new_name))
+        }
+        # the current version is locked, so that no other version is saved
+        # between the check and the save; any version saved after the upload
+        # (a different GUID) is left as is
+        with transaction.atomic():
+            current = self.__class__.objects.select_for_update().get(pk=self.pk)
+            updated = current.guid == self.guid and \
+                getattr(current, attr_name).name == name
+            if updated:
+                for field_name, value in values.items():
+                    setattr(current, field_name, value)
+                current.save()
+                storage.replace(name, new_name)
+
+        if not updated:  # the object was changed meanwhile
+            storage.delete(new_name)
+            return
+
+        for field_name, value in values.items():
+            setattr(self, field_name, value)
+
+
+class SampledDataObject(DataObject):
+    """ implements slicing for regularly sampled signals, where the time of
+    every sample is defined by 't_start' and 'sampling_rate' """
+
+    class Meta:
+        abstract = True
+
+    def get_index_range(self, start_time=None, end_time=None, unit=None):
+        unit = unit or self.t_start__unit
+        t_start = rescale(self.t_start, self.t_start__unit, 's')
+        rate = rescale(self.sampling_rate, self.sampling_rate__unit, 'Hz')
+
+        def to_index(time):
+            if time is None:
+                return None
+            offset = (rescale(time, unit, 's') - t_start) * rate
+            # rounding avoids float noise pushing exact sample times forward
+            return max(int(math.ceil(round(offset, 6))), 0)
+
+        return to_index(start_time), to_index(end_time)
+
+    def prepare_data(self, attr_name):
+        """ builds min / max pyramid of the signal for zoomed-out views """
+        super(SampledDataObject, self).prepare_data(attr_name)
+        if attr_name == 'signal':
+            if os.path.exists(pyramid_path(self.signal.path)):
+                return  # same content was uploaded before
+
+            build_pyramid(self.signal.path, settings.DATA_CONFIG['pyramid_base'])
+
 
 # 2 (of 15)
 class Segment(BlockBasedPermissionsMixin, BaseInfo):
@@ -123,6 +387,8 @@ class EventArray(BlockBasedPermissionsMixin, BaseInfo, DataObject):
     """
     NEO EventArray @ G-Node.
     """
+    data_field = 'times'
+
     name = models.CharField(max_length=DEFAULTS['name_max_length'], blank=True, null=True)
 
     # NEO data arrays
@@ -152,6 +418,9 @@ class Event(BlockBasedPermissionsMixin, BaseInfo):
     # NEO relationships
     segment = VersionedForeignKey(Segment)
 
+    temporal = True  # closed versions go to a history table
+    current_indexes = (('segment', 'time'),)  # events of a segment in time
+
     def save(self, *args, **kwargs):
         self.block = self.segment.block
         super(Event, self).save(*args, **kwargs)
@@ -162,6 +431,8 @@ class EpochArray(BlockBasedPermissionsMixin, BaseInfo, DataObject):
     """
     NEO EpochArray @ G-Node.
     """
+    data_field = 'times'
+
     name = models.CharField(max_length=DEFAULTS['name_max_length'], blank=True, null=True)
 
     # NEO data arrays
@@ -194,6 +465,8 @@ class Epoch(BlockBasedPermissionsMixin, BaseInfo):
     # NEO relationships
     segment = VersionedForeignKey(Segment)
 
+    current_indexes = (('segment', 'time'),)  # epochs of a segment in time
+
     def save(self, *args, **kwargs):
         self.block = self.segment.block
         super(Epoch, self).save(*args, **kwargs)
@@ -244,6 +517,8 @@ class SpikeTrain(BlockBasedPermissionsMixin, BaseInfo, DataObject):
     """
     NEO SpikeTrain @ G-Node.
     """
+    data_field = 'times'
+
     # NEO attributes
     name = models.CharField(max_length=DEFAULTS['name_max_length'], blank=True, null=True)
     t_start = models.FloatField('t_start')
@@ -271,10 +546,12 @@ class SpikeTrain(BlockBasedPermissionsMixin, BaseInfo, DataObject):
 
 
 # 11 (of 15)
-class AnalogSignalArray(BlockBasedPermissionsMixin, BaseInfo, DataObject):
+class AnalogSignalArray(BlockBasedPermissionsMixin, BaseInfo, SampledDataObject):
     """
     NEO AnalogSignalArray @ G-Node.
     """
+    data_field = 'signal'
+
     # NEO attributes
     name = models.CharField(max_length=DEFAULTS['name_max_length'], blank=True, null=True)
     sampling_rate = models.FloatField('sampling_rate')
@@ -299,10 +576,12 @@ class AnalogSignalArray(BlockBasedPermissionsMixin, BaseInfo, DataObject):
 
 
 # 12 (of 15)
-class AnalogSignal(BlockBasedPermissionsMixin, BaseInfo, DataObject):
+class AnalogSignal(BlockBasedPermissionsMixin, BaseInfo, SampledDataObject):
     """
     NEO AnalogSignal @ G-Node.
     """
+    data_field = 'signal'
+
     # NEO attributes
     name = models.CharField(max_length=DEFAULTS['name_max_length'], blank=True, null=True)
     sampling_rate = models.FloatField('sampling_rate')
@@ -328,6 +607,8 @@ class IrregularlySampledSignal(BlockBasedPermissionsMixin, BaseInfo, DataObject)
     """
     NEO IrregularlySampledSignal @ G-Node.
     """
+    data_field = 'signal'
+
     # NEO attributes
     name = models.CharField(max_length=DEFAULTS['name_max_length'], blank=True, null=True)
     t_start = models.FloatField('t_start')
@@ -348,6 +629,23 @@ class IrregularlySampledSignal(BlockBasedPermissionsMixin, BaseInfo, DataObject)
         consistent. Currently switched off. """
         super(IrregularlySampledSignal, self).full_clean(*args, **kwargs)
 
+    def get_index_range(self, start_time=None, end_time=None, unit=None):
+        """ sample times are stored in the 'times' array, which is sorted, so
+        indexes are found by a binary search reading only a few elements """
+        unit = unit or self.times__unit
+
+        with file_pool.open(self.times.path, self.guid) as f:
+            times = get_dataset(f)
+
+            def to_index(time):
+                if time is None:
+                    return None
+                return bisect.bisect_left(
+                    times, rescale(time, unit, self.times__unit)
+                )
+
+            return to_index(start_time), to_index(end_time)
+
     def save(self, *args, **kwargs):
         self.block = self.segment.block
         super(IrregularlySampledSignal, self).save(*args, **kwargs)
@@ -358,6 +656,8 @@ class Spike(BlockBasedPermissionsMixin, BaseInfo, DataObject):
     """
     NEO Spike @ G-Node.
     """
+    data_field = 'waveform'
+
     # NEO attributes
     name = models.CharField(max_length=DEFAULTS['name_max_length'], blank=True, null=True)
     time = models.FloatField()
@@ -0,0 +1,258 @@
+import os
+import glob
+import uuid
+import hashlib
+
+from django.core.files import storage
+from django.core.files.move import file_move_safe
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, transaction
+
+# size of a single block read while hashing a file
+CHUNK_SIZE = 64 * 1024
+
+PREFIX = 'sha256'
+
+# attempts to get or create a FileBlob to lock, see locked_blob
+LOCK_ATTEMPTS = 10
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """ SHA-256 hex digest of a file on disk, read in blocks """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(chunk_size), ''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class ContentAddressedStorage(storage.FileSystemStorage):
+    """
+    File system storage that keeps every distinct content once, under a name
+    derived from its SHA-256 digest like 'sha256/ab/cd/abcd...<extension>'.
+    Content is hashed while it is written, saving the same content again only
+    adds a reference to the stored file. A file is removed when the last
+    reference is deleted.
+
+    Reference counts are kept in the FileBlob model. Names not created by this
+    storage (files stored before it was introduced) are handled as usual.
+    """
+
+    @property
+    def blobs(self):
+        from ephys.models import FileBlob  # models are built on this storage
+        return FileBlob.objects
+
+    def blob_name(self, digest, name):
+        """ name of the content with a given digest, the extension of the
+        original file name is kept """
+        extension = os.path.splitext(name)[1].lower()
+        return '/'.join([PREFIX, digest[:2], digest[2:4], digest + extension])
+
+    def is_blob(self, name):
+        return name.startswith(PREFIX + '/')
+
+    def get_available_name(self, name):
+        """ names are derived from the content, never taken """
+        return name
+
+    def temporary_path(self):
+        """ path for a new temporary file on the storage volume, so that it
+        can be moved into the storage without copying """
+        directory = self.path('tmp')
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # created concurrently
+                pass
+
+        return os.path.join(directory, uuid.uuid4().hex)
+
+    def _spool(self, content):
+        """ writes content into a temporary file in the storage, computing its
+        digest on the way
+
+        :returns: (path, digest)
+        """
+        path = self.temporary_path()
+        digest = hashlib.sha256()
+        with open(path, 'wb') as f:
+            for data in content.chunks():
+                digest.update(data)
+                f.write(data)
+
+        return path, digest.hexdigest()
+
+    def _save(self, name, content):
+        digest = getattr(content, 'sha256', None)
+        if hasattr(content, 'temporary_file_path'):
+            temp = content.temporary_file_path()
+            spooled = False
+        else:
+            temp, digest = self._spool(content)
+            spooled = True
+
+        try:
+            return self.store(temp, name, digest)
+        finally:
+            content.close()
+            if spooled and os.path.exists(temp):
+                os.remove(temp)
+
+    def store(self, path, name, digest=None):
+        """ moves a file at a given path into the storage (or drops it, if the
+        same content is stored already) and adds a reference to it.
+
+        :param name:    original file name
+        :returns:       name of the stored file
+        """
+        if digest is None:
+            digest = hash_file(path)
+
+        blob = self.blob_name(digest, name)
+        full_path = self.path(blob)
+        with transaction.atomic():
+            stored = self.locked_blob(blob)
+            if not os.path.exists(full_path):
+                directory = os.path.dirname(full_path)
+                if not os.path.exists(directory):
+                    try:
+                        os.makedirs(directory)
+                    except OSError:  # created concurrently
+                        pass
+
+                file_move_safe(path, full_path, allow_overwrite=True)
+
+            stored.size = os.path.getsize(full_path)
+            stored.references += 1
+            stored.save()
+        return blob
+
+    def replace(self, name, new_name):
+        """ moves one reference from a stored file to another one, just stored
+        for it (like the same array in a different layout). The old file is
+        left in place, as other objects, other file fields and closed versions
+        may still refer to it, and is removed with its last reference as
+        usual. The old name is kept as an alias, so that the old content is
+        linked to the new file. """
+        with transaction.atomic():
+            old = self.locked_blob(name)
+            old.references = max(old.references - 1, 0)
+            old.replaced_by = new_name
+            old.save()
+
+    def locked_blob(self, name):
+        """ FileBlob of a stored file, locked until the end of the current
+        transaction, so that references are counted and files are removed
+        without races. Created without references if missing.
+
+        :raises: IntegrityError if the blob is removed concurrently every time
+                 it is created, LOCK_ATTEMPTS times
+        """
+        for attempt in range(LOCK_ATTEMPTS):
+            try:
+                return self.blobs.select_for_update().get(name=name)
+            except ObjectDoesNotExist:
+                pass
+
+            try:
+                with transaction.atomic():
+                    self.blobs.create(name=name, references=0)
+            except IntegrityError:  # created concurrently
+                pass
+
+        raise IntegrityError("Could not lock stored file %s in %d attempts" %
+                             (name, LOCK_ATTEMPTS))
+
+    def link(self, digest, name, allowed=None):
+        """ adds a reference to already stored content with a given digest, so
+        that a repeated upload does not need to be sent at all. Knowing a
+        digest is no proof of having the content, so 'allowed' should tell if
+        the client has access to a stored file already.
+
+        :param name:    original file name
+        :param allowed: function of a stored file name, True if it may be
+                        linked
+        :returns:       name of the stored file or None if not stored (or not
+                        allowed)
+        """
+        blob = self.blob_name(digest.lower(), name)
+        try:
+            target = self.blobs.get(name=blob).replaced_by or blob
+        except ObjectDoesNotExist:
+            return None
+
+        if allowed is not None and not (allowed(blob) or allowed(target)):
+            return None
+
+        with transaction.atomic():
+            try:
+                stored = self.blobs.select_for_update().get(
+                    name=target, references__gt=0
+                )
+            except ObjectDoesNotExist:  # removed concurrently
+                return None
+
+            if not self.exists(target):
+                return None
+
+            stored.references += 1
+            stored.save()
+        return target
+
+    def delete(self, name):
+        """ removes one reference to a stored file. The file, together with
+        files derived from it and stored next to it (like pyramids), is removed
+        after the last reference is committed, see collect. Within an outer
+        transaction the file is left for collect_garbage, as the transaction
+        may still be rolled back. Files stored before content addressing are
+        removed at once, with their derived files too. """
+        if not self.is_blob(name):  # stored before, not counted
+            return self.remove_files(name)
+
+        with transaction.atomic():
+            stored = self.locked_blob(name)
+            stored.references = max(stored.references - 1, 0)
+            stored.save()
+
+        if stored.references == 0 and \
+                not transaction.get_connection().in_atomic_block:
+            self.collect(name)
+
+    def collect(self, name):
+        """ removes a stored file (and files derived from it) if it has no
+        references. The blob of a replaced file is kept as an alias, with no
+        size. """
+        with transaction.atomic():
+            try:
+                stored = self.blobs.select_for_update().get(
+                    name=name, references=0
+                )
+            except ObjectDoesNotExist:  # referenced again or removed already
+                return
+
+            if stored.replaced_by:
+                stored.size = 0
+                stored.save()
+            else:
+                stored.delete()
+            self.remove_files(name)
+
+    def collect_garbage(self):
+        """ removes all stored files without references
+
+        :returns: number of collected names
+        """
+        unreferenced = self.blobs.filter(references=0).exclude(
+            replaced_by__isnull=False, size=0  # collected aliases
+        )
+        names = list(unreferenced.values_list('name', flat=True))
+        for name in names:
+            self.collect(name)
+        return len(names)
+
+    def remove_files(self, name):
+        """ removes a stored file and files derived from it """
+        for derived in glob.glob(self.path(name) + '.*'):
+            os.remove(derived)
+        super(ContentAddressedStorage, self).delete(name)
@@ -0,0 +1,28 @@
+import logging
+import threading
+
+from django.db import connection
+from gndata_api import settings
+
+logger = logging.getLogger(__name__)
+
+
+def run_task(func, *args, **kwargs):
+    """ runs a data processing function (building pyramids etc.) in a
+    background thread, so that the request that uploaded the data is not
+    delayed. Runs synchronously if background processing is switched off. """
+    def safe_run():
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Data processing task %s failed", func.__name__)
+        finally:
+            connection.close()  # every thread has its own connection
+
+    if not settings.DATA_CONFIG['background']:
+        return func(*args, **kwargs)
+
+    thread = threading.Thread(target=safe_run)
+    thread.daemon = True
+    thread.start()
+    return thread
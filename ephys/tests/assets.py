@@ -1,10 +1,9 @@
 from django.contrib.auth.models import User
-from django.core.files import File
+from django.core.files.base import ContentFile
 from gndata_api.baseassets import BaseAssets
 from ephys.models import *
-from gndata_api.settings import FILE_MEDIA_ROOT
 
-import os
+import io
 import random
 import h5py
 import uuid
@@ -24,17 +23,13 @@ class Assets(BaseAssets):
     def make_dummy_file(self, obj_with_owner):
         uid = uuid.uuid1().hex
         filename = uid + '.h5'
-        rel_path = make_upload_path(obj_with_owner, filename)
-        fullpath = os.path.join(FILE_MEDIA_ROOT, rel_path)
 
-        if not os.path.exists(fullpath.replace(filename, '')):
-            os.makedirs(fullpath.replace(filename, ''))
-
-        f = h5py.File(fullpath)
+        buf = io.BytesIO()
+        f = h5py.File(buf, 'w')
         f.create_dataset(name=uid, data=[1.48, 2.58, 3.30, 3.88, 4.75])
         f.close()
 
-        return rel_path
+        return fs.save(filename, ContentFile(buf.getvalue()))
 
     def fill(self):
         # collector for created objects
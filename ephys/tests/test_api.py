@@ -1,7 +1,23 @@
+import io
+import hashlib
+import os
+import uuid
+import h5py
+import numpy as np
+import simplejson as json
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from gndata_api import settings
+from gndata_api.settings import FILE_MEDIA_ROOT
 from gndata_api.utils import update_keys_for_model
 from gndata_api.urls import EPHYS_RESOURCES
 from rest.tests.base import TestApi
 from ephys.tests.assets import Assets
+from ephys.models import AnalogSignal, AnalogSignalArray
+from ephys.models import IrregularlySampledSignal
+from ephys.hdf5 import pyramid_path
+from rest.uploads import UPLOADS_ROOT, UploadSession
 
 
 class TestEphysApi(TestApi):
@@ -28,4 +44,317 @@ class TestEphysApi(TestApi):
         ]
         for resource in self.resources:
             update_keys_for_model(resource.Meta.object_class)
-        self.assets = Assets().fill()
\ No newline at end of file
+        self.assets = Assets().fill()
+
+        # process uploaded data synchronously
+        self.background = settings.DATA_CONFIG['background']
+        settings.DATA_CONFIG['background'] = False
+
+    def tearDown(self):
+        settings.DATA_CONFIG['background'] = self.background
+
+    def get_array(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+
+        f = h5py.File(io.BytesIO(response.content), 'r')
+        return f[f.keys()[0]][:]
+
+    def test_get_data_slice(self):
+        self.login(self.bob)
+
+        signal = AnalogSignal.objects.all()[0]
+        url = "/%s/electrophysiology/analogsignal/%s/signal/" % (
+            self.url_prefix, signal.local_id
+        )
+
+        # dummy signal [1.48, 2.58, 3.30, 3.88, 4.75], t_start 1.56 ms, 10 kHz
+        data = self.get_array(url, start_index=1, end_index=3)
+        self.assertEqual(list(data), [2.58, 3.30])
+
+        data = self.get_array(url, start_time=1.66, end_time=1.86)
+        self.assertEqual(list(data), [2.58, 3.30])
+
+        data = self.get_array(url, start_time=0.00166, time__unit='s')
+        self.assertEqual(list(data), [2.58, 3.30, 3.88, 4.75])
+
+        response = self.client.get(url, {'start_time': 1, 'start_index': 1})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(url, {'start_time': 1, 'time__unit': 'm'})
+        self.assertEqual(response.status_code, 400)
+
+        # irregular signal, dummy times [1.48, 2.58, 3.30, 3.88, 4.75] ms
+        irsa = IrregularlySampledSignal.objects.all()[0]
+        url = "/%s/electrophysiology/irregularlysampledsignal/%s/signal/" % (
+            self.url_prefix, irsa.local_id
+        )
+        data = self.get_array(url, start_time=3.0, end_time=4.0)
+        self.assertEqual(list(data), [3.30, 3.88])
+
+    def test_get_data_envelope(self):
+        self.login(self.bob)
+
+        signal = AnalogSignal.objects.all()[0]
+        url = "/%s/electrophysiology/analogsignal/%s/signal/" % (
+            self.url_prefix, signal.local_id
+        )
+
+        path = os.path.join(FILE_MEDIA_ROOT, uuid.uuid1().hex + '.h5')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('signal', data=np.arange(10000, dtype='float64'))
+
+        try:
+            with open(path, 'rb') as f:
+                response = self.client.post(url, {'signal': f})
+            self.assertEqual(response.status_code, 202, response.content)
+        finally:
+            os.remove(path)
+
+        signal = AnalogSignal.objects.get(pk=signal.pk)
+        self.assertTrue(os.path.exists(pyramid_path(signal.signal.path)))
+
+        response = self.client.get(url, {'max_points': 100})
+        self.assertEqual(response['X-Decimation-Factor'], '100')
+
+        data = self.get_array(url, max_points=100)
+        self.assertEqual(data.shape, (100, 2))
+        self.assertEqual(list(data[1]), [100, 199])
+
+        # 10 kHz signal starting at 1.56 ms, i.e. samples 1000 - 2999
+        data = self.get_array(url, max_points=20, start_time=101.56,
+                              end_time=301.56)
+        self.assertEqual(data.shape, (20, 2))
+        self.assertEqual(list(data[0]), [1000, 1099])
+
+        data = self.get_array(url, max_points=20, start_index=10, end_index=20)
+        self.assertEqual(list(data), range(10, 20))
+
+    def test_get_data_channels(self):
+        self.login(self.bob)
+
+        asa = AnalogSignalArray.objects.all()[0]
+        url = "/%s/electrophysiology/analogsignalarray/%s/signal/" % (
+            self.url_prefix, asa.local_id
+        )
+
+        path = os.path.join(FILE_MEDIA_ROOT, uuid.uuid1().hex + '.h5')
+        with h5py.File(path, 'w') as f:
+            matrix = np.arange(1000 * 8, dtype='float64').reshape(1000, 8)
+            f.create_dataset('signal', data=matrix)
+
+        try:
+            with open(path, 'rb') as f:
+                response = self.client.post(url, {'signal': f})
+            self.assertEqual(response.status_code, 202, response.content)
+        finally:
+            os.remove(path)
+
+        # array layout is recorded on upload, the array is normalised
+        response = self.client.get(url.replace('signal/', ''))
+        asa = json.loads(response.content)
+        self.assertEqual(asa['data_length'], 1000)
+        self.assertEqual(asa['data_shape'], '1000,8')
+        self.assertEqual(asa['data_dtype'], '<f8')
+        self.assertEqual(asa['data_chunks'], '1000,8')
+        self.assertEqual(asa['data_compression'], 'lzf')
+        self.assertTrue(asa['data_stored_size'] < asa['data_uploaded_size'])
+
+        data = self.get_array(url, channels='1,4-5', start_index=2, end_index=4)
+        self.assertEqual(data.tolist(), [[17, 20, 21], [25, 28, 29]])
+
+        data = self.get_array(url, channels='5,1', end_index=1)
+        self.assertEqual(data.tolist(), [[5, 1]])
+
+        data = self.get_array(url, channels='2', max_points=10)
+        self.assertEqual(data.shape, (10, 2, 1))
+        self.assertEqual(data[0].tolist(), [[2], [794]])
+
+        for channels in ['8', 'one', '-1', '5-3', '0-1000000000']:
+            response = self.client.get(url, {'channels': channels})
+            self.assertEqual(response.status_code, 400, channels)
+
+    def test_get_data_formats(self):
+        self.login(self.bob)
+
+        signal = AnalogSignal.objects.all()[0]
+        url = "/%s/electrophysiology/analogsignal/%s/signal/" % (
+            self.url_prefix, signal.local_id
+        )
+        dummy = [1.48, 2.58, 3.30, 3.88, 4.75]
+        content = lambda r: ''.join(r.streaming_content)
+
+        response = self.client.get(url, {'format': 'json'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(content(response)), dummy)
+
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response['Content-Type'], 'application/x-hdf')
+
+        response = self.client.get(
+            url, HTTP_ACCEPT='application/json, application/x-npy;q=0.9')
+        data = np.load(io.BytesIO(content(response)))
+        self.assertEqual(list(data), dummy)
+
+        response = self.client.get(url, {'format': 'raw'})
+        self.assertEqual(response['X-Array-Shape'], '5')
+        data = np.frombuffer(content(response), response['X-Array-Dtype'])
+        self.assertEqual(list(data), dummy)
+
+        response = self.client.get(url, {'format': 'npy'})
+        data = np.load(io.BytesIO(content(response)))
+        self.assertEqual(list(data), dummy)
+
+        response = self.client.get(url, {'format': 'json', 'start_index': 3})
+        self.assertEqual(json.loads(content(response)), dummy[3:])
+
+        response = self.client.get(url, HTTP_ACCEPT='text/html,*/*;q=0.8')
+        self.assertEqual(response['Content-Type'], 'application/x-hdf')
+
+        response = self.client.get(url, {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_normalise_changed_object(self):
+        self.login(self.bob)
+
+        signal = AnalogSignal.objects.all()[0]
+        url = "/%s/electrophysiology/analogsignal/%s/signal/" % (
+            self.url_prefix, signal.local_id
+        )
+
+        path = os.path.join(FILE_MEDIA_ROOT, uuid.uuid1().hex + '.h5')
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('signal', data=np.arange(1000, dtype='float64'))
+
+        normalise = settings.DATA_CONFIG['normalise']
+        settings.DATA_CONFIG['normalise'] = False
+        try:
+            with open(path, 'rb') as f:
+                response = self.client.post(url, {'signal': f})
+            self.assertEqual(response.status_code, 202, response.content)
+        finally:
+            settings.DATA_CONFIG['normalise'] = normalise
+            os.remove(path)
+
+        # a version saved after the upload is not overwritten
+        uploaded = AnalogSignal.objects.get(pk=signal.pk)
+        changed = AnalogSignal.objects.get(pk=signal.pk)
+        changed.name = 'changed'
+        changed.save()
+
+        uploaded.normalise_data('signal')
+        current = AnalogSignal.objects.get(pk=signal.pk)
+        self.assertEqual(current.guid, changed.guid)
+        self.assertEqual(current.data_compression, None)
+
+    def test_upload_invalid_file(self):
+        self.login(self.bob)
+
+        signal = AnalogSignal.objects.all()[0]
+        url = "/%s/electrophysiology/analogsignal/%s/signal/" % (
+            self.url_prefix, signal.local_id
+        )
+
+        content = SimpleUploadedFile('signal.h5', 'not an HDF5 file')
+        response = self.client.post(url, {'signal': content})
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(AnalogSignal.objects.get(pk=signal.pk).guid,
+                         signal.guid)
+
+    def test_chunked_upload(self):
+        self.login(self.bob)
+
+        signal = AnalogSignal.objects.all()[0]
+        url = "/%s/electrophysiology/analogsignal/%s/signal/" % (
+            self.url_prefix, signal.local_id
+        )
+
+        buf = io.BytesIO()
+        with h5py.File(buf, 'w') as f:
+            f.create_dataset('signal', data=np.arange(5000, dtype='float64'))
+        content = buf.getvalue()
+        checksum = hashlib.sha256(content).hexdigest()
+        chunks = [content[i:i + 10000] for i in range(0, len(content), 10000)]
+
+        response = self.client.post(url + 'upload/', {'filename': 'big.h5'})
+        self.assertEqual(response.status_code, 201, response.content)
+        session = json.loads(response.content)
+        session_url = response['Location']
+
+        for number in reversed(range(1, len(chunks))):  # any order
+            response = self.client.put(
+                session_url + '%d/' % number, chunks[number],
+                content_type='application/octet-stream'
+            )
+            self.assertEqual(response.status_code, 204, response.content)
+
+        response = self.client.post(session_url + 'commit/',
+                                    {'checksum': checksum})
+        self.assertEqual(response.status_code, 400)  # chunk 0 is missing
+        self.assertIn('Missing chunks: 0', response.content)
+
+        response = self.client.put(session_url + '1000000000/', 'x',
+                                   content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.put(session_url + '0/', chunks[0],
+                                   content_type='application/octet-stream',
+                                   CONTENT_LENGTH='')
+        self.assertEqual(response.status_code, 411)
+
+        response = self.client.get(session_url)
+        self.assertEqual(json.loads(response.content)['chunks'],
+                         range(1, len(chunks)))
+
+        self.client.put(session_url + '0/', chunks[0],
+                        content_type='application/octet-stream')
+
+        response = self.client.post(session_url + 'commit/',
+                                    {'checksum': '0' * 64})
+        self.assertEqual(response.status_code, 400)
+
+        self.login(self.ed)  # sessions are private
+        response = self.client.get(session_url)
+        self.assertEqual(response.status_code, 404)
+
+        self.login(self.bob)
+
+        # only one commit proceeds, chunks are not changed meanwhile
+        locked = UploadSession.load(session['id'])
+        self.assertTrue(locked.lock())
+        response = self.client.post(session_url + 'commit/',
+                                    {'checksum': checksum})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.put(session_url + '0/', chunks[0],
+                                   content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 409)
+        locked.unlock()
+
+        response = self.client.post(session_url + 'commit/',
+                                    {'checksum': checksum})
+        self.assertEqual(response.status_code, 202, response.content)
+
+        data = self.get_array(url, start_index=0)
+        self.assertEqual(list(data), range(5000))
+
+        signal = AnalogSignal.objects.get(pk=signal.pk)
+        self.assertEqual(signal.data_length, 5000)
+        self.assertFalse(os.path.exists(
+            os.path.join(UPLOADS_ROOT, session['id'])
+        ))
+
+        # same content is not uploaded again
+        other = AnalogSignal.objects.all()[1]
+        url = url.replace(signal.local_id, other.local_id)
+        response = self.client.post(url + 'upload/', {'filename': 'copy.h5',
+                                                      'checksum': checksum})
+        self.assertEqual(response.status_code, 202, response.content)
+
+        other = AnalogSignal.objects.get(pk=other.pk)
+        self.assertEqual(other.signal.name, signal.signal.name)
+        self.assertEqual(other.data_length, 5000)
+
+        # only content of own objects is linked by checksum
+        resource = EPHYS_RESOURCES['analogsignal']
+        self.assertTrue(resource.is_file_owner(self.bob, signal.signal.name))
+        self.assertFalse(resource.is_file_owner(self.ed, signal.signal.name))
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import h5py
+import numpy as np
+
+from django.test import SimpleTestCase
+from ephys.hdf5 import FilePool, get_dataset, open_file, normalise_dataset
+from ephys.hdf5 import envelope, read_envelope_blocks
+from ephys import hdf5
+
+
+class TestFilePool(SimpleTestCase):
+    """
+    Tests the pool of open HDF5 files.
+    """
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.location, '%d.h5' % i)
+            with h5py.File(path, 'w') as f:
+                f.create_dataset('data', data=np.arange(10) * i)
+            self.paths.append(path)
+
+        self.pool = FilePool(2, 1024 * 1024)
+
+    def test_hits_and_misses(self):
+        for i in range(3):
+            with self.pool.open(self.paths[0], 'guid') as f:
+                self.assertEqual(get_dataset(f)[1], 0)
+
+        with self.pool.open(self.paths[0], 'other guid') as f:
+            pass
+
+        self.assertEqual(self.pool.stats['hits'], 2)
+        self.assertEqual(self.pool.stats['misses'], 2)
+
+    def test_eviction(self):
+        with self.pool.open(self.paths[0]) as first:
+            pass
+
+        with self.pool.open(self.paths[1]):
+            with self.pool.open(self.paths[2]):
+                pass
+
+        self.assertFalse(first.id.valid)  # least recently used is closed
+        self.assertEqual(self.pool.stats['open'], 2)
+
+    def test_eviction_in_use(self):
+        with self.pool.open(self.paths[0]) as first:
+            with self.pool.open(self.paths[1]):
+                with self.pool.open(self.paths[2]):
+                    pass
+
+            # evicted, but still readable while in use
+            self.assertEqual(get_dataset(first)[1], 0)
+
+        self.assertFalse(first.id.valid)
+
+    def test_invalidate(self):
+        with self.pool.open(self.paths[1], 'guid') as f:
+            pass
+
+        self.pool.invalidate(self.paths[1])
+        self.assertFalse(f.id.valid)
+
+        with self.pool.open(self.paths[1], 'guid') as f:
+            self.assertEqual(get_dataset(f)[1], 1)
+
+        self.assertEqual(self.pool.stats['misses'], 2)
+
+    def tearDown(self):
+        self.pool.clear()
+        shutil.rmtree(self.location)
+
+
+class TestNormalise(SimpleTestCase):
+    """
+    Tests rewriting of uploaded arrays with the server chunk layout.
+    """
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.src = os.path.join(self.location, 'src.h5')
+        self.dst = os.path.join(self.location, 'dst.h5')
+
+        with h5py.File(self.src, 'w') as f:
+            data = np.arange(10000 * 4, dtype='int32').reshape(10000, 4)
+            f.create_dataset('signal', data=data, chunks=(1, 4))
+            f['signal'].attrs['unit'] = 'mV'
+
+    def test_normalise(self):
+        self.assertTrue(normalise_dataset(self.src, self.dst, 1024, 'lzf'))
+
+        with open_file(self.dst) as f:
+            dataset = get_dataset(f)
+            self.assertEqual(dataset.name, '/signal')
+            self.assertEqual(dataset.chunks, (64, 4))
+            self.assertEqual(dataset.compression, 'lzf')
+            self.assertEqual(dataset.attrs['unit'], 'mV')
+            self.assertEqual(dataset[9999].tolist(), range(39996, 40000))
+
+        # layout is already normalised
+        self.assertFalse(normalise_dataset(self.dst, self.src, 1024, 'lzf'))
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+
+class TestEnvelope(SimpleTestCase):
+    """
+    Tests decimation of signals into min / max envelopes.
+    """
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.data = np.random.rand(10000, 3)
+        with h5py.File(os.path.join(self.location, 'a.h5'), 'w') as f:
+            f.create_dataset('signal', data=self.data)
+
+    def test_blocks(self):
+        # blocks of 10 rows (30 elements), rounded to whole buckets
+        self.addCleanup(setattr, hdf5, 'BLOCK_SIZE', hdf5.BLOCK_SIZE)
+        hdf5.BLOCK_SIZE = 30
+
+        with open_file(os.path.join(self.location, 'a.h5')) as f:
+            dataset = get_dataset(f)
+            mins, maxs = read_envelope_blocks(dataset, 5, 9995, 7, [2, 0])
+
+        expected = envelope(self.data[5:9995][:, [2, 0]],
+                            self.data[5:9995][:, [2, 0]], 7)
+        self.assertEqual(mins.shape, (1428, 2))
+        self.assertTrue(np.array_equal(mins, expected[0]))
+        self.assertTrue(np.array_equal(maxs, expected[1]))
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
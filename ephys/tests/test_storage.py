@@ -0,0 +1,115 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.db import IntegrityError
+from django.test import TestCase
+from ephys.models import FileBlob
+from ephys.storage import ContentAddressedStorage
+
+
+class VanishingBlobs(object):
+    """ blobs removed concurrently right after they are created """
+
+    def select_for_update(self):
+        return self
+
+    def get(self, **kwargs):
+        raise FileBlob.DoesNotExist()
+
+    def create(self, **kwargs):
+        pass
+
+
+class VanishingStorage(ContentAddressedStorage):
+    blobs = VanishingBlobs()
+
+
+class TestContentAddressedStorage(TestCase):
+    """
+    Tests the deduplicated file storage.
+    """
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = ContentAddressedStorage(location=self.location)
+        self.digest = hashlib.sha256('content').hexdigest()
+
+    def test_save_same_content(self):
+        first = self.storage.save('a.h5', ContentFile('content'))
+        second = self.storage.save('b.h5', ContentFile('content'))
+
+        self.assertEqual(first, second)
+        self.assertEqual(first, 'sha256/%s/%s/%s.h5' % (
+            self.digest[:2], self.digest[2:4], self.digest
+        ))
+        self.assertEqual(FileBlob.objects.get(name=first).references, 2)
+        self.assertEqual(os.listdir(self.storage.path('tmp')), [])
+
+        other = self.storage.save('a.h5', ContentFile('other content'))
+        self.assertNotEqual(first, other)
+
+    def test_link(self):
+        self.assertEqual(self.storage.link(self.digest, 'a.h5'), None)
+
+        name = self.storage.save('a.h5', ContentFile('content'))
+        self.assertEqual(self.storage.link(self.digest, 'b.h5'), name)
+        self.assertEqual(FileBlob.objects.get(name=name).references, 2)
+
+        # content is not linked without access to it
+        self.assertEqual(self.storage.link(self.digest, 'c.h5', lambda x:
+                                           False), None)
+        self.assertEqual(FileBlob.objects.get(name=name).references, 2)
+
+    def test_delete(self):
+        name = self.storage.save('a.h5', ContentFile('content'))
+        self.storage.save('a.h5', ContentFile('content'))
+        derived = self.storage.path(name) + '.pyramid'
+        open(derived, 'w').close()
+
+        self.storage.delete(name)
+        self.assertTrue(self.storage.exists(name))
+
+        # within a transaction (of the test) files are left for collection,
+        # as the transaction may be rolled back
+        self.storage.delete(name)
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(FileBlob.objects.get(name=name).references, 0)
+
+        self.assertEqual(self.storage.collect_garbage(), 1)
+        self.assertFalse(self.storage.exists(name))
+        self.assertFalse(os.path.exists(derived))
+        self.assertFalse(FileBlob.objects.filter(name=name).exists())
+
+    def test_locked_blob(self):
+        self.assertEqual(self.storage.locked_blob('sha256/a.h5').references, 0)
+
+        # a blob removed every time it is created is not retried forever
+        storage = VanishingStorage(location=self.location)
+        self.assertRaises(IntegrityError, storage.locked_blob, 'sha256/b.h5')
+
+    def test_replace(self):
+        name = self.storage.save('a.h5', ContentFile('content'))
+        self.storage.save('b.h5', ContentFile('content'))
+        new_name = self.storage.save('a.h5', ContentFile('normalised'))
+
+        # one reference is moved, the file stays for the other one
+        self.storage.replace(name, new_name)
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(FileBlob.objects.get(name=name).references, 1)
+        self.assertEqual(FileBlob.objects.get(name=new_name).references, 1)
+
+        # the old content is linked to the new file
+        self.assertEqual(self.storage.link(self.digest, 'c.h5'), new_name)
+
+        # the old file is collected with its last reference, the alias stays
+        self.storage.delete(name)
+        self.assertEqual(self.storage.collect_garbage(), 1)
+        self.assertFalse(self.storage.exists(name))
+        self.assertEqual(self.storage.link(self.digest, 'd.h5'), new_name)
+        self.assertEqual(self.storage.collect_garbage(), 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
@@ -47,6 +47,52 @@ REST_CONFIG = {
     'max_results': 100
 }
 
+DATA_CONFIG = {
+    # process uploaded data (pyramids etc.) in background threads
+    'background': True,
+    # rewrite uploaded arrays with chunks of 'chunk_bytes' along the time axis
+    # and a given compression filter ('lzf', 'gzip' or None)
+    'normalise': True,
+    'chunk_bytes': 256 * 1024,
+    'compression': 'lzf',
+    # decimation factor between two levels of a signal min / max pyramid
+    'pyramid_base': 10,
+    # max number of HDF5 files kept open for reading by every process
+    'file_pool_size': 64,
+    # raw data chunk cache of every open HDF5 file, bytes
+    'chunk_cache_size': 4 * 1024 * 1024,
+    # max size of a single chunk of a chunked upload, bytes
+    'max_chunk_size': 64 * 1024 * 1024,
+    # max number of chunks of a chunked upload
+    'max_chunks': 100000,
+    # uncommitted upload sessions are removed after this time, seconds
+    'upload_expiry': 24 * 3600
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # results of queries for versions in the past, which never change. Use a
+    # shared cache (like memcached) with several processes
+    'versions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'versions',
+        'TIMEOUT': 24 * 3600,
+        'OPTIONS': {'MAX_ENTRIES': 10000}
+    }
+}
+
+VERSIONS_CONFIG = {
+    # cache for results of queries 'at_time' (None to switch off)
+    'cache': 'versions',
+    # times older than that are cached, all versions made before them are
+    # committed, seconds
+    'settle_time': 60,
+    # results with more objects are not cached
+    'cache_max_objects': 1000
+}
+
 TASTYPIE_FULL_DEBUG = True
 
 # Absolute path to the directory that holds storage of USER FILES.
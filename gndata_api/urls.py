@@ -7,6 +7,8 @@ from tastypie.api import Api
 from metadata.api import *
 from ephys.api import *
 from account.api import UserResource
+from state_machine.api import SnapshotResource
+from rest.changes import ChangeFeed
 
 # API initialization -----------------------------------------------------------
 
@@ -14,6 +16,10 @@ ACCOUNT_RESOURCES = {
     'user': UserResource(),
 }
 
+VERSIONS_RESOURCES = {
+    'snapshot': SnapshotResource(),
+}
+
 METADATA_RESOURCES = {
     'document': DocumentResource(),
     'section': SectionResource(),
@@ -43,6 +49,11 @@ v1_user_api = Api(api_name='user')
 for resource in ACCOUNT_RESOURCES.values():
     v1_user_api.register(resource)
 
+# register snapshot resource
+v1_versions_api = Api(api_name='versions')
+for resource in VERSIONS_RESOURCES.values():
+    v1_versions_api.register(resource)
+
 # register all resources
 v1_metadata_api = Api(api_name='metadata')
 for resource in METADATA_RESOURCES.values():
@@ -72,8 +83,12 @@ urlpatterns = patterns('',
     # REST API -----------------------------------------------------------------
 
     url(r'^api/v1/', include(v1_user_api.urls)),
+    url(r'^api/v1/', include(v1_versions_api.urls)),
     url(r'^api/v1/', include(v1_metadata_api.urls)),
     url(r'^api/v1/', include(v1_ephys_api.urls)),
+    url(r'^api/v1/changes/$', ChangeFeed(
+        dict(METADATA_RESOURCES.items() + EPHYS_RESOURCES.items())
+    ), name='changes'),
 
     # Browser  -----------------------------------------------------------------
 
@@ -8,6 +8,9 @@ import random
 from django.core.management.color import no_style
 from django.db import connection
 from gndata_api import settings
+from state_machine.versioning.temporal import is_temporal, create_history
+from state_machine.versioning.temporal import drop_history
+from state_machine.versioning.indexes import create_indexes
 
 # this is base32hex alphabet, used to create unique IDs
 alphabet = tuple(list('0123456789' + string.ascii_uppercase)[:32])
@@ -155,10 +158,17 @@ def create_fake_model(prototype):
 
     # versioned objects require PRIMARY KEY change
     update_keys_for_model(prototype)
+    create_indexes(prototype)
+
+    if is_temporal(prototype):
+        create_history(prototype)
 
 
 def delete_fake_model(model):
     """ Delete the schema for the test model """
+    if is_temporal(model):
+        drop_history(model)
+
     sql = connection.creation.sql_destroy_model(model, (), no_style())
     _cursor = connection.cursor()
     for statement in sql:
@@ -152,6 +152,8 @@ class Property(DocumentBasedPermissionsMixin, BaseGnodeObject):
     section = VersionedForeignKey(Section, on_delete=models.CASCADE)
     document = VersionedForeignKey(Document)
 
+    temporal = True  # closed versions go to a history table
+
     def __unicode__(self):
         return self.name
 
@@ -175,6 +177,9 @@ class Value(DocumentBasedPermissionsMixin, BaseGnodeObject):
     property = VersionedForeignKey(Property, on_delete=models.CASCADE)
     document = VersionedForeignKey(Document)
 
+    temporal = True  # closed versions go to a history table
+    retention = (30, 'daily')  # older versions thinned to one per day
+
     def __unicode__(self):
         return self.data
 
@@ -1,7 +1,19 @@
+import urllib
+import simplejson as json
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.test.client import RequestFactory
+from django.utils import timezone
+from tastypie.exceptions import NotFound
 from gndata_api.utils import update_keys_for_model
 from gndata_api.urls import METADATA_RESOURCES
 from rest.tests.base import TestApi
+from rest.snapshots import MAX_AGE
 from metadata.tests.assets import Assets
+from metadata.models import Document
+from state_machine.models import Snapshot
+from state_machine.versioning.temporal import close_versions
+from gndata_api import settings
 
 
 class TestMetadataApi(TestApi):
@@ -18,4 +30,179 @@ class TestMetadataApi(TestApi):
         ]
         for resource in self.resources:
             update_keys_for_model(resource.Meta.object_class)
-        self.assets = Assets().fill()
\ No newline at end of file
+        self.assets = Assets().fill()
+
+    def changes(self, since, max_results=100):
+        """ all change records after 'since', fetched page by page """
+        url = '/%s/changes/?%s' % (self.url_prefix, urllib.urlencode({
+            'since': since.isoformat(), 'max_results': max_results
+        }))
+        records = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(''.join(response.streaming_content))
+            records += data['selected']
+            url = data['meta']['next']
+        return [(x['action'], x['type'], x['id']) for x in records]
+
+    def test_changes(self):
+        changes = self.changes
+        self.login(self.bob)
+
+        # all objects available for bob were created after the origin
+        expected = []
+        for resource in self.resources:
+            name = resource.Meta.resource_name
+            expected += [('created', name, obj.local_id) for obj in
+                         self.get_available_objs(resource, self.bob)]
+        self.assertEqual(sorted(changes(self.origin)), sorted(expected))
+
+        # pages follow each other by keyset
+        self.assertEqual(changes(self.origin, 7), changes(self.origin))
+
+        since = timezone.now()
+        document = self.assets['document'][0]
+        prop = self.assets['property'][0]
+        Document.objects.filter(pk=document.pk).update(version='2.0')
+        prop.delete()
+
+        self.assertEqual(sorted(changes(since)), sorted([
+            ('updated', 'document', document.local_id),
+            ('deleted', 'property', prop.local_id),
+            ('deleted', 'value', self.assets['value'][0].local_id)
+        ]))
+
+        self.logout()
+        response = self.client.get('/%s/changes/' % self.url_prefix)
+        self.assertEqual(response.status_code, 401)
+
+    def test_changes_access(self):
+        self.login(self.bob)
+
+        # a document of ed, public no more, is not listed at all
+        document = self.assets['document'][2]
+        self.assertIn(('created', 'document', document.local_id),
+                      self.changes(self.origin))
+
+        Document.objects.filter(pk=document.pk).update(safety_level=3)
+        self.assertNotIn(document.local_id,
+                         [x[2] for x in self.changes(self.origin)])
+
+    def test_changes_keyset(self):
+        self.login(self.bob)
+
+        # a version created and deleted at once is listed twice, on any page
+        document = Document.objects.get(pk=self.assets['document'][0].pk)
+        close_versions(Document, [document.pk], document.starts_at)
+
+        expected = [('created', 'document', document.local_id),
+                    ('deleted', 'document', document.local_id)]
+        for max_results in [1, 2, 100]:
+            records = [x for x in self.changes(self.origin, max_results)
+                       if x[2] == document.local_id]
+            self.assertEqual(records, expected)
+
+    def test_history(self):
+        def history(document, **params):
+            url = '/%s/metadata/document/%s/history/?%s' % (
+                self.url_prefix, document.local_id, urllib.urlencode(params)
+            )
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            return json.loads(response.content)['selected']
+
+        self.login(self.bob)
+        document = self.assets['document'][0]
+        old = Document.objects.get(pk=document.pk).version
+
+        Document.objects.filter(pk=document.pk).update(version='2.0')
+        since = timezone.now()
+        Document.objects.filter(pk=document.pk).update(version='3.0')
+
+        versions = history(document, diff=1)
+        self.assertEqual(len(versions), 3)
+        self.assertEqual(versions[0]['guid'], document.guid)
+        self.assertEqual(versions[0]['changes'], None)
+        self.assertEqual(versions[1]['changes'], {'version': [old, '2.0']})
+        self.assertEqual(versions[2]['changes'], {'version': ['2.0', '3.0']})
+        self.assertEqual(versions[2]['ends_at'], None)
+        self.assertEqual(versions[0]['ends_at'], versions[1]['starts_at'])
+
+        # versions valid after 'since' only
+        versions = history(document, **{'from': since.isoformat()})
+        self.assertEqual(len(versions), 2)
+        self.assertFalse('changes' in versions[0])
+
+        url = '/%s/metadata/document/%s/history/' % (self.url_prefix, 'X' * 10)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_get_via_uris(self):
+        resource = METADATA_RESOURCES['section']
+        request = RequestFactory().get('/')
+        request.user = self.bob
+
+        sections = list(self.get_available_objs(resource, self.bob))
+        uris = ['/%s/metadata/section/%s/' % (self.url_prefix, x.local_id)
+                for x in sections]
+        found = resource.get_via_uris(uris, request=request)
+        self.assertEqual([x.pk for x in found], [x.pk for x in sections])
+
+        uri = '/%s/metadata/section/%s/' % (self.url_prefix, 'X' * 10)
+        self.assertRaises(ObjectDoesNotExist, resource.get_via_uris, [uri],
+                          request)
+
+        document = self.assets['document'][0]
+        uri = '/%s/metadata/document/%s/' % (self.url_prefix, document.pk)
+        self.assertRaises(NotFound, resource.get_via_uris, [uri], request)
+
+    def test_snapshot(self):
+        settle_time = settings.VERSIONS_CONFIG['settle_time']
+        settings.VERSIONS_CONFIG['settle_time'] = 0
+        self.addCleanup(settings.VERSIONS_CONFIG.__setitem__, 'settle_time',
+                        settle_time)
+
+        self.login(self.bob)
+        response = self.client.post(
+            '/%s/versions/snapshot/' % self.url_prefix,
+            json.dumps({'name': 'before'}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+
+        # names are unique per user, snapshots of others are not visible
+        Snapshot.objects.create(name='before', owner=self.ed)
+        Snapshot.objects.create(name='other', owner=self.ed)
+        url = '/%s/versions/snapshot/' % self.url_prefix
+        response = self.client.get(url + 'before/')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.client.get(url + 'other/').status_code, 404)
+
+        document = self.assets['document'][0]
+        old = Document.objects.get(pk=document.pk).version
+        Document.objects.filter(pk=document.pk).update(version='2.0')
+
+        url = '/%s/metadata/document/%s/' % (self.url_prefix, document.pk)
+        response = self.client.get(url + '?snapshot=before')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(json.loads(response.content)['version'], old)
+        self.assertEqual(sorted(response['Cache-Control'].split(', ')),
+                         ['immutable', 'max-age=%d' % MAX_AGE, 'private'])
+        self.assertTrue('Cookie' in response['Vary'])
+
+        # lists depend on current shares, they are not cached
+        response = self.client.get(url.replace(document.pk + '/', ''),
+                                   {'snapshot': 'before'})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content)['version'], '2.0')
+        self.assertFalse('immutable' in response.get('Cache-Control', ''))
+
+        # snapshots are read only
+        response = self.client.put(url + '?snapshot=before',
+                                   json.dumps({'version': '3.0'}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(url + '?snapshot=after').status_code,
+                         404)
@@ -22,40 +22,48 @@ class BasePermissionsMixin(models.Model):
         abstract = True
 
     def share(self, users):
-        """ performs an update of the related ACL.
+        """ performs an update of the related ACL, with a fixed number of
+        queries for any number of users.
 
         :param  users   new personal accesses to an object
         :type   users   {'<user_id>': <access_level>, ...}
 
         """
-        def validate_user(user_id):
-            return User.objects.get(pk=int(user_id))
-
-        current_users = [x.access_for for x in self.shared_with]
-        users_to_remove = list(set([x.id for x in current_users]) - set(users.keys()))
+        users = dict([(int(k), v) for k, v in users.items()])
+        valid_users = User.objects.in_bulk(users.keys())
 
         for user_id, level in users.items():
-            u = validate_user(user_id)
+            if not user_id in valid_users:
+                raise User.DoesNotExist("User %s does not exist" % user_id)
 
             if level not in dict(SingleAccess.ACCESS_LEVELS).keys():
                 raise ValueError("Provided access level for the user ID %s \
                     is not valid: %s" % (user_id, level))
 
-            if u in current_users:  # update access level
-                p = self.shared_with.get(access_for=u)
-                p.access_level = level
-                p.save()
+        current = dict([(x.access_for_id, x) for x in self.shared_with])
 
-            else:  # create new access
-                SingleAccess(
+        new_accesses, changed = [], {}
+        for user_id, level in users.items():
+            if not user_id in current:  # create new access
+                new_accesses.append(SingleAccess(
                     object_id=self.local_id,
                     object_type=self.acl_type,
-                    access_for=u,
+                    access_for=valid_users[user_id],
                     access_level=level
-                ).save()
+                ))
+
+            elif current[user_id].access_level != level:  # update level
+                changed.setdefault(level, []).append(user_id)
+
+        SingleAccess.objects.bulk_create(new_accesses)
+        for level, user_ids in changed.items():
+            self.shared_with.filter(access_for__in=user_ids).update(
+                access_level=level
+            )
 
-        for u in users_to_remove:  # delete legacy accesses
-            self.shared_with.get(access_for=u).delete()
+        users_to_remove = set(current.keys()) - set(users.keys())
+        if users_to_remove:  # delete legacy accesses
+            self.shared_with.filter(access_for__in=users_to_remove).delete()
 
     @property
     def shared_with(self):
@@ -1,4 +1,5 @@
 from django.conf.urls import url
+from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from tastypie.resources import Resource, ModelResource
 from tastypie.utils import trailing_slash
@@ -9,6 +10,7 @@ from tastypie.resources import ALL
 from permissions.authorization import ACLManageAuthorization
 from permissions.models import SingleAccess
 from account.api import UserResource
+from rest.resource import detail_id_from_uri
 
 
 class ACLResource(ModelResource):
@@ -70,11 +72,19 @@ class PermissionsResourceMixin(Resource):
         if request.method == 'PUT':
             new_accesses = acl_resource.deserialize(request, request.body)
 
-            update = {}
+            # users are resolved with one query, not one per access
             user_resource = UserResource()
-            for access in new_accesses:
-                clean_user = user_resource.get_via_uri(access['user'])
-                update[clean_user.pk] = access['access_level']
+            names = [detail_id_from_uri(user_resource, access['user'])
+                     for access in new_accesses]
+            found = dict(User.objects.filter(username__in=names).values_list(
+                'username', 'pk'
+            ))
+
+            update = {}
+            for name, access in zip(names, new_accesses):
+                if not name in found:
+                    raise User.DoesNotExist("User %s does not exist" % name)
+                update[found[name]] = access['access_level']
 
             obj.share(update)
 
@@ -89,6 +89,20 @@ class TestApi(ResourceTestCase):
         new_username = SingleAccess.objects.all()[0].access_for.username
         self.assertEqual(new_username, self.neo.username)
 
+    def test_share(self):
+        obj = self.assets['owned'][1]  # shared with ed, read-only
+
+        # one query to check users, one for current accesses, then one to
+        # create, to update (per access level) and to delete accesses
+        with self.assertNumQueries(4):
+            obj.share({self.neo.pk: 2, self.bob.pk: 1, str(self.ed.pk): 2})
+        with self.assertNumQueries(3):
+            obj.share({self.neo.pk: 2})
+
+        self.assertEqual(obj.access_list, [self.neo])
+        self.assertEqual(obj.get_access_for_user(self.neo).access_level, 2)
+        self.assertRaises(User.DoesNotExist, obj.share, {999: 1})
+
     def test_access_public(self):
         pass
 
@@ -1,3 +1,4 @@
+from rest.pagination import after_cursor
 from gndata_api import settings
 
 max_results = settings.REST_CONFIG['max_results']
@@ -15,14 +16,19 @@ class BaseService(object):
     def __init__(self, model):
         self.model = model
 
-    def list(self, user, filters=[], excludes=[], max_results=max_results, offset=0):
+    def list(self, user, filters=[], excludes=[], max_results=max_results,
+             offset=0, cursor=None):
         """
         List of objects filtered with filters and negative filters (excludes).
+        Pages by keyset if a cursor is given ('' for the first page), by
+        offset otherwise.
 
         :param filters:     list of filters to apply
         :type filters:      [('key1', 'value1'), ('key1', 'value1'), ...]
         :param excludes:    list of negative filters
         :type excludes:     [('key1', 'value1'), ('key1', 'value1'), ...]
+        :param cursor:      cursor from rest.pagination.encode_cursor, pointing
+                            after the last object of the previous page
 
         :returns: list of objects of type self.model
         """
@@ -42,6 +48,9 @@ class BaseService(object):
             filter_dict = dict([filt])
             objects = objects.exclude(**filter_dict)
 
+        if cursor is not None:
+            return after_cursor(objects.distinct(), cursor)[:max_results]
+
         return objects.distinct()[offset: offset + max_results]
 
     def get(self, user, pk, at_time=None):
@@ -90,7 +99,8 @@ class BaseService(object):
         test = lambda x: not x.primary_key and x.editable
         fields = [f for f in obj._meta.local_fields if test(f)]
         params = dict([(f.attname, getattr(obj, f.attname)) for f in fields])
-        return qs.update(**params)[0]
+        qs.update(**params)
+        return self.model.objects.get(pk=pk)
 
     def delete(self, user, pk):
         """
@@ -0,0 +1,186 @@
+import heapq
+import urllib
+import simplejson as json
+
+from django.db import connections
+from django.db.models import Q
+from django.http import HttpResponseBadRequest, HttpResponseNotAllowed
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from tastypie import http
+from permissions.authorization import SessionAuthenticationNoSCRF
+from state_machine.versioning.temporal import all_versions, versions_view
+from state_machine.versioning.temporal import is_temporal
+from gndata_api import settings
+
+# actions of change records, in the order of records at the same time and
+# guid: a version created and deleted at once is reported as created first
+ACTIONS = {'created': 0, 'updated': 0, 'deleted': 1}
+
+
+def parse_time(value):
+    """ parses an ISO 8601 timestamp given in a request
+
+    :raises: ValueError if the value can not be parsed
+    """
+    parsed = parse_datetime(value.replace(' ', '+'))  # '+' sent unquoted
+    if parsed is None or parsed.tzinfo is None:
+        raise ValueError("Timestamp %s should be in ISO 8601 format with a "
+                         "time zone" % value)
+    return parsed
+
+
+def parse_cursor(value):
+    """ parses a cursor like '<timestamp>,<guid>,<action>' """
+    parts = value.rsplit(',', 2)
+    if len(parts) < 3:
+        raise ValueError("Cursor %s should be like <timestamp>,<guid>,"
+                         "<action>" % value)
+    time, guid, action = parts
+    if not action in ACTIONS:
+        raise ValueError("Unknown action %s in cursor" % action)
+    return parse_time(time), guid, action
+
+
+class ChangeFeed(object):
+    """
+    View listing objects changed since a given time, across all versioned
+    models of given resources the user can access:
+
+    GET /api/v1/changes/?since=<ISO 8601 timestamp>
+
+    Every change is a record with the time, action ('created', 'updated' or
+    'deleted'), type, ID, guid of the version and location of the object. A
+    new version is reported at its 'starts_at', a deletion at the 'ends_at' of
+    the last version. Records are ordered by (time, guid, action) and
+    paginated by keyset: the 'next' link continues after the last record of a
+    page, so pages do not shift while objects change.
+
+    Objects are listed if the user owns them, or has access to their current
+    version; access to an object in the past does not show its later changes.
+    """
+    authentication = SessionAuthenticationNoSCRF()
+
+    def __init__(self, resources):
+        """ :param resources: {<resource name>: <resource>} """
+        self.resources = resources
+
+    def __call__(self, request):
+        if request.method != 'GET':
+            return HttpResponseNotAllowed(['GET'])
+
+        if not self.authentication.is_authenticated(request):
+            return http.HttpUnauthorized()
+
+        try:
+            if 'cursor' in request.GET:
+                after = parse_cursor(request.GET['cursor'])
+            elif 'since' in request.GET:
+                after = (parse_time(request.GET['since']), '', '')
+            else:
+                raise ValueError("Parameter 'since' is required")
+
+            limit = settings.REST_CONFIG['max_results']
+            limit = min(int(request.GET.get('max_results', limit)), limit)
+            if limit < 1:
+                raise ValueError("Parameter 'max_results' should be positive")
+
+        except ValueError, e:
+            return HttpResponseBadRequest(str(e))
+
+        # one more record than requested tells if there is a next page
+        changes = list(heapq.merge(*[
+            iterator for name in sorted(self.resources.keys())
+            for iterator in self.model_changes(request, name, after, limit + 1)
+        ]))[:limit + 1]
+
+        next_url = None
+        if len(changes) > limit:
+            changes = changes[:limit]
+            last = changes[-1]
+            next_url = '%s?%s' % (request.path, urllib.urlencode({
+                'cursor': '%s,%s,%s' % (last[0].isoformat(), last[1], last[3]),
+                'max_results': limit
+            }))
+
+        prefix = request.is_secure() and 'https' or 'http'
+        base = '%s://%s' % (prefix, request.get_host())
+        meta = {'limit': limit, 'next': next_url and base + next_url}
+        content = self.serialize(changes, meta, base)
+        return StreamingHttpResponse(content, content_type='application/json')
+
+    def model_changes(self, request, name, after, limit):
+        """ new versions and deletions of objects of a resource after a given
+        (time, guid, action) position, each as a sorted list of at most 'limit'
+        records (time, guid, order of action, action, resource name, local
+        ID) """
+        model = self.resources[name]._meta.object_class
+        time, guid, action = after
+
+        versions = all_versions(model)
+        qn = connections[versions.db].ops.quote_name
+        table = model._meta.db_table
+        owner = "%s.%s = %%s" % (
+            qn(table), qn(model._meta.get_field('owner').column)
+        )
+        if hasattr(model, 'security_filter'):
+            # access is checked on current versions, not on the past ones
+            sql, params = model.security_filter(
+                model.objects.all(), request.user
+            ).selection()
+            versions = versions.extra(where=[
+                "(%s OR %s.%s IN (%s))" % (owner, qn(table), qn('local_id'),
+                                           sql)
+            ], params=[request.user.pk] + list(params))
+        else:
+            versions = versions.extra(where=[owner], params=[request.user.pk])
+
+        after_created = Q(starts_at__gt=time) | \
+            Q(starts_at=time, guid__gt=guid)
+        if not action:  # nothing listed at (time, guid) yet
+            after_created |= Q(starts_at=time, guid=guid)
+        created = versions.filter(after_created).order_by(
+            'starts_at', 'guid'
+        ).values_list('starts_at', 'guid', 'date_created', 'local_id')[:limit]
+
+        # the last version of a deleted object is closed without a successor,
+        # a version created and closed at once is no successor of itself
+        successors = versions_view(model) if is_temporal(model) else table
+        after_deleted = Q(ends_at__gt=time) | Q(ends_at=time, guid__gt=guid)
+        if action != 'deleted':
+            after_deleted |= Q(ends_at=time, guid=guid)
+        deleted = versions.filter(after_deleted).extra(where=[
+            "NOT EXISTS (SELECT 1 FROM %s successor WHERE successor.%s = "
+            "%s.%s AND successor.%s = %s.%s AND successor.%s <> %s.%s)" % (
+                qn(successors), qn('local_id'), qn(table), qn('local_id'),
+                qn('starts_at'), qn(table), qn('ends_at'), qn('guid'),
+                qn(table), qn('guid')
+            )
+        ]).order_by('ends_at', 'guid').values_list(
+            'ends_at', 'guid', 'local_id'
+        )[:limit]
+
+        records = []
+        for x in created:
+            kind = 'created' if x[0] == x[2] else 'updated'
+            records.append((x[0], x[1], ACTIONS[kind], kind, name, x[3]))
+        yield records
+        yield [(x[0], x[1], ACTIONS['deleted'], 'deleted', name, x[2])
+               for x in deleted]
+
+    def serialize(self, changes, meta, base):
+        """ streams a page of changes as JSON, in the format of tastypie lists
+        (records under 'selected') """
+        yield '{"meta": %s, "selected": [' % json.dumps(meta)
+        for i, (time, guid, _, action, name, local_id) in enumerate(changes):
+            uri = self.resources[name].get_resource_uri()
+            record = {
+                'time': time.isoformat(),
+                'action': action,
+                'type': name,
+                'id': local_id,
+                'guid': guid,
+                'location': '%s%s%s/' % (base, uri, local_id)
+            }
+            yield (i and ', ' or '') + json.dumps(record)
+        yield ']}'
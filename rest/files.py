@@ -0,0 +1,282 @@
+import os
+import re
+import io
+import h5py
+import mimeparse
+import numpy as np
+import simplejson as json
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from tastypie import http
+
+# size of a single block read from disk while streaming a file
+CHUNK_SIZE = 64 * 1024
+
+# query parameters that select a part of an array instead of the whole file
+SLICE_PARAMS = ('start_index', 'end_index', 'start_time', 'end_time',
+                'time__unit', 'max_points', 'channels')
+
+# supported formats of array data: name -> (mime type, file extension)
+DATA_FORMATS = {
+    'json': ('application/json', '.json'),
+    'npy': ('application/x-npy', '.npy'),
+    'raw': ('application/octet-stream', '.bin'),
+    'hdf5': ('application/x-hdf', '.h5'),
+}
+
+# formats chosen by the 'Accept' header, only data-specific media types
+NEGOTIATED_FORMATS = ('npy', 'raw')
+
+range_regex = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', re.I)
+
+
+class HttpRangeNotSatisfiable(http.HttpResponse):
+    status_code = 416
+
+
+class HttpLengthRequired(http.HttpResponse):
+    status_code = 411
+
+
+def file_iterator(f, offset=0, length=None, chunk_size=CHUNK_SIZE):
+    """ generator that reads a given open file from 'offset' in blocks of at
+    most 'chunk_size' bytes, until 'length' bytes (or the whole file) are read.
+    Closes the file at the end. """
+    try:
+        f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            data = f.read(size)
+            if not data:
+                break
+
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def parse_range(header, size):
+    """ parses a value of the HTTP 'Range' header like 'bytes=0-499',
+    'bytes=500-' or 'bytes=-500' into an inclusive (first, last) byte pair for
+    a file of a given size. Multiple ranges are not supported.
+
+    :returns: None if the header is not set or can not be parsed (the whole file
+              should be sent), (first, last) tuple otherwise
+    :raises:  ValueError if the range can not be satisfied
+    """
+    if not header:
+        return None
+
+    match = range_regex.match(header)
+    if match is None:
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+
+    if size == 0:  # no byte of an empty file can be selected
+        raise ValueError("Range %s is not satisfiable" % header)
+
+    if not first:  # suffix range, last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range requested")
+        return max(size - length, 0), size - 1
+
+    first = int(first)
+    last = int(last) if last else size - 1
+    if first > last or first >= size:
+        raise ValueError("Range %s is not satisfiable" % header)
+
+    return first, min(last, size - 1)
+
+
+def make_etag(filepath):
+    """ validator of the file, based on its modification time and size. Sent
+    as a strong ETag, as stored files are never changed in place (new content
+    gets a new name in the content-addressed storage). """
+    stat = os.stat(filepath)
+    return '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+
+
+def range_applies(request, etag, last_modified):
+    """ checks the 'If-Range' header: a range is served only if the file has
+    not changed since the client fetched the validator """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+
+    since = parse_http_date_safe(if_range)
+    return since is not None and int(last_modified) <= since
+
+
+def stream_file(request, filepath, content_type, chunk_size=CHUNK_SIZE):
+    """
+    Builds a streaming response for a file on disk, so that a file is never
+    fully loaded into memory. Honours 'Range' and 'If-Range' headers, returning
+    206 (Partial Content) for a satisfiable byte range.
+
+    :param request:     incoming http request
+    :param filepath:    absolute path to the file to serve
+    :param content_type: mime type of the response
+    :return:            Http Response
+    """
+    size = os.path.getsize(filepath)
+    etag = make_etag(filepath)
+    last_modified = os.path.getmtime(filepath)
+
+    first, last = 0, size - 1
+    partial = False
+
+    if range_applies(request, etag, last_modified):
+        try:
+            requested = parse_range(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpRangeNotSatisfiable()
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+
+        if requested is not None:
+            first, last = requested
+            partial = True
+
+    length = last - first + 1 if size > 0 else 0
+    content = file_iterator(open(filepath, 'rb'), first, length, chunk_size)
+
+    response = StreamingHttpResponse(content, content_type=content_type)
+    if partial:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+
+    response['Content-Disposition'] = "attachment; filename=%s" % \
+                                      os.path.basename(filepath)
+    response['Content-Length'] = length
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def determine_data_format(request):
+    """ chooses a format of array data from the 'format' query parameter or,
+    if not given, from media types listed explicitly in the 'Accept' header.
+    Only NEGOTIATED_FORMATS are picked from 'Accept', so that generic clients
+    sending 'application/json' or wildcards still get HDF5, the default.
+
+    :raises: ValueError if the requested format is not supported
+    """
+    if 'format' in request.GET:
+        name = request.GET['format']
+        if not name in DATA_FORMATS:
+            raise ValueError("Format %s is not supported. Use: %s." %
+                             (name, ", ".join(DATA_FORMATS.keys())))
+        return name
+
+    best, best_quality = 'hdf5', 0
+    for media_range in request.META.get('HTTP_ACCEPT', '').split(','):
+        if not media_range.strip():
+            continue
+        try:
+            main, sub, params = mimeparse.parse_media_range(media_range)
+            quality = float(params.get('q', 1))
+        except ValueError:
+            continue
+        for name in NEGOTIATED_FORMATS:
+            if DATA_FORMATS[name][0] == '%s/%s' % (main, sub) and \
+                    quality > best_quality:
+                best, best_quality = name, quality
+
+    return best
+
+
+def encode_blocks(format, shape, dtype, blocks):
+    """
+    Encodes an array, given as consecutive blocks of rows, into 'raw' (little-
+    endian C-ordered binary buffer), 'npy' or 'json' format. Blocks are encoded
+    one by one, so an array of any size may be streamed.
+
+    :param shape:   shape of the whole array
+    :param dtype:   numpy dtype of the array
+    :param blocks:  iterable of numpy arrays
+    """
+    little = np.dtype(dtype).newbyteorder('<')
+
+    if format == 'json':
+        yield '['
+        first = True
+        for block in blocks:
+            if len(block) == 0:
+                continue
+            if not first:
+                yield ', '
+            yield json.dumps(block.tolist())[1:-1]
+            first = False
+        yield ']'
+        return
+
+    if format == 'npy':
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+            'descr': np.lib.format.dtype_to_descr(little),
+            'fortran_order': False,
+            'shape': tuple(shape)
+        })
+        yield header.getvalue()
+
+    for block in blocks:
+        # the response makes bytes of every item anyway, so each block is
+        # copied once here, into little-endian C order. Memory held is
+        # bounded by the size of a block, not of the array.
+        yield np.ascontiguousarray(block, dtype=little).tostring()
+
+
+def data_response(format, shape, dtype, blocks, filename):
+    """
+    Builds a streaming response for an array in 'raw', 'npy' or 'json' format.
+    Shape and dtype of the array are sent in 'X-Array-Shape' and
+    'X-Array-Dtype' headers, so that a 'raw' buffer can be decoded directly.
+
+    :param filename:    name of the original file, extension is replaced
+    :return:            Http Response
+    """
+    mime, extension = DATA_FORMATS[format]
+    content = encode_blocks(format, shape, dtype, blocks)
+    little = np.dtype(dtype).newbyteorder('<')
+
+    response = StreamingHttpResponse(content, content_type=mime)
+    response['Content-Disposition'] = "attachment; filename=%s" % \
+                                      (os.path.splitext(filename)[0] + extension)
+    response['X-Array-Shape'] = ",".join([str(x) for x in shape])
+    response['X-Array-Dtype'] = little.str
+    if format == 'raw':
+        response['Content-Length'] = int(np.prod(shape)) * little.itemsize
+    return response
+
+
+def array_response(array, filename, format='hdf5'):
+    """ builds a response for an array, computed in memory (slices etc.)
+
+    :param array:       numpy array
+    :param filename:    name of the file to suggest to the client
+    :param format:      one of DATA_FORMATS
+    :return:            Http Response
+    """
+    if not format == 'hdf5':
+        return data_response(format, array.shape, array.dtype, [array], filename)
+
+    buf = io.BytesIO()
+    with h5py.File(buf, 'w') as f:
+        f.create_dataset(os.path.splitext(filename)[0], data=array)
+
+    response = HttpResponse(buf.getvalue(), content_type='application/x-hdf')
+    response['Content-Disposition'] = "attachment; filename=%s" % filename
+    response['Content-Length'] = len(response.content)
+    return response
@@ -0,0 +1,103 @@
+import base64
+import urllib
+import simplejson as json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+#===============================================================================
+# Keyset (cursor) pagination. Objects are ordered by (date_created, local_id),
+# which does not change between versions of an object, and a page continues
+# after the keys of the last object of the previous page. Every page is an
+# index range scan, whatever its depth, and pages do not shift when objects
+# are created or deleted. The cursor is opaque to clients.
+#===============================================================================
+
+KEYSET = ('date_created', 'local_id')
+
+
+def encode_cursor(obj):
+    """ cursor pointing after a given object """
+    keys = [obj.date_created.isoformat(), obj.local_id]
+    return base64.urlsafe_b64encode(json.dumps(keys))
+
+
+def decode_cursor(cursor):
+    """ keys (date_created, local_id) of a cursor
+
+    :raises: ValueError if the cursor is not valid
+    """
+    try:
+        created, local_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor %s" % cursor)
+
+    created = parse_datetime(created)
+    if created is None or not isinstance(local_id, basestring):
+        raise ValueError("Invalid cursor %s" % cursor)
+    return created, local_id
+
+
+def after_cursor(objects, cursor):
+    """ objects ordered by keyset, after a given cursor (from the start if the
+    cursor is empty) """
+    objects = objects.order_by(*KEYSET)
+    if not cursor:
+        return objects
+
+    created, local_id = decode_cursor(cursor)
+    return objects.filter(
+        Q(date_created__gt=created) | Q(date_created=created,
+                                        local_id__gt=local_id)
+    )
+
+
+class CursorPaginator(Paginator):
+    """
+    Paginates by keyset if the request has a 'cursor' parameter (empty for the
+    first page), and by offset otherwise. Cursor pages have no 'offset' and
+    'total_count' in meta, as both need all previous objects to be counted.
+    """
+
+    def page(self):
+        if not 'cursor' in self.request_data:
+            return super(CursorPaginator, self).page()
+
+        if 'order_by' in self.request_data:
+            raise BadRequest("Parameter 'order_by' is not supported with "
+                             "'cursor'.")
+
+        limit = self.get_limit()
+        try:
+            objects = after_cursor(self.objects, self.request_data['cursor'])
+        except ValueError, e:
+            raise BadRequest(str(e))
+
+        if limit:
+            # one more object than requested tells if there is a next page
+            objects = list(objects[:limit + 1])
+        else:
+            objects = list(objects)
+
+        meta = {'limit': limit, 'previous': None, 'next': None}
+        if limit and len(objects) > limit:
+            objects = objects[:limit]
+            meta['next'] = self.get_cursor_uri(limit, encode_cursor(objects[-1]))
+
+        return {
+            self.collection_name: objects,
+            'meta': meta,
+        }
+
+    def get_cursor_uri(self, limit, cursor):
+        if self.resource_uri is None:
+            return None
+
+        params = dict([
+            (k, isinstance(v, unicode) and v.encode('utf-8') or v) for k, v in
+            self.request_data.items() if not k in ('limit', 'offset', 'cursor')
+        ])
+        params.update({'limit': limit, 'cursor': cursor})
+        return '%s?%s' % (self.resource_uri, urllib.urlencode(params))
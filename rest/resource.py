@@ -3,16 +3,56 @@ import urlparse
 
 from django.conf.urls import url
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.http import HttpResponse
-from django.db import models
+from django.core.urlresolvers import get_script_prefix, Resolver404
+from django.db import models, transaction
 from django.db.models.fields import FieldDoesNotExist
 from tastypie import fields, http
 from tastypie.utils import trailing_slash
 from tastypie.constants import ALL, ALL_WITH_RELATIONS
+from tastypie.exceptions import ImmediateHttpResponse, NotFound, ApiFieldError
 from tastypie.resources import ModelResource
 from account.api import UserResource
 from permissions.authorization import BaseAuthorization
 from permissions.authorization import SessionAuthenticationNoSCRF
+from rest.files import stream_file, array_response, data_response
+from rest.files import determine_data_format, SLICE_PARAMS
+from rest.files import HttpLengthRequired
+from rest.uploads import UploadSession
+from rest.pagination import CursorPaginator
+from rest.changes import parse_time
+from rest.snapshots import get_snapshot, patch_snapshot_headers
+from rest.snapshots import SnapshotCache
+from state_machine.versioning.temporal import object_versions
+from gndata_api import settings
+
+
+def detail_id_from_uri(resource, uri):
+    """ value of the detail URI field (like 'pk') of an object at a given URI
+    of a resource, resolved as in 'get_via_uri' but without fetching the object
+
+    :raises: NotFound if the URI is not a link to an object
+    """
+    prefix = get_script_prefix()
+    chomped_uri = uri
+    if prefix and chomped_uri.startswith(prefix):
+        chomped_uri = chomped_uri[len(prefix) - 1:]
+
+    name = resource._meta.detail_uri_name
+    try:
+        found_at = chomped_uri.index(resource._meta.resource_name)
+        chomped_uri = chomped_uri[found_at:]
+        for url_resolver in resource.urls:
+            result = url_resolver.resolve(chomped_uri)
+            if result is not None:
+                kwargs = resource.remove_api_resource_names(result[2])
+                if kwargs.keys() == [name]:
+                    return kwargs[name]
+                break
+    except (ValueError, Resolver404):
+        pass
+
+    raise NotFound("The URL provided '%s' was not a link to a valid "
+                   "resource." % uri)
 
 
 class BaseMeta:
@@ -21,6 +61,8 @@ class BaseMeta:
     authorization = BaseAuthorization()
     collection_name = 'selected'
     always_return_data = True
+    paginator_class = CursorPaginator
+    cache = SnapshotCache()
     filtering = {
         'id': ALL,
         'date_created': ALL,
@@ -38,6 +80,16 @@ class BaseGNodeResource(ModelResource):
     def determine_format(self, request):
         return 'application/json'
 
+    @classmethod
+    def api_field_from_django_field(cls, f, default=fields.CharField):
+        """ tastypie maps unknown model fields to strings, BigIntegerField
+        included """
+        if f.get_internal_type() == 'BigIntegerField':
+            return fields.IntegerField
+        return super(BaseGNodeResource, cls).api_field_from_django_field(
+            f, default
+        )
+
     def dehydrate(self, bundle):
         """ tastypie does not (?) support full URLs having hostname etc. This is
         a hack to make full URLs with http:// etc. """
@@ -99,10 +151,88 @@ class BaseGNodeResource(ModelResource):
 
     def obj_create(self, bundle, **kwargs):
         """ always set owner of an object to the request.user """
+        get_snapshot(bundle.request)  # objects can not be created in snapshots
         return super(BaseGNodeResource, self).obj_create(
             bundle, owner=bundle.request.user
         )
 
+    def get_object_list(self, request):
+        """ objects at the time of a snapshot, if one is given in the
+        'snapshot' parameter, current objects otherwise """
+        snapshot = get_snapshot(request)
+        if snapshot is None:
+            return super(BaseGNodeResource, self).get_object_list(request)
+
+        return self._meta.object_class.objects.filter(at_time=snapshot.at_time)
+
+    def get_detail(self, request, **kwargs):
+        """ details read through a snapshot may be cached, lists are not (see
+        rest.snapshots) """
+        response = super(BaseGNodeResource, self).get_detail(request, **kwargs)
+        snapshot = get_snapshot(request)
+        if snapshot is not None and response.status_code == 200:
+            patch_snapshot_headers(response, snapshot)
+        return response
+
+    def hydrate_m2m(self, bundle):
+        """ resolves lists of URIs given for to-many fields with one query per
+        field, instead of one per URI. Related objects are not dehydrated, as
+        m2m relations sent via the API are ignored (see save_m2m). """
+        for name, field in self.fields.items():
+            if not getattr(field, 'is_m2m', False) or field.readonly or \
+                    not field.attribute:
+                continue
+
+            uris = bundle.data.get(field.instance_name) or []
+            if not uris or not all([isinstance(x, basestring) for x in uris]):
+                continue  # nested objects are left to tastypie
+
+            resource = field.to_class()
+            if not hasattr(resource, 'get_via_uris'):
+                continue
+
+            try:
+                objects = resource.get_via_uris(uris, request=bundle.request)
+            except ObjectDoesNotExist as e:
+                raise ApiFieldError(str(e))
+
+            bundle.data[field.instance_name] = [
+                resource.build_bundle(obj=obj, request=bundle.request)
+                for obj in objects
+            ]
+
+        return super(BaseGNodeResource, self).hydrate_m2m(bundle)
+
+    def get_via_uris(self, uris, request=None):
+        """ objects at given URIs, like 'get_via_uri', but fetched with one
+        query, see 'in_bulk'
+
+        :return: list of objects in the order of URIs
+        :raises: NotFound if a URI is not a link to an object of the resource,
+                 ObjectDoesNotExist if an object is not found or not accessible
+        """
+        ids = [self.pk_from_uri(uri) for uri in uris]
+
+        bundle = self.build_bundle(request=request)
+        objects = self.authorized_read_list(
+            self.get_object_list(request), bundle
+        ).in_bulk(ids)
+
+        for uri, pk in zip(uris, ids):
+            if not pk in objects:
+                raise self._meta.object_class.DoesNotExist(
+                    "Could not find the provided object via resource URI "
+                    "'%s'." % uri
+                )
+        return [objects[pk] for pk in ids]
+
+    def pk_from_uri(self, uri):
+        """ ID of an object at a given URI, resolved as in 'get_via_uri'
+
+        :raises: NotFound if the URI is not a link to an object
+        """
+        return detail_id_from_uri(self, uri)
+
     def save_m2m(self, bundle):
         """ ignore m2m relations sent via the API. TODO add specific m2m like
         for RCG <-> RC and others, if any """
@@ -125,16 +255,105 @@ class BaseGNodeResource(ModelResource):
         self.log_throttled_access(request)
         return self.create_response(request, self.build_schema())
 
+    def prepend_urls(self):
+        legacy_urls = super(BaseGNodeResource, self).prepend_urls()
+        name = self._meta.resource_name
+
+        # goes first as file URLs match it as well
+        return [
+            url(
+                r"^(?P<resource_name>%s)/(?P<pk>\w[\w-]*)/history%s$" % (
+                    name, trailing_slash()
+                ),
+                self.wrap_view('get_history'),
+                name="api_%s_history" % name
+            )
+        ] + legacy_urls
+
+    def get_history(self, request, **kwargs):
+        """
+        GET .../<id>/history/ lists versions of an object, oldest first, with
+        their 'guid', 'starts_at' and 'ends_at' (null for the current one).
+
+        'from' / 'to' (ISO 8601 timestamps) select versions valid at any time
+        in between. With 'diff=1' every version has 'changes' with old and new
+        values of fields changed since the previous version in the list.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        self.log_throttled_access(request)
+
+        try:
+            start, end = [parse_time(request.GET[k]) if k in request.GET else
+                          None for k in ('from', 'to')]
+        except ValueError as e:
+            return http.HttpBadRequest(str(e))
+
+        model = self._meta.object_class
+        versions = object_versions(model, kwargs['pk'], start, end)
+        if hasattr(model, 'security_filter'):
+            versions = model.security_filter(versions, request.user)
+        else:
+            versions = versions.filter(owner=request.user)
+        versions = list(versions.order_by('starts_at'))
+
+        if not versions and start is None and end is None:
+            return http.HttpNotFound()
+
+        skipped = ('guid', 'date_created', 'starts_at', 'ends_at')
+        compared = [f for f in model._meta.local_fields if
+                    not f.name in skipped and not f.primary_key]
+
+        records = []
+        for i, version in enumerate(versions):
+            record = {
+                'guid': version.guid,
+                'starts_at': version.starts_at,
+                'ends_at': version.ends_at
+            }
+            if request.GET.get('diff') in ('1', 'true'):
+                record['changes'] = None
+                if i > 0:
+                    record['changes'] = self.version_changes(
+                        compared, versions[i - 1], version
+                    )
+            records.append(record)
+
+        return self.create_response(request, {
+            'meta': {'total_count': len(records)},
+            self._meta.collection_name: records
+        })
+
+    @staticmethod
+    def version_changes(fields, previous, version):
+        """ {<field name>: [<old value>, <new value>]} for fields which
+        differ between two versions of an object """
+        changes = {}
+        for field in fields:
+            old = field.value_from_object(previous)
+            new = field.value_from_object(version)
+            if old != new:
+                changes[field.name] = [old, new]
+        return changes
+
 
 class BaseFileResourceMixin(ModelResource):
 
     def __init__(self, *args, **kwargs):
         """ makes all file fields read-only to avoid parsing these fields on
-        create / update """
+        create / update. Fields that are not editable on the model (like array
+        layout, computed on upload) are read-only as well. """
         super(BaseFileResourceMixin, self).__init__(*args, **kwargs)
         for name, field in self.file_fields.items():
             field.readonly = True
 
+        model_fields = self._meta.object_class._meta.fields
+        computed = [f.name for f in model_fields if not f.editable]
+        for name, field in self.fields.items():
+            if field.attribute in computed:
+                field.readonly = True
+
     def dehydrate(self, bundle):
         """ converts output for every FileField into an URL (as defined in
         file_url_regex """
@@ -156,54 +375,136 @@ class BaseFileResourceMixin(ModelResource):
         return r"^(?P<resource_name>%s)/(?P<pk>\w[\w/-]*)/(?P<attr_name>\w[\w/-]*)%s$" % \
                (resource_name, trailing_slash())
 
+    def upload_url_regex(self, resource_name, suffix=''):
+        return r"^(?P<resource_name>%s)/(?P<pk>\w[\w-]*)/(?P<attr_name>\w+)/upload%s" \
+               r"%s$" % (resource_name, suffix, trailing_slash())
+
     def prepend_urls(self):
         legacy_urls = super(BaseFileResourceMixin, self).prepend_urls()
+        name = self._meta.resource_name
+        session = r"/(?P<session_id>[0-9a-f]{32})"
+
+        # upload URLs go first as the file URL matches them as well
         return legacy_urls + [
             url(
-                self.file_url_regex(self._meta.resource_name),
+                self.upload_url_regex(name),
+                self.wrap_view('process_upload_session'),
+                name="api_%s_upload" % name
+            ),
+            url(
+                self.upload_url_regex(name, session),
+                self.wrap_view('process_upload_session'),
+                name="api_%s_upload_session" % name
+            ),
+            url(
+                self.upload_url_regex(name, session + r"/(?P<chunk>\d+)"),
+                self.wrap_view('process_upload_chunk'),
+                name="api_%s_upload_chunk" % name
+            ),
+            url(
+                self.upload_url_regex(name, session + r"/commit"),
+                self.wrap_view('process_upload_commit'),
+                name="api_%s_upload_commit" % name
+            ),
+            url(
+                self.file_url_regex(name),
                 self.wrap_view('process_file'),
-                name="api_%s_data" % self._meta.resource_name
+                name="api_%s_data" % name
             )
         ]
 
-    # TODO implement different file response formats (HDF5, JSON, etc.)
+    def get_file_object(self, request, pk, attr_name):
+        """ returns the object which file field is accessed at a given URL.
 
-    def process_file(self, request, **kwargs):
-        """
-        :param request:     incoming http request
-        :param pk:          ID of the object that has file fields
-        :param attr_name:   name of the attribute where the file is stored
-        :return:            Http Response
+        :raises: ImmediateHttpResponse if object or field is not found
         """
-        attr_name = kwargs.pop('attr_name')
-
-        if not request.method in ['GET', 'POST']:
-            return http.HttpMethodNotAllowed("Use GET or POST to manage files")
-
         try:
             bundle = self.build_bundle(
-                data={'pk': kwargs['pk']}, request=request
-            )
-            obj = self.cached_obj_get(
-                bundle=bundle, **self.remove_api_resource_names(kwargs)
+                data={'pk': pk}, request=request
             )
+            obj = self.cached_obj_get(bundle=bundle, pk=pk)
 
         except ObjectDoesNotExist:
-            return http.HttpGone()
+            raise ImmediateHttpResponse(response=http.HttpGone())
 
         except MultipleObjectsReturned:
-            return http.HttpMultipleChoices("More than one object found "
-                                            "at this URL.")
+            raise ImmediateHttpResponse(response=http.HttpMultipleChoices(
+                "More than one object found at this URL."
+            ))
         try:
             field = self.Meta.object_class._meta.get_field_by_name(attr_name)[0]
 
         except FieldDoesNotExist:
-            return http.HttpBadRequest("Attribute %s does not exist" %
-                                       attr_name)
+            raise ImmediateHttpResponse(response=http.HttpBadRequest(
+                "Attribute %s does not exist" % attr_name
+            ))
 
         if not isinstance(field, models.FileField):
-            return http.HttpBadRequest("Attribute %s is not a data-field" %
-                                       attr_name)
+            raise ImmediateHttpResponse(response=http.HttpBadRequest(
+                "Attribute %s is not a data-field" % attr_name
+            ))
+
+        return obj
+
+    def attach_file(self, obj, attr_name, content=None, name=None):
+        """ stores a file in a given file field of an object and saves the
+        object. The stored file is removed if the object can't be saved, or
+        if its content is not valid (400).
+
+        :param content:     django File to store
+        :param name:        or name of a file already in the storage
+        """
+        ffile = getattr(obj, attr_name)
+        previous = ffile.name
+        if content is not None:
+            ffile.save(content.name, content, save=False)
+        else:
+            setattr(obj, attr_name, name)
+            ffile = getattr(obj, attr_name)
+
+        try:
+            if hasattr(obj, 'update_layout'):
+                try:
+                    obj.update_layout(attr_name)
+                except ValueError as e:
+                    raise ImmediateHttpResponse(
+                        response=http.HttpBadRequest(str(e))
+                    )
+
+            with transaction.atomic():
+                obj.save()
+
+        except Exception:
+            ffile.delete(save=False)
+            raise
+
+        if hasattr(obj, 'process_upload'):
+            obj.process_upload(attr_name, previous)
+
+    def process_file(self, request, **kwargs):
+        """
+        :param request:     incoming http request
+        :param pk:          ID of the object that has file fields
+        :param attr_name:   name of the attribute where the file is stored
+        :return:            Http Response
+
+        GET accepts 'start_index' / 'end_index' or 'start_time' / 'end_time'
+        (with optional 'time__unit') to return only a part of the array,
+        'channels' like '0,3,5-8' to select columns of 2-dimensional arrays and
+        'max_points' to return a min / max envelope of at most that many
+        buckets; the number of samples per bucket is sent in the
+        'X-Decimation-Factor' header.
+
+        Arrays are sent as HDF5 by default, 'raw' (little-endian binary
+        buffer), 'npy' or 'json' may be requested with the 'format' parameter.
+        'raw' and 'npy' are also chosen by their media types in 'Accept'.
+        """
+        attr_name = kwargs.pop('attr_name')
+
+        if not request.method in ['GET', 'POST']:
+            return http.HttpMethodNotAllowed("Use GET or POST to manage files")
+
+        obj = self.get_file_object(request, kwargs['pk'], attr_name)
 
         if request.method == 'GET':
             ffile = getattr(obj, attr_name)
@@ -212,12 +513,36 @@ class BaseFileResourceMixin(ModelResource):
             except ValueError:  # file is not set, empty
                 return http.HttpNoContent()
 
-            with open(filepath, 'r') as f:
-                response = HttpResponse(f.read(), mimetype='application/x-hdf')
-                response['Content-Disposition'] = "attachment; filename=%s" % \
-                                                  os.path.basename(filepath)
-                response['Content-Length'] = os.path.getsize(f.name)
-                return response
+            filename = os.path.basename(filepath)
+            selection = dict([(k, v) for k, v in request.GET.items()
+                              if k in SLICE_PARAMS])
+            try:
+                format = determine_data_format(request)
+            except ValueError as e:
+                return http.HttpBadRequest(str(e))
+
+            if not selection and format == 'hdf5':
+                return stream_file(request, filepath, 'application/x-hdf')
+
+            if not hasattr(obj, 'get_slice'):
+                return http.HttpBadRequest("Attribute %s does not support "
+                                           "slicing or formats" % attr_name)
+            try:
+                if not selection:
+                    shape, dtype, blocks = obj.get_blocks(attr_name)
+                    return data_response(format, shape, dtype, blocks, filename)
+
+                if 'max_points' in selection:
+                    factor, data = obj.get_envelope(attr_name, **selection)
+                else:
+                    factor, data = None, obj.get_slice(attr_name, **selection)
+            except ValueError as e:
+                return http.HttpBadRequest(str(e))
+
+            response = array_response(data, filename, format)
+            if factor is not None:
+                response['X-Decimation-Factor'] = factor
+            return response
 
         if not obj.is_editable(request.user):
             return http.HttpUnauthorized("No access to the update this object")
@@ -226,6 +551,197 @@ class BaseFileResourceMixin(ModelResource):
             return http.HttpNoContent()
 
         # take first file in the multipart/form request
-        setattr(obj, attr_name, request.FILES.values()[0])
-        obj.save()
+        self.attach_file(obj, attr_name, request.FILES.values()[0])
+        return http.HttpAccepted("File content updated successfully")
+
+    def is_file_owner(self, user, name):
+        """ whether current objects of a given user refer to a stored file, in
+        any file field of any model. Only such files may be linked to other
+        objects by their checksum. """
+        for model in models.get_models():
+            names = [f.name for f in model._meta.fields
+                     if isinstance(f, models.FileField)]
+            if not names or not hasattr(model, 'owner'):
+                continue
+
+            query = reduce(lambda x, y: x | y,
+                           [models.Q(**{x: name}) for x in names])
+            if model.objects.filter(owner=user).filter(query).exists():
+                return True
+        return False
+
+    def get_upload_session(self, request, **kwargs):
+        """ returns an upload session, started by the current user for the
+        file field at a given URL.
+
+        :raises: ImmediateHttpResponse if session is not found
+        """
+        session = UploadSession.load(kwargs['session_id'])
+        if session is not None:
+            info = session.info
+            expected = {
+                'owner': request.user.pk,
+                'resource': self._meta.resource_name,
+                'pk': kwargs['pk'],
+                'attr_name': kwargs['attr_name']
+            }
+            if all([info.get(k) == v for k, v in expected.items()]):
+                return session
+
+        raise ImmediateHttpResponse(response=http.HttpNotFound(
+            "Upload session %s not found" % kwargs['session_id']
+        ))
+
+    def upload_status(self, request, session, uri):
+        return self.create_response(request, {
+            'id': session.id,
+            'filename': session.info['filename'],
+            'chunks': session.chunks,
+            'size': session.size,
+            'resource_uri': uri
+        })
+
+    def process_upload_session(self, request, **kwargs):
+        """
+        Chunked upload of large files:
+
+        - POST .../<attr_name>/upload/ (optional 'filename') starts a session.
+          If a 'checksum' is given and objects of the user have the same
+          content stored already, the file is attached at once (202 instead
+          of 201)
+        - PUT .../upload/<session_id>/<n>/ with raw bytes as a body uploads
+          chunk number n (from 0). Chunks may be sent in any order, in parallel
+          and sent again if failed
+        - GET .../upload/<session_id>/ lists received chunks to resume
+        - POST .../upload/<session_id>/commit/ with a 'checksum' (SHA-256 hex
+          digest of the whole file) assembles the chunks, verifies the checksum
+          and attaches the file to the object
+        - DELETE .../upload/<session_id>/ aborts the session
+
+        :param request:     incoming http request
+        :param pk:          ID of the object that has file fields
+        :param attr_name:   name of the attribute where the file is stored
+        :param session_id:  ID of the upload session, if started
+        :return:            Http Response
+        """
+        if not 'session_id' in kwargs:
+            if not request.method == 'POST':
+                return http.HttpMethodNotAllowed("Use POST to start an upload")
+
+            attr_name = kwargs['attr_name']
+            obj = self.get_file_object(request, kwargs['pk'], attr_name)
+            if not obj.is_editable(request.user):
+                return http.HttpUnauthorized("No access to the update this "
+                                             "object")
+
+            filename = os.path.basename(request.POST.get('filename') or
+                                        attr_name)
+            checksum = request.POST.get('checksum')
+            storage = obj._meta.get_field(attr_name).storage
+            if checksum and hasattr(storage, 'link'):
+                name = storage.link(checksum, filename, lambda x:
+                                    self.is_file_owner(request.user, x))
+                if name is not None:
+                    self.attach_file(obj, attr_name, name=name)
+                    return http.HttpAccepted("File content updated "
+                                             "successfully")
+
+            UploadSession.clear_expired(settings.DATA_CONFIG['upload_expiry'])
+            session = UploadSession.create(
+                owner=request.user.pk,
+                resource=self._meta.resource_name,
+                pk=kwargs['pk'],
+                attr_name=attr_name,
+                filename=filename
+            )
+            uri = os.path.join(request.path, session.id) + '/'
+            response = self.upload_status(request, session, uri)
+            response.status_code = 201
+            response['Location'] = uri
+            return response
+
+        session = self.get_upload_session(request, **kwargs)
+
+        if request.method == 'GET':
+            return self.upload_status(request, session, request.path)
+
+        if request.method == 'DELETE':
+            session.delete()
+            return http.HttpNoContent()
+
+        return http.HttpMethodNotAllowed("Use GET or DELETE to manage an "
+                                         "upload session")
+
+    def process_upload_chunk(self, request, **kwargs):
+        """ receives a single chunk of a chunked upload as a raw request body,
+        see process_upload_session """
+        if not request.method == 'PUT':
+            return http.HttpMethodNotAllowed("Use PUT to upload a chunk")
+
+        session = self.get_upload_session(request, **kwargs)
+
+        number = int(kwargs['chunk'])
+        if number >= settings.DATA_CONFIG['max_chunks']:
+            return http.HttpBadRequest("Chunks should be numbered below %d" %
+                                       settings.DATA_CONFIG['max_chunks'])
+
+        if not request.META.get('CONTENT_LENGTH'):
+            return HttpLengthRequired("Content-Length of a chunk is required")
+
+        try:
+            length = int(request.META['CONTENT_LENGTH'])
+        except ValueError:
+            return http.HttpBadRequest("Invalid Content-Length")
+
+        if length > settings.DATA_CONFIG['max_chunk_size']:
+            return http.HttpBadRequest("Chunk should not exceed %d bytes" %
+                                       settings.DATA_CONFIG['max_chunk_size'])
+
+        if not session.lock(shared=True):
+            return http.HttpConflict("Upload session is being committed")
+
+        try:
+            session.write_chunk(number, request, length)
+        except ValueError as e:
+            return http.HttpBadRequest(str(e))
+        finally:
+            session.unlock()
+
+        return http.HttpNoContent()
+
+    def process_upload_commit(self, request, **kwargs):
+        """ assembles a chunked upload and attaches the file to the object,
+        see process_upload_session """
+        if not request.method == 'POST':
+            return http.HttpMethodNotAllowed("Use POST to commit an upload")
+
+        session = self.get_upload_session(request, **kwargs)
+
+        attr_name = kwargs['attr_name']
+        obj = self.get_file_object(request, kwargs['pk'], attr_name)
+        if not obj.is_editable(request.user):
+            return http.HttpUnauthorized("No access to the update this object")
+
+        checksum = request.POST.get('checksum') or request.GET.get('checksum')
+        if not checksum:
+            return http.HttpBadRequest("SHA-256 checksum of the file is "
+                                       "required")
+        if not session.lock():
+            return http.HttpConflict("Upload session is being committed")
+
+        try:
+            content = session.assemble(checksum, session.info['filename'])
+        except ValueError as e:
+            session.unlock()
+            return http.HttpBadRequest(str(e))
+
+        try:
+            self.attach_file(obj, attr_name, content)
+        except Exception:
+            session.unlock()
+            raise
+        finally:
+            content.close()
+
+        session.delete()
         return http.HttpAccepted("File content updated successfully")
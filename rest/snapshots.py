@@ -0,0 +1,76 @@
+from datetime import timedelta
+
+from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from tastypie import http
+from tastypie.cache import NoCache
+from tastypie.exceptions import ImmediateHttpResponse
+from state_machine.models import Snapshot
+from gndata_api import settings
+
+#===============================================================================
+# Reads through named snapshots: '?snapshot=<name>' on any endpoint of a
+# versioned resource reads objects at the time pinned by a snapshot of the
+# current user. Snapshots never change, so once no transaction may still add
+# versions before their time (see VERSIONS_CONFIG 'settle_time'), details of
+# objects may be cached forever, privately per session.
+#
+# Access control (shares) is not versioned and is applied as it is now. A list
+# read through a snapshot changes when objects are shared or unshared, so lists
+# are never cached. A user who loses access to an object may still read a
+# detail of it from their own cache.
+#===============================================================================
+
+# max-age of cacheable responses, one year as by RFC 2616
+MAX_AGE = 365 * 24 * 3600
+
+
+def get_snapshot(request):
+    """ snapshot given in the 'snapshot' parameter of a request or None
+
+    :raises: ImmediateHttpResponse if the snapshot is not found or the
+             request is not a read
+    """
+    name = request and request.GET.get('snapshot')
+    if not name:
+        return None
+
+    if hasattr(request, '_snapshot'):
+        return request._snapshot
+
+    if request.method != 'GET':
+        raise ImmediateHttpResponse(response=http.HttpBadRequest(
+            "Objects can not be changed in a snapshot"
+        ))
+
+    try:
+        snapshot = Snapshot.objects.get(owner=request.user.id, name=name)
+    except Snapshot.DoesNotExist:
+        raise ImmediateHttpResponse(response=http.HttpNotFound(
+            "Snapshot %s not found" % name
+        ))
+
+    request._snapshot = snapshot
+    return snapshot
+
+
+def patch_snapshot_headers(response, snapshot):
+    """ makes a response read through a snapshot cacheable forever, if the
+    time of the snapshot is old enough """
+    settle_time = timedelta(seconds=settings.VERSIONS_CONFIG['settle_time'])
+    if snapshot.at_time > timezone.now() - settle_time:
+        return
+
+    patch_cache_control(response, private=True, max_age=MAX_AGE,
+                        immutable=True)
+    patch_vary_headers(response, ['Cookie'])
+
+
+class SnapshotCache(NoCache):
+    """ disables caching of responses, except for those having their own
+    cache headers already (details read through snapshots) """
+
+    def cacheable(self, request, response):
+        if response.has_header('Cache-Control'):
+            return False
+        return super(SnapshotCache, self).cacheable(request, response)
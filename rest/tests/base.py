@@ -113,6 +113,33 @@ class TestApi(ResourceTestCase):
                 count = self.get_available_objs(resource, user).count()
                 validate_obj_count(count)
 
+    def test_list_cursor(self):
+        self.login(self.bob)
+
+        for resource in self.resources:
+            name = resource.Meta.resource_name
+            base = "/%s/%s/%s/" % (
+                self.url_prefix, resource.Meta.api_name, name
+            )
+            url = base + "?cursor=&limit=2"
+
+            listed = []
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200, response.content)
+                data = json.loads(response.content)
+                listed += [x['id'] for x in data[resource.Meta.collection_name]]
+                url = data['meta']['next']
+
+            expected = self.get_available_objs(resource, self.bob)
+            self.assertEqual(sorted(listed),
+                             sorted([x.local_id for x in expected]))
+
+            response = self.client.get(base + '?cursor=x')
+            self.assertEqual(response.status_code, 400)
+
+        self.logout()
+
     def test_get(self):
         # TODO also test back in time
         for resource in self.resources:
@@ -163,6 +190,53 @@ class TestApi(ResourceTestCase):
                 except ValueError:
                     self.assertEqual(response.status_code, 204)
 
+    def test_get_data_range(self):
+        self.login(self.bob)
+
+        for resource in self.resources:
+            if not isinstance(resource, BaseFileResourceMixin):
+                continue
+
+            res_name = resource.Meta.resource_name
+            api_name = resource.Meta.api_name
+            obj = self.get_available_objs(resource, self.bob)[0]
+
+            for name, field in resource.file_fields.items():
+                try:
+                    filepath = getattr(obj, name).path
+                except ValueError:
+                    continue  # no file to test ranges on
+
+                url = "/%s/%s/%s/%s/%s/" % (
+                    self.url_prefix, api_name, res_name, obj.local_id, name
+                )
+                with open(filepath, 'rb') as f:
+                    original = f.read()
+
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Accept-Ranges'], 'bytes')
+                self.assertEqual(''.join(response.streaming_content), original)
+
+                response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(''.join(response.streaming_content),
+                                 original[10:20])
+
+                response = self.client.get(url, HTTP_RANGE='bytes=-5')
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(''.join(response.streaming_content),
+                                 original[-5:])
+
+                # outdated validator - the whole file is sent
+                response = self.client.get(url, HTTP_RANGE='bytes=10-19',
+                                           HTTP_IF_RANGE='"outdated"')
+                self.assertEqual(response.status_code, 200)
+
+                range_header = 'bytes=%d-' % len(original)
+                response = self.client.get(url, HTTP_RANGE=range_header)
+                self.assertEqual(response.status_code, 416)
+
     def test_create(self):
         self.login(self.bob)
 
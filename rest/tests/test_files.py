@@ -0,0 +1,23 @@
+from django.test import SimpleTestCase
+
+from rest.files import parse_range
+
+
+class TestParseRange(SimpleTestCase):
+    """
+    Tests parsing of HTTP 'Range' headers.
+    """
+
+    def test_ranges(self):
+        self.assertEqual(parse_range(None, 100), None)
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-500', 100), (0, 99))
+        self.assertEqual(parse_range('bytes=50-500', 100), (50, 99))
+
+    def test_not_satisfiable(self):
+        self.assertRaises(ValueError, parse_range, 'bytes=100-', 100)
+        self.assertRaises(ValueError, parse_range, 'bytes=-0', 100)
+        self.assertRaises(ValueError, parse_range, 'bytes=-10', 0)
+        self.assertRaises(ValueError, parse_range, 'bytes=0-', 0)
@@ -6,6 +6,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 
 from rest._service import BaseService
+from rest.pagination import encode_cursor
 from rest.tests.fake import *
 from rest.tests.assets import Assets
 
@@ -37,6 +38,20 @@ class TestService(TestCase):
     def test_offset(self):
         self.assertEqual(len(self.srv1.list(self.bob, offset=2)), 1)
 
+    def test_cursor(self):
+        first = self.srv1.list(self.bob, max_results=2, cursor='')
+        self.assertEqual(len(first), 2)
+
+        cursor = encode_cursor(first[1])
+        rest = self.srv1.list(self.bob, max_results=2, cursor=cursor)
+        self.assertEqual(len(rest), 1)
+
+        listed = [x.pk for x in first] + [x.pk for x in rest]
+        self.assertEqual(sorted(listed),
+                         sorted([x.pk for x in self.srv1.list(self.bob)]))
+
+        self.assertRaises(ValueError, self.srv1.list, self.bob, cursor='x')
+
     def test_filters(self):
         filters = [('test_attr', '2')]
         selected = self.srv1.list(self.bob, filters=filters)
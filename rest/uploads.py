@@ -0,0 +1,219 @@
+import os
+import re
+import errno
+import fcntl
+import time
+import uuid
+import shutil
+import hashlib
+import simplejson as json
+
+from django.core.files import File
+from gndata_api import settings
+from rest.files import CHUNK_SIZE
+
+# upload sessions are kept on the same volume as the uploaded files, so that an
+# assembled file is moved into the storage instead of being copied
+UPLOADS_ROOT = os.path.join(settings.FILE_MEDIA_ROOT, 'uploads')
+
+session_regex = re.compile(r'^[0-9a-f]{32}$')
+
+
+class AssembledFile(File):
+    """ file assembled from uploaded chunks. FileSystemStorage moves files that
+    provide 'temporary_file_path' in place instead of copying them. The SHA-256
+    digest, computed while assembling, is kept for content-addressed storage.
+    """
+
+    def __init__(self, file, name=None, sha256=None):
+        super(AssembledFile, self).__init__(file, name)
+        self.size = os.path.getsize(file.name)  # known after the file is moved
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class UploadSession(object):
+    """
+    Upload of a large file in numbered chunks. Chunks may be sent in any order
+    and in parallel; a failed chunk is simply sent again. Every session is a
+    directory with a manifest and a file per received chunk. On commit the
+    chunks are assembled and verified against a SHA-256 checksum of the whole
+    file. A session is locked exclusively while it is committed, so that only
+    one commit proceeds and chunks are not changed meanwhile.
+    """
+    manifest_name = 'session.json'
+    assembled_name = 'assembled'
+    lock_name = 'commit.lock'
+
+    def __init__(self, session_id, root=UPLOADS_ROOT):
+        if not session_regex.match(session_id):
+            raise ValueError("Invalid upload session ID %s" % session_id)
+
+        self.id = session_id
+        self.path = os.path.join(root, session_id)
+        self._info = None
+        self._lock_file = None
+
+    @classmethod
+    def create(cls, root=UPLOADS_ROOT, **info):
+        """ starts a new session. Info (owner, object, file name etc.) is
+        stored in the manifest of the session. """
+        session = cls(uuid.uuid4().hex, root)
+        os.makedirs(session.path)
+
+        info['created'] = time.time()
+        with open(os.path.join(session.path, cls.manifest_name), 'w') as f:
+            json.dump(info, f)
+        return session
+
+    @classmethod
+    def load(cls, session_id, root=UPLOADS_ROOT):
+        """ returns an existing session or None """
+        try:
+            session = cls(session_id, root)
+        except ValueError:
+            return None
+        return session if os.path.isdir(session.path) else None
+
+    @classmethod
+    def clear_expired(cls, max_age, root=UPLOADS_ROOT):
+        """ removes sessions that were started more than 'max_age' seconds
+        ago and were not committed """
+        if not os.path.isdir(root):
+            return
+
+        for name in os.listdir(root):
+            session = cls.load(name, root)
+            if session is not None and session.age > max_age:
+                session.delete()
+
+    @property
+    def info(self):
+        if self._info is None:
+            with open(os.path.join(self.path, self.manifest_name)) as f:
+                self._info = json.load(f)
+        return self._info
+
+    @property
+    def age(self):
+        try:
+            return time.time() - self.info['created']
+        except (IOError, ValueError, KeyError):  # broken or removed session
+            return float('inf')
+
+    def chunk_path(self, number):
+        return os.path.join(self.path, '%d.part' % number)
+
+    @property
+    def chunks(self):
+        """ sorted numbers of all received chunks """
+        names = [x for x in os.listdir(self.path) if x.endswith('.part')]
+        return sorted([int(x.split('.')[0]) for x in names])
+
+    @property
+    def size(self):
+        """ total size of received chunks, bytes """
+        return sum([os.path.getsize(self.chunk_path(x)) for x in self.chunks])
+
+    def write_chunk(self, number, stream, length, chunk_size=CHUNK_SIZE):
+        """ writes a chunk of 'length' bytes from a given stream (like an
+        incoming request) in bounded memory. The chunk is written to a temporary
+        file first and moved in place when complete, so a chunk sent again
+        replaces the previous one and partial chunks are never assembled.
+
+        :raises: ValueError if the stream ends before 'length' bytes are read
+        """
+        temp = '%s.%s' % (self.chunk_path(number), uuid.uuid4().hex)
+        remaining = length
+        try:
+            with open(temp, 'wb') as f:
+                while remaining > 0:
+                    data = stream.read(min(chunk_size, remaining))
+                    if not data:
+                        raise ValueError("Chunk %d is incomplete: %d bytes "
+                                         "missing" % (number, remaining))
+                    f.write(data)
+                    remaining -= len(data)
+
+            os.rename(temp, self.chunk_path(number))
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def lock(self, shared=False):
+        """ locks the session without waiting: exclusively for a commit, or
+        shared for writing a chunk, so that chunks are written in parallel but
+        never while the session is committed. The lock is held by an open lock
+        file, so it is released by unlock() or when the process ends.
+
+        :return: True if locked by this call, False if locked by others
+        """
+        path = os.path.join(self.path, self.lock_name)
+        try:
+            lock_file = open(path, 'a')
+        except IOError as e:
+            if e.errno == errno.ENOENT:  # session removed meanwhile
+                return False
+            raise
+
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+        except IOError as e:
+            lock_file.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+
+        self._lock_file = lock_file
+        return True
+
+    def unlock(self):
+        """ releases the lock taken by this session object """
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def assemble(self, checksum, name, chunk_size=CHUNK_SIZE):
+        """
+        Concatenates all chunks into one file, computing its SHA-256 checksum
+        on the way. Chunks are numbered from 0 and should not have gaps.
+
+        :param checksum:    expected SHA-256 hex digest of the whole file
+        :param name:        file name to give to the assembled file
+        :return:            AssembledFile
+        :raises:            ValueError if chunks are missing or the checksum
+                            does not match
+        """
+        chunks = self.chunks
+        if not chunks:
+            raise ValueError("No chunks uploaded")
+
+        # gaps between consecutive numbers, as (first, last) missing chunks
+        gaps = [(x + 1, y - 1) for x, y in zip([-1] + chunks, chunks)
+                if y - x > 1]
+        if gaps:
+            raise ValueError("Missing chunks: %s" % ", ".join(
+                [str(x) if x == y else "%d-%d" % (x, y) for x, y in gaps]
+            ))
+
+        target = os.path.join(self.path, self.assembled_name)
+        digest = hashlib.sha256()
+        with open(target, 'wb') as dst:
+            for number in chunks:
+                with open(self.chunk_path(number), 'rb') as src:
+                    for data in iter(lambda: src.read(chunk_size), ''):
+                        digest.update(data)
+                        dst.write(data)
+
+        if digest.hexdigest() != checksum.lower():
+            os.remove(target)
+            raise ValueError("Checksum does not match: got %s" %
+                             digest.hexdigest())
+
+        return AssembledFile(open(target, 'rb'), name, digest.hexdigest())
+
+    def delete(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,40 @@
+from tastypie import fields
+from tastypie.resources import ModelResource, ALL
+from account.api import UserResource
+from permissions.authorization import BaseAuthorization
+from permissions.authorization import SessionAuthenticationNoSCRF
+from state_machine.models import Snapshot
+
+
+class SnapshotResource(ModelResource):
+    """ named snapshots of the current user. Snapshots can be created and read
+    only, as responses read through them may be cached forever """
+    owner = fields.ForeignKey(UserResource, 'owner', readonly=True)
+
+    class Meta:
+        queryset = Snapshot.objects.all()
+        resource_name = 'snapshot'
+        detail_uri_name = 'name'
+        collection_name = 'selected'
+        list_allowed_methods = ['get', 'post']
+        detail_allowed_methods = ['get']
+        always_return_data = True
+        authentication = SessionAuthenticationNoSCRF()
+        authorization = BaseAuthorization()
+        filtering = {
+            'name': ALL,
+            'at_time': ALL
+        }
+
+    def get_object_list(self, request):
+        """ snapshots of the current user only, as names are unique per
+        owner """
+        return super(SnapshotResource, self).get_object_list(request).filter(
+            owner=request.user
+        )
+
+    def obj_create(self, bundle, **kwargs):
+        """ always set owner of a snapshot to the request.user """
+        return super(SnapshotResource, self).obj_create(
+            bundle, owner=bundle.request.user
+        )
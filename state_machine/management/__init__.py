@@ -0,0 +1,33 @@
+from django.db.models import get_models
+from django.db.models.signals import post_syncdb
+from state_machine.versioning.temporal import is_temporal, create_history
+from state_machine.versioning.registry import versioned_tables
+from state_machine.versioning.indexes import create_indexes
+from state_machine.versioning.ids import create_sequence
+
+
+def create_history_tables(sender, app, db='default', **kwargs):
+    """ creates history tables for versioned models in temporal mode """
+    for model in get_models(app):
+        if is_temporal(model) and model._meta.managed and \
+                not model._meta.proxy:
+            create_history(model, db)
+
+post_syncdb.connect(create_history_tables)
+
+
+def create_version_indexes(sender, app, db='default', **kwargs):
+    """ creates indexes for versioned access patterns, see indexes """
+    for model in get_models(app):
+        if versioned_tables.get(model._meta.db_table) is model and \
+                model._meta.managed and not model._meta.proxy:
+            create_indexes(model, db)
+
+post_syncdb.connect(create_version_indexes)
+
+
+def create_local_id_sequence(sender, app, db='default', **kwargs):
+    """ creates the sequence of blocks of local IDs, see ids """
+    create_sequence(db)
+
+post_syncdb.connect(create_local_id_sequence)
@@ -0,0 +1,76 @@
+import timeit
+
+from optparse import make_option
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test.client import RequestFactory
+from django.utils import timezone
+from state_machine.versioning.managers import VersionManager
+from ephys.models import Event, Segment
+from ephys.api import EventResource
+
+
+def legacy_getattribute(self, name):
+    """ attribute access of versioned objects as it was before related
+    managers took the time of their object: every attribute was checked for
+    a manager to be given the time. Kept for comparison only. """
+    attr = object.__getattribute__(self, name)
+    if isinstance(attr, VersionManager) and self._at_time:
+        attr._at_time = self._at_time
+    return attr
+
+
+class Command(BaseCommand):
+    help = "Measures reading all fields of versioned objects (Events) and " \
+           "dehydrating them with the API resource, with and without the " \
+           "former hook on attribute access of versioned objects. No " \
+           "queries are sent to the database."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--number', type='int', default=100000,
+                    help='Number of objects to dehydrate'),
+    )
+
+    def handle(self, *args, **options):
+        number = options['number']
+        now = timezone.now()
+
+        owner = User(pk=1, username='bob')
+        segment = Segment(local_id='SEGMENT01', owner=owner)
+        objects = [
+            Event(local_id='%09d' % i, guid='%032x' % i, date_created=now,
+                  starts_at=now, owner=owner, segment=segment, label='event',
+                  time=float(i), time__unit='ms')
+            for i in xrange(number)
+        ]
+
+        resource = EventResource()
+        request = RequestFactory().get('/api/v1/ephys/event/')
+        names = [f.attname for f in Event._meta.fields]
+
+        def read_fields():
+            for obj in objects:
+                for name in names:
+                    getattr(obj, name)
+
+        def dehydrate():
+            for obj in objects:
+                bundle = resource.build_bundle(obj=obj, request=request)
+                resource.full_dehydrate(bundle)
+
+        for case, run in [('reads', read_fields), ('dehydrate', dehydrate)]:
+            results = {}
+            try:
+                Event.__getattribute__ = legacy_getattribute
+                results['before'] = min(timeit.repeat(run, repeat=3, number=1))
+            finally:
+                del Event.__getattribute__
+            results['after'] = min(timeit.repeat(run, repeat=3, number=1))
+
+            self.stdout.write("%-10s before: %7.2f s (%6.1f us/object), "
+                              "after: %7.2f s (%6.1f us/object), %.2fx" % (
+                                  case, results['before'],
+                                  results['before'] / number * 1e6,
+                                  results['after'],
+                                  results['after'] / number * 1e6,
+                                  results['before'] / results['after']))
@@ -0,0 +1,43 @@
+import timeit
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from gndata_api.utils import get_new_local_id
+from state_machine.versioning.ids import LocalIdAllocator, BLOCK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Measures throughput of allocating local IDs for bulk creation: " \
+           "random IDs as before and IDs from blocks reserved in the " \
+           "database. Reserves (and leaves unused) blocks of IDs."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--number', type='int', default=100000,
+                    help='Number of IDs to allocate at once'),
+        make_option('--block-size', type='int', default=BLOCK_SIZE,
+                    help='Number of IDs in a reserved block'),
+        make_option('--database', default=DEFAULT_DB_ALIAS,
+                    help='Database to reserve blocks in'),
+    )
+
+    def handle(self, *args, **options):
+        number = options['number']
+
+        def random_ids():
+            return [get_new_local_id() for i in xrange(number)]
+
+        def allocated_ids():
+            # a new allocator has no reserved blocks, as a new process
+            allocator = LocalIdAllocator(options['block_size'])
+            return allocator.allocate(number, options['database'])
+
+        ids = allocated_ids()
+        assert len(set(ids)) == number
+
+        for name, allocate in [('random', random_ids),
+                               ('blocks', allocated_ids)]:
+            total = min(timeit.repeat(allocate, repeat=3, number=1))
+            self.stdout.write("%-8s %10.0f IDs/s, %.2f us/ID" % (
+                name, number / total, total / number * 1e6
+            ))
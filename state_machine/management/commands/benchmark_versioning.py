@@ -0,0 +1,106 @@
+import timeit
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import sql, Q
+from django.utils import timezone
+from state_machine.versioning.registry import versioned_tables
+
+
+def legacy_inject_time(qs):
+    """ injection of version time filters as it was done before the registry of
+    versioned tables: introspection of installed models and walking MRO of
+    every model on every query. Kept for comparison only. """
+    def update_constraint(node, table):
+        if hasattr(node, 'children') and node.children:
+            for child in node.children:
+                update_constraint(child, table)
+        else:
+            node[0].alias = table
+
+    high_mark, low_mark = qs.query.high_mark, qs.query.low_mark
+    qs.query.clear_limits()
+
+    qry = qs.query.__class__(model=qs.model)
+    if qs._at_time:
+        qry.add_q(Q(starts_at__lte=qs._at_time))
+        qry.add_q(Q(ends_at__gt=qs._at_time) | Q(ends_at__isnull=True))
+    else:
+        qry.add_q(Q(ends_at__isnull=True))
+
+    cp = qs.query.get_compiler(using=qs.db)
+    cp.pre_sql_setup()
+    tables = [table for table, rc in cp.query.alias_refcount.items() if rc]
+
+    vmodel_map = {}
+    for model in connection.introspection.installed_models(tables):
+        vmodel_map[model._meta.db_table] = model
+
+    for table in tables:
+        real_name = table
+        for mod_name, aliases in qs.query.table_map.items():
+            if table in aliases:
+                real_name = mod_name
+
+        if vmodel_map.has_key(real_name):
+            superclasses = vmodel_map[real_name].mro()
+            cls_names = [x.__name__ for x in superclasses]
+            if not ('BaseGnodeObject' in cls_names or 'VersionedM2M' in cls_names):
+                continue
+
+        cloned_node = qry.where.__deepcopy__(memodict=None)
+        update_constraint(cloned_node, table)
+        qs.query.where.add(cloned_node, sql.where.AND)
+
+    qs.query.set_limits(low=low_mark, high=high_mark)
+    qs._time_injected = True
+
+
+class Command(BaseCommand):
+    help = "Measures the overhead of injecting version time filters into " \
+           "queries of all versioned models, with and without joins. No " \
+           "queries are sent to the database."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--number', type='int', default=2000,
+                    help='Number of queries to prepare for every model'),
+    )
+
+    def handle(self, *args, **options):
+        number = options['number']
+        at_time = timezone.now()
+
+        cases = [
+            ('current', lambda m: m.objects.all()),
+            ('at_time', lambda m: m.objects.filter(at_time=at_time)),
+            ('joins', lambda m: m.objects.select_related()),
+        ]
+        methods = [
+            ('before', legacy_inject_time),
+            ('after', lambda qs: qs.inject_time()),
+        ]
+
+        models = sorted(versioned_tables.values(), key=lambda m: m.__name__)
+        for case, make_qs in cases:
+            querysets = [make_qs(model) for model in models]
+            results = {}
+
+            for name, inject in methods:
+                def run():
+                    for qs in querysets:
+                        inject(qs._clone())
+
+                # cloning is part of both, measured to be subtracted
+                base = min(timeit.repeat(
+                    lambda: [qs._clone() for qs in querysets],
+                    repeat=3, number=number
+                ))
+                total = min(timeit.repeat(run, repeat=3, number=number))
+                results[name] = (total - base) / (number * len(querysets))
+
+            self.stdout.write("%-8s before: %7.1f us/query, after: %7.1f "
+                              "us/query, %.1fx" % (
+                                  case, results['before'] * 1e6,
+                                  results['after'] * 1e6,
+                                  results['before'] / results['after']))
@@ -0,0 +1,34 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import get_models
+from state_machine.versioning.registry import versioned_tables
+from state_machine.versioning.indexes import index_statements, create_indexes
+
+
+class Command(BaseCommand):
+    help = "Creates indexes for versioned access patterns (current versions, " \
+           "versions at time) on tables of all versioned models, if missing. " \
+           "Indexes are also created by syncdb for new tables."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default=DEFAULT_DB_ALIAS,
+                    help='Database to create indexes in'),
+        make_option('--sql', action='store_true', default=False,
+                    help='Only print SQL statements'),
+    )
+
+    def handle(self, *args, **options):
+        using = options['database']
+
+        for model in get_models():
+            if versioned_tables.get(model._meta.db_table) is not model:
+                continue
+
+            if options['sql']:
+                statements = index_statements(model, using)
+            else:
+                statements = create_indexes(model, using)
+
+            for statement in statements:
+                self.stdout.write(statement + ";")
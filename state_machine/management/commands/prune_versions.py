@@ -0,0 +1,30 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import get_models
+from state_machine.versioning.registry import versioned_tables
+from state_machine.versioning.retention import prune
+
+
+class Command(BaseCommand):
+    help = "Removes closed versions older than the retention window of " \
+           "versioned models which have a 'retention' policy. Meant to run " \
+           "periodically, like from cron."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default=DEFAULT_DB_ALIAS,
+                    help='Database to prune versions in'),
+    )
+
+    def handle(self, *args, **options):
+        using = options['database']
+
+        for model in get_models():
+            if versioned_tables.get(model._meta.db_table) is not model or \
+                    not getattr(model, 'retention', None):
+                continue
+
+            removed = prune(model, using=using)
+            self.stdout.write("%s: %d versions removed" % (
+                model._meta.object_name, removed
+            ))
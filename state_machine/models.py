@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from state_machine.versioning.models import BaseVersionedObject
 
@@ -23,4 +24,28 @@ class BaseGnodeObject(BaseVersionedObject):
 
     @classmethod
     def security_filter(cls, queryset, user, update=False):
-        return queryset.filter(owner=user.id)
\ No newline at end of file
+        return queryset.filter(owner=user.id)
+
+
+class Snapshot(models.Model):
+    """
+    A named point in time, pinned by a user to read versioned objects as they
+    were at this time over many requests ('snapshot' parameter of the API).
+    Snapshots are never changed, so reads through them are never outdated.
+    """
+    name = models.SlugField(max_length=100)
+    owner = models.ForeignKey(User, editable=False)
+    at_time = models.DateTimeField(default=timezone.now)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('owner', 'name'),)
+
+    def __unicode__(self):
+        return self.name
+
+    def is_accessible(self, user):
+        return self.owner == user
+
+    def is_editable(self, user):
+        return False
@@ -19,7 +19,8 @@ class Assets(BaseAssets):
 
     """
     def __init__(self):
-        self.models = [FakeModel, FakeParentModel, FakeChildModel, parent_fake]
+        self.models = [FakeModel, FakeParentModel, FakeChildModel, parent_fake,
+                       FakeTemporalModel]
 
     @classmethod
     def fm(cls, i, at_time=None):
@@ -53,4 +54,8 @@ class Assets(BaseAssets):
 
         FakeChildModel.objects.create(test_attr=1, test_ref=fp1, owner=owner)
         FakeChildModel.objects.create(test_attr=2, test_ref=fp1, owner=owner)
-        FakeChildModel.objects.create(test_attr=3, test_ref=fp2, owner=owner)
\ No newline at end of file
+        FakeChildModel.objects.create(test_attr=3, test_ref=fp2, owner=owner)
+
+        for i in range(1, 4):
+            FakeTemporalModel.objects.create(test_attr=i, test_ref=fp1,
+                                             owner=owner)
\ No newline at end of file
@@ -33,6 +33,16 @@ class FakeChildModel(BaseGnodeObject):
     )
 
 
+class FakeTemporalModel(BaseGnodeObject):
+    """ versioned model keeping closed versions in a history table """
+    test_attr = models.IntegerField()
+    test_ref = VersionedForeignKey(
+        FakeParentModel, blank=True, null=True, on_delete=models.SET_NULL
+    )
+
+    temporal = True
+
+
 class parent_fake(VersionedM2M):
     """ M2M relationship class """
     parent = VersionedForeignKey(FakeParentModel)
@@ -1,11 +1,27 @@
+import os
+import re
 import time
+from datetime import timedelta
 
 from django.utils import timezone
 from django.test import TestCase
+from django.db import connection, connections
+from django.db.models import signals
 from django.contrib.auth.models import User
 
 from state_machine.tests.fake import *
+from state_machine.versioning.registry import versioned_tables
+from state_machine.versioning.deletion import VersionedCollector
+from state_machine.versioning.temporal import history_table
+from state_machine.versioning.temporal import create_history, drop_history
+from state_machine.versioning.cache import invalidate
+from state_machine.versioning.retention import prune
+from state_machine.versioning.ids import LocalIdAllocator
+from state_machine.versioning.indexes import index_name
 from state_machine.tests.assets import Assets
+from state_machine.models import Snapshot
+from metadata.models import Section, Document
+from gndata_api import settings
 
 
 class TestVersionedQuerySet(TestCase):
@@ -57,6 +73,41 @@ class TestVersionedQuerySet(TestCase):
 
         self.qs.bulk_create(objects)
         self.assertEqual(self.qs.count(), count + 3)
+        self.assertEqual(len(set([obj.pk for obj in objects])), 3)
+
+    def test_bulk_update(self):
+        before = dict([(x.pk, x) for x in self.qs.all()])
+
+        updated = self.qs.filter(test_attr__gte=2).update(test_attr=100)
+        self.assertEqual(updated, 2)
+        self.assertEqual(self.qs.count(), len(before))
+
+        for obj in self.qs.filter(test_attr=100):
+            old = before[obj.pk]
+            self.assertNotEqual(obj.guid, old.guid)
+            self.assertEqual(obj.date_created, old.date_created)
+            self.assertTrue(obj.starts_at > old.starts_at)
+
+            at_time = self.qs.filter(at_time=old.starts_at).get(pk=obj.pk)
+            self.assertEqual(at_time.test_attr, old.test_attr)
+
+        self.assertEqual(self.qs.filter(test_attr=1).count(), 1)
+        self.assertEqual(self.qs.filter(test_attr=100).update(), 0)
+
+    def test_in_bulk(self):
+        objs = list(self.qs.all())
+        obj = objs[0]
+        at_time = timezone.now()
+        self.qs.filter(pk=obj.pk).update(test_attr=271828)
+
+        with self.assertNumQueries(1):
+            bulk = self.qs.in_bulk([x.pk for x in objs] + ['UNKNOWN'])
+        self.assertEqual(sorted(bulk.keys()), sorted([x.pk for x in objs]))
+        self.assertEqual(bulk[obj.pk].test_attr, 271828)
+
+        bulk = self.qs.in_bulk([obj.pk], at_time=at_time)
+        self.assertEqual(bulk[obj.pk].test_attr, obj.test_attr)
+        self.assertEqual(self.qs.in_bulk([]), {})
 
     def test_exists(self):
         self.qs.all().delete()
@@ -87,6 +138,21 @@ class TestVersionedQuerySet(TestCase):
         self.assertEqual(filtered.count(), 1)
         self.assertEqual(filtered[0].test_attr, 271828)
 
+    def test_time_filters(self):
+        self.assertTrue(versioned_tables[FakeModel._meta.db_table] is FakeModel)
+        self.assertTrue(parent_fake._meta.db_table in versioned_tables)
+        self.assertFalse(User._meta.db_table in versioned_tables)
+
+        qs = FakeChildModel.objects.filter(test_ref__test_attr=1)
+        qs = qs.select_related('owner').order_by('test_ref__test_attr')
+        qs.inject_time()
+        query = str(qs.query)
+
+        for model in [FakeChildModel, FakeParentModel]:
+            self.assertTrue('"%s"."ends_at" IS NULL' % model._meta.db_table
+                            in query, query)
+        self.assertFalse('"auth_user"."ends_at"' in query)
+
     def tearDown(self):
         self.assets.flush()
 
@@ -189,6 +255,30 @@ class TestObjectRelations(TestCase):
         self.assert_fm1_not_changed(self.assets.fm(1, self.origin))
         self.assert_fc1_not_changed(self.assets.fc(1, self.origin))
 
+    def test_all_parent_delete_cascade(self):
+        collector = VersionedCollector(using='default')
+        self.assertTrue(collector.can_cascade(FakeParentModel))
+
+        FakeParentModel.objects.filter(test_attr=1).delete()
+        self.assertEqual(FakeChildModel.objects.count(), 3)
+        self.assertEqual(parent_fake.objects.count(), 1)
+        self.assertEqual(FakeTemporalModel.objects.filter(
+            test_ref__isnull=True).count(), 3)
+
+        # receivers of delete signals get objects collected as before
+        deleted = []
+        receiver = lambda sender, **kwargs: deleted.append(kwargs['instance'])
+        signals.pre_delete.connect(receiver, sender=parent_fake)
+        try:
+            self.assertFalse(collector.can_cascade(FakeParentModel))
+            FakeParentModel.objects.filter(test_attr=2).delete()
+        finally:
+            signals.pre_delete.disconnect(receiver, sender=parent_fake)
+
+        self.assertEqual(len(deleted), 1)
+        self.assertFalse(parent_fake.objects.exists())
+        self.assertTrue(self.assets.fc(3).test_ref is None)
+
     def test_all_parent_remove(self):
         fp1 = self.assets.fp(1)
         fp1.m2m.through.objects.filter(parent=fp1, fake=self.assets.fm(1)).delete()
@@ -213,6 +303,45 @@ class TestObjectRelations(TestCase):
         self.assert_fp1_not_changed(self.assets.fp(1, self.origin))
         self.assert_fm3_not_changed(self.assets.fm(3, self.origin))
 
+    def test_prefetch_at_time(self):
+        FakeParentModel.objects.filter(test_attr=1).update(test_attr=10)
+        FakeModel.objects.filter(test_attr=1).update(test_attr=100)
+        FakeChildModel.objects.filter(test_attr=2).delete()
+
+        with self.assertNumQueries(3):
+            parents = FakeParentModel.objects.filter(at_time=self.origin)
+            parents = parents.prefetch_related('fakechildmodel_set', 'm2m')
+            fp1, fp2 = parents.order_by('test_attr')
+            self.assertEqual(fp1.test_attr, 1)
+            self.assert_fp1_not_changed(fp1)
+            self.assertEqual(sorted([x.test_attr for x in fp1.m2m.all()]),
+                             [1, 2])
+            self.assert_fp2_not_changed(fp2)
+
+        # one query per level
+        with self.assertNumQueries(3):
+            children = FakeChildModel.objects.filter(at_time=self.origin)
+            children = children.prefetch_related('test_ref__m2m')
+            self.assertEqual(len(children), 3)
+            for child in children:
+                self.assertTrue(child.test_ref.test_attr in [1, 2])
+                for fm in child.test_ref.m2m.all():
+                    self.assertTrue(fm.test_attr in [1, 2])
+
+    def test_select_related_at_time(self):
+        FakeChildModel.objects.create(test_attr=4, owner=self.owner)
+        at_time = timezone.now()
+        time.sleep(1)
+        FakeParentModel.objects.filter(test_attr=1).update(test_attr=10)
+
+        with self.assertNumQueries(1):
+            children = FakeChildModel.objects.filter(at_time=at_time)
+            children = children.select_related('test_ref').order_by(
+                'test_attr'
+            )
+            refs = [x.test_ref and x.test_ref.test_attr for x in children]
+        self.assertEqual(refs, [1, 1, 2, None])
+
     def test_fk_child_delete(self):
         FakeChildModel.objects.filter(test_attr=1).delete()
         self.assertTrue(self.assets.fp(1).fakechildmodel_set.all().count(), 1)
@@ -293,3 +422,301 @@ class TestVersionedObject(TestCase):
 
     def tearDown(self):
         self.assets.flush()
+
+
+class TestTemporalTables(TestCase):
+    """
+    Tests versioned models keeping closed versions in a history table.
+    """
+    fixtures = ["users.json"]
+
+    def setUp(self):
+        self.assets = Assets()
+        self.assets.fill()
+        self.qs = FakeTemporalModel.objects
+        self.origin = timezone.now()
+        time.sleep(1)  # needed to test versioned objects
+
+    def count_rows(self, table):
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM %s" % table)
+        return cursor.fetchone()[0]
+
+    def test_update(self):
+        obj = self.qs.get(test_attr=1)
+        self.qs.filter(pk=obj.pk).update(test_attr=271828)
+
+        table = FakeTemporalModel._meta.db_table
+        self.assertEqual(self.count_rows(table), 3)
+        self.assertEqual(self.count_rows(history_table(FakeTemporalModel)), 1)
+
+        self.assertEqual(self.qs.get(pk=obj.pk).test_attr, 271828)
+        old_obj = self.qs.filter(at_time=self.origin).get(pk=obj.pk)
+        self.assertEqual(old_obj.test_attr, 1)
+        self.assertEqual(self.qs.filter(at_time=self.origin).count(), 3)
+
+    def test_delete(self):
+        obj = self.qs.get(test_attr=1)
+        obj.delete()
+
+        self.assertFalse(self.qs.filter(pk=obj.pk).exists())
+        self.assertEqual(self.qs.count(), 2)
+        self.assertEqual(self.count_rows(history_table(FakeTemporalModel)), 1)
+
+        old_obj = self.qs.filter(at_time=self.origin).get(pk=obj.pk)
+        self.assertEqual(old_obj.test_attr, 1)
+
+    def test_create_history(self):
+        # versions closed before the model was temporal are moved
+        model = FakeTemporalModel
+        model.temporal = False
+        try:
+            self.qs.filter(test_attr=1).update(test_attr=271828)
+        finally:
+            model.temporal = True
+        drop_history(model)
+
+        create_history(model)
+        self.assertEqual(self.count_rows(model._meta.db_table), 3)
+        self.assertEqual(self.count_rows(history_table(model)), 1)
+        old_obj = self.qs.filter(at_time=self.origin).get(test_attr=1)
+        self.assertEqual(old_obj.test_ref_id, self.qs.get(
+            test_attr=271828).test_ref_id)
+
+        # columns added to the model are added to the history
+        drop_history(model)
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE %s AS SELECT local_id, guid, starts_at, "
+                       "ends_at FROM %s WHERE 1 = 0" % (
+                           history_table(model), model._meta.db_table))
+
+        create_history(model)
+        self.qs.filter(test_attr=2).update(test_attr=20)
+        old_obj = self.qs.filter(at_time=self.origin).get(test_attr=2)
+        self.assertEqual(old_obj.test_attr, 2)
+
+        # columns missing in the model are not silently dropped
+        cursor.execute("ALTER TABLE %s ADD COLUMN removed integer NULL" %
+                       history_table(model))
+        self.assertRaises(ValueError, create_history, model)
+
+    def test_relations(self):
+        fp1 = FakeParentModel.objects.get(test_attr=1)
+        FakeParentModel.objects.filter(pk=fp1.pk).update(test_attr=10)
+        self.qs.filter(test_attr=2).update(test_attr=20)
+
+        filtered = self.qs.filter(test_ref__test_attr=10)
+        self.assertEqual(sorted([x.test_attr for x in filtered]), [1, 3, 20])
+
+        filtered = self.qs.filter(at_time=self.origin, test_ref__test_attr=1)
+        self.assertEqual(sorted([x.test_attr for x in filtered]), [1, 2, 3])
+
+    def tearDown(self):
+        self.assets.flush()
+
+
+class TestVersionIndexes(TestCase):
+    """
+    Tests that versioned reads are planned with indexes for versions.
+    """
+    fixtures = ["users.json"]
+
+    def setUp(self):
+        self.assets = Assets()
+        self.assets.fill()
+
+    def explain(self, qs, using='default'):
+        """ query plan of a versioned queryset as a single string """
+        qs = qs.using(using)
+        qs.inject_time()
+        sql, params = qs.query.get_compiler(using=using).as_sql()
+
+        cursor = connections[using].cursor()
+        if connections[using].vendor == 'postgresql':
+            # tables in tests are tiny, make the planner choose indexes
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            cursor.execute("EXPLAIN " + sql, params)
+        else:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return "\n".join([str(row) for row in cursor.fetchall()])
+
+    def assertIndexUsed(self, model, suffix, plan, using='default'):
+        name = index_name(model, suffix, using)
+        self.assertTrue(re.search(r'\b%s\b' % re.escape(name), plan), plan)
+
+    def test_indexes_used(self):
+        fp1 = FakeParentModel.objects.get(test_attr=1)
+        fc1 = FakeChildModel.objects.get(test_attr=1)
+
+        plan = self.explain(FakeChildModel.objects.filter(test_ref=fp1.pk))
+        self.assertIndexUsed(FakeChildModel, 'current_test_ref_id', plan)
+
+        plan = self.explain(FakeChildModel.objects.filter(pk=fc1.pk))
+        self.assertIndexUsed(FakeChildModel, 'current', plan)
+
+        qs = FakeChildModel.objects.filter(at_time=timezone.now())
+        plan = self.explain(qs.filter(pk=fc1.pk))
+        self.assertIndexUsed(FakeChildModel, 'at_time', plan)
+
+    def test_indexes_temporal(self):
+        # current versions are queried without 'ends_at' in temporal tables
+        fp1 = FakeParentModel.objects.get(test_attr=1)
+        plan = self.explain(FakeTemporalModel.objects.filter(test_ref=fp1.pk))
+        self.assertIndexUsed(FakeTemporalModel, 'current_test_ref_id', plan)
+
+    def test_indexes_sqlite(self):
+        plan = self.explain(Section.objects.filter(document='ABC'), 'sqlite')
+        self.assertIndexUsed(Section, 'current_document_id', plan, 'sqlite')
+
+    def tearDown(self):
+        self.assets.flush()
+
+
+class TestLocalIds(TestCase):
+    """
+    Tests allocation of local IDs from reserved blocks.
+    """
+
+    def test_allocate(self):
+        allocator = LocalIdAllocator(block_size=10)
+        first = allocator.allocate(3)
+        more = allocator.allocate(25)
+
+        ids = first + more
+        self.assertEqual(len(set(ids)), 28)
+        self.assertTrue(all([len(x) == 9 for x in ids]))
+
+        # another process reserves other blocks
+        other = LocalIdAllocator(block_size=10).allocate(10)
+        self.assertFalse(set(other) & set(ids))
+
+        self.assertEqual(allocator.allocate(0), [])
+
+    def test_fork(self):
+        allocator = LocalIdAllocator(block_size=10)
+        ids = allocator.allocate(3)
+
+        # a forked process does not take IDs from blocks of its parent
+        allocator.pid = -1
+        forked = allocator.allocate(3)
+        self.assertFalse(set(forked) & set(ids))
+        self.assertEqual(allocator.pid, os.getpid())
+
+
+class TestRetention(TestCase):
+    """
+    Tests removing closed versions older than a retention window.
+    """
+    fixtures = ["users.json"]
+
+    def setUp(self):
+        self.assets = Assets()
+        self.assets.fill()
+        self.origin = timezone.now()
+        time.sleep(1)  # needed to test versioned objects
+
+    def update_twice(self, model):
+        obj = model.objects.get(test_attr=1)
+        for value in [10, 20]:
+            model.objects.filter(pk=obj.pk).update(test_attr=value)
+        return obj
+
+    def test_drop(self):
+        obj = self.update_twice(FakeModel)
+        policy = (30, 'drop')
+
+        # versions in the window are kept
+        self.assertEqual(prune(FakeModel, policy), 0)
+        old_obj = FakeModel.objects.filter(at_time=self.origin).get(pk=obj.pk)
+        self.assertEqual(old_obj.test_attr, 1)
+
+        later = timezone.now() + timedelta(days=31)
+        self.assertEqual(prune(FakeModel, policy, now=later), 2)
+        self.assertEqual(FakeModel.objects.get(pk=obj.pk).test_attr, 20)
+        self.assertFalse(FakeModel.objects.filter(at_time=self.origin,
+                                                  pk=obj.pk).exists())
+        self.assertEqual(FakeModel.objects.filter(at_time=self.origin).count(),
+                         2)
+
+    def test_daily(self):
+        obj = self.update_twice(FakeTemporalModel)
+        qs = FakeTemporalModel.objects
+
+        later = timezone.now() + timedelta(days=31)
+        self.assertEqual(prune(FakeTemporalModel, (30, 'daily'), later), 1)
+
+        # the last version of the day covers the whole day
+        old_obj = qs.filter(at_time=self.origin).get(pk=obj.pk)
+        self.assertEqual(old_obj.test_attr, 10)
+        self.assertEqual(qs.get(pk=obj.pk).test_attr, 20)
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM %s" %
+                       history_table(FakeTemporalModel))
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+        # nothing left to thin
+        self.assertEqual(prune(FakeTemporalModel, (30, 'daily'), later), 0)
+
+    def test_snapshot(self):
+        owner = User.objects.get(pk=1)
+        Snapshot.objects.create(name='origin', owner=owner,
+                                at_time=self.origin)
+
+        # versions valid at the time of a snapshot are kept
+        for model in [FakeModel, FakeTemporalModel]:
+            obj = self.update_twice(model)
+            later = timezone.now() + timedelta(days=31)
+            self.assertEqual(prune(model, (30, 'drop'), now=later), 1)
+            old_obj = model.objects.filter(at_time=self.origin).get(pk=obj.pk)
+            self.assertEqual(old_obj.test_attr, 1)
+
+    def tearDown(self):
+        self.assets.flush()
+
+
+class TestAtTimeCache(TestCase):
+    """
+    Tests caching of results of queries for versions in the past. Uses a model
+    of an installed app, as cached objects are pickled.
+    """
+    fixtures = ["users.json"]
+
+    def setUp(self):
+        owner = User.objects.get(pk=1)
+        for version in ['1', '2', '3']:
+            Document.objects.create(version=version, owner=owner)
+
+        self.qs = Document.objects
+        self.settle_time = settings.VERSIONS_CONFIG['settle_time']
+        settings.VERSIONS_CONFIG['settle_time'] = 0
+
+    def test_cache(self):
+        at_time = timezone.now()
+        self.assertEqual(len(self.qs.filter(at_time=at_time)), 3)
+        self.qs.filter(at_time=at_time).get(version='1')
+
+        # history does not change, results come from the cache
+        self.qs.get(version='1').delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.qs.filter(at_time=at_time)), 3)
+            obj = self.qs.filter(at_time=at_time).get(version='1')
+        self.assertEqual(obj._at_time, at_time)
+
+        # current versions are always fetched
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.qs.all()), 2)
+
+        invalidate()
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.qs.filter(at_time=at_time)), 3)
+
+    def test_recent_time(self):
+        settings.VERSIONS_CONFIG['settle_time'] = 60
+        at_time = timezone.now()
+        self.assertEqual(len(self.qs.filter(at_time=at_time)), 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.qs.filter(at_time=at_time)), 3)
+
+    def tearDown(self):
+        settings.VERSIONS_CONFIG['settle_time'] = self.settle_time
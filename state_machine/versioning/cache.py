@@ -0,0 +1,52 @@
+import hashlib
+from datetime import timedelta
+
+from django.core.cache import get_cache
+from django.utils import timezone
+from gndata_api import settings
+
+#===============================================================================
+# Cache for results of queries 'at_time'. Versions are never changed once
+# closed, so a query for versions at a time in the past always gives the same
+# result and needs no invalidation. Only times old enough for all transactions
+# that may have made versions before them to be committed are cached.
+#
+# Changes of closed versions (like new locations of stored files) should call
+# 'invalidate', which starts a new generation of keys.
+#===============================================================================
+
+GENERATION_KEY = 'versions:generation'
+
+
+def get_versions_cache(at_time):
+    """ cache for results of a query at a given time or None, if the time is
+    too recent or caching is switched off """
+    alias = settings.VERSIONS_CONFIG['cache']
+    if not alias or not at_time:
+        return None
+
+    settle_time = timedelta(seconds=settings.VERSIONS_CONFIG['settle_time'])
+    if at_time > timezone.now() - settle_time:
+        return None
+
+    return get_cache(alias)
+
+
+def cache_key(cache, using, sql, params):
+    """ key for results of a compiled query, of the current generation """
+    generation = cache.get(GENERATION_KEY, 0)
+    digest = hashlib.sha1(repr((using, sql, params))).hexdigest()
+    return 'versions:%s:%s' % (generation, digest)
+
+
+def invalidate():
+    """ makes all cached results outdated """
+    alias = settings.VERSIONS_CONFIG['cache']
+    if not alias:
+        return
+
+    cache = get_cache(alias)
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:  # no generation yet
+        cache.set(GENERATION_KEY, 1, None)
@@ -1,13 +1,139 @@
 from operator import attrgetter
 
-from django.db import transaction
-from django.db.models import signals, sql
-from django.db.models.deletion import Collector
+from django.db import transaction, connections
+from django.db.models import signals, deletion
+from django.db.models.deletion import Collector, ProtectedError
 from django.utils import timezone, six
 
+from registry import versioned_tables
+from temporal import close_versions, close_matching, closed_at, copy_versions
+
+# on_delete rules applied by statements in the database, see cascade
+SQL_RULES = (deletion.CASCADE, deletion.SET_NULL, deletion.PROTECT,
+             deletion.DO_NOTHING)
+
 
 class VersionedCollector(Collector):
 
+    def can_cascade(self, model):
+        """ whether objects of a model, together with all dependants, may be
+        deleted by statements in the database, without loading them. Not if
+        any model to delete has pre/post_delete receivers, is inherited or has
+        related models which are not versioned or use other on_delete rules
+        than in SQL_RULES, or if a model has several FKs set to NULL. """
+        to_check, seen = [model], set()
+        while to_check:
+            model = to_check.pop()
+            if model in seen:
+                continue
+            seen.add(model)
+
+            if model._meta.parents or \
+                    signals.pre_delete.has_listeners(model) or \
+                    signals.post_delete.has_listeners(model):
+                return False
+
+            set_null = {}
+            for related in model._meta.get_all_related_objects(
+                    include_hidden=True):
+                rule = related.field.rel.on_delete
+                if rule is deletion.DO_NOTHING:
+                    continue
+
+                child = related.model
+                if not rule in SQL_RULES or \
+                        not child._meta.db_table in versioned_tables:
+                    return False
+
+                if rule is deletion.CASCADE:
+                    to_check.append(child)
+                elif rule is deletion.SET_NULL:
+                    set_null[child] = set_null.get(child, 0) + 1
+
+            if [x for x in set_null.values() if x > 1]:
+                return False
+
+        return True
+
+    def cascade(self, model, selection):
+        """
+        Versioned deletion of selected objects and their dependants by
+        statements in the database, one per related table and level of
+        relations. Dependants are found by their FKs to objects closed at the
+        same time, the same statements repeated while they close anything, so
+        that FKs to the same model (trees) are followed as well. FKs with
+        SET_NULL are cleared in new versions at the end. No signals are sent,
+        check 'can_cascade' first.
+
+        :param selection:   (sql, params) of a query selecting local IDs of
+                            objects to delete
+        """
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        now = timezone.now()
+
+        def referring(field, parent):
+            """ condition on the FK to objects of a parent just closed """
+            closed_sql, params = closed_at(parent, now, self.using)
+            return "%s IN (SELECT %s FROM (%s) %s)" % (
+                qn(field.column), qn(parent._meta.pk.column), closed_sql,
+                qn('closed')
+            ), params
+
+        with transaction.commit_on_success_unless_managed(using=self.using):
+            sql, params = selection
+            pk = qn(model._meta.pk.column)
+            where = "%s IN (SELECT %s FROM (%s) %s)" % (
+                pk, pk, sql, qn('selected')
+            )
+            if not close_matching(model, where, params, now, self.using):
+                return
+
+            to_clear = {}  # {(model, field name): (field, parent)}
+            queue = [model]
+            while queue:
+                parent = queue.pop(0)
+                for related in parent._meta.get_all_related_objects(
+                        include_hidden=True):
+                    child, field = related.model, related.field
+                    rule = field.rel.on_delete
+
+                    if rule is deletion.CASCADE:
+                        where, params = referring(field, parent)
+                        closed = close_matching(
+                            child, where, params, now, self.using
+                        )
+                        if closed and not child in queue:
+                            queue.append(child)
+
+                    elif rule is deletion.PROTECT:
+                        where, params = referring(field, parent)
+                        protected = child.objects.extra(
+                            where=[where], params=params
+                        )
+                        if protected.exists():
+                            raise ProtectedError(
+                                "Cannot delete some instances of model '%s' "
+                                "because they are referenced through a "
+                                "protected foreign key: '%s.%s'" % (
+                                    parent.__name__, child.__name__,
+                                    field.name
+                                ), list(protected)
+                            )
+
+                    elif rule is deletion.SET_NULL:
+                        to_clear[(child, field.name)] = (field, parent)
+
+            # after all deletes, as new versions are made at the same time
+            for child, name in to_clear:
+                field, parent = to_clear[(child, name)]
+                where, params = referring(field, parent)
+                sql = "SELECT %s FROM %s WHERE %s" % (
+                    qn(child._meta.pk.column), qn(child._meta.db_table), where
+                )
+                copy_versions(child, (sql, params), {field.column: None},
+                              now, self.using)
+
     def delete(self):
         """ deletion for versioned objects means setting the 'ends_at' field
         to the current datetime. Applied only for active versions, having
@@ -33,9 +159,8 @@ class VersionedCollector(Collector):
 
             # fast deletes - TODO check works correctly with versioned rels
             for qs in self.fast_deletes:
-                query = sql.UpdateQuery(qs.model)
                 pk_list = [obj.pk for obj in qs.all()]
-                query.update_batch(pk_list, {'ends_at': now}, self.using)
+                close_versions(qs.model, pk_list, now, self.using)
 
             # update fields - TODO check works correctly with versioned rels
             for model, instances_for_fieldvalues in six.iteritems(self.field_updates):
@@ -50,9 +175,8 @@ class VersionedCollector(Collector):
 
             # delete instances by setting 'ends_at' to 'now'
             for model, instances in six.iteritems(self.data):
-                query = sql.UpdateQuery(model)
                 pk_list = [obj.pk for obj in instances]
-                query.update_batch(pk_list, {'ends_at': now}, self.using)
+                close_versions(model, pk_list, now, self.using)
 
                 if not model._meta.auto_created:
                     for obj in instances:
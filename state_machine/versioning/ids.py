@@ -0,0 +1,122 @@
+import os
+import threading
+
+from django.db import connections
+from gndata_api.utils import base32str
+
+#===============================================================================
+# Allocation of local IDs in blocks. The database hands out block numbers, from
+# a sequence (PostgreSQL) or an auto-increment table (others), which are never
+# given twice, even if a transaction reserving them is rolled back (except on
+# SQLite, where the counter is transactional, for development only). Every
+# process then takes IDs from its reserved blocks without asking the database.
+#
+# IDs are encoded as 9-digit base32 strings. Older random IDs always have 10
+# digits, so allocated IDs can not collide with them.
+#===============================================================================
+
+SEQUENCE = 'versioned_local_id_blocks'
+
+# number of IDs in a block
+BLOCK_SIZE = 1000
+
+# number of base32 digits of an allocated ID
+ID_LENGTH = 9
+
+
+def create_sequence(using='default'):
+    """ creates the sequence of block numbers, if it does not exist yet """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT 1 FROM pg_class WHERE relkind = 'S' AND "
+                       "relname = %s", [SEQUENCE])
+        if not cursor.fetchone():
+            cursor.execute("CREATE SEQUENCE %s" % qn(SEQUENCE))
+
+    elif not SEQUENCE in connection.introspection.table_names():
+        if connection.vendor == 'mysql':
+            column = "BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY"
+        else:
+            column = "INTEGER PRIMARY KEY AUTOINCREMENT"
+        cursor.execute("CREATE TABLE %s (%s %s)" % (
+            qn(SEQUENCE), qn('id'), column
+        ))
+
+
+def reserve_blocks(count, using='default'):
+    """ reserves a number of blocks of IDs in the database
+
+    :return: list of block numbers
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s)",
+                       [SEQUENCE, count])
+        return [row[0] for row in cursor.fetchall()]
+
+    blocks = []
+    for i in range(count):
+        cursor.execute("INSERT INTO %s (%s) VALUES (NULL)" % (
+            qn(SEQUENCE), qn('id')
+        ))
+        blocks.append(cursor.lastrowid)
+    return blocks
+
+
+def encode_id(value):
+    """ local ID of an allocated integer """
+    return base32str(value).rjust(ID_LENGTH, '0')
+
+
+class LocalIdAllocator(object):
+    """
+    Hands out local IDs from blocks reserved in the database, separately for
+    every database. IDs left in blocks are lost when a process exits. Safe to
+    use from several threads. A forked process (like a worker started from a
+    preloaded master) drops the blocks it inherited and reserves its own, so
+    that the same IDs are never handed out by two processes.
+    """
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.reset()
+
+    def reset(self):
+        """ drops all reserved blocks """
+        self.pid = os.getpid()  # process the blocks were reserved by
+        self.lock = threading.Lock()
+        self.ranges = {}  # {<using>: [(<next ID>, <end>), ...]}
+
+    def allocate(self, count, using='default'):
+        """ list of new local IDs """
+        if self.pid != os.getpid():  # blocks are of the parent process
+            self.reset()
+
+        with self.lock:
+            ranges = self.ranges.setdefault(using, [])
+            available = sum([end - start for start, end in ranges])
+            if available < count:
+                needed = -(-(count - available) // self.block_size)
+                ranges.extend([
+                    (block * self.block_size, (block + 1) * self.block_size)
+                    for block in reserve_blocks(needed, using)
+                ])
+
+            values = []
+            while len(values) < count:
+                start, end = ranges.pop(0)
+                taken = min(end - start, count - len(values))
+                values.extend(range(start, start + taken))
+                if start + taken < end:
+                    ranges.insert(0, (start + taken, end))
+
+        return [encode_id(value) for value in values]
+
+
+allocator = LocalIdAllocator()
@@ -0,0 +1,109 @@
+from django.db import connections, models
+from django.db.backends.util import truncate_name
+from state_machine.versioning.temporal import is_temporal
+
+#===============================================================================
+# Indexes for versioned access patterns. Reads filter by 'ends_at IS NULL'
+# (current versions) or by a 'starts_at' / 'ends_at' window, together with the
+# local ID or a FK. Every versioned table gets
+#
+# - (local_id, starts_at, ends_at) for versions of an object at a given time
+# - (local_id) WHERE ends_at IS NULL for the current version of an object
+# - (<fk>) WHERE ends_at IS NULL for every FK, like owner, block, segment
+# - (date_created, local_id) WHERE ends_at IS NULL for keyset pagination
+# - indexes over current versions listed in 'current_indexes' of a model
+#
+# Databases without partial indexes (MySQL) get these indexes with 'ends_at'
+# as the last column instead. Tables of temporal models hold current versions
+# only and are queried without 'ends_at', so they get plain indexes.
+#===============================================================================
+
+# vendors supporting 'CREATE INDEX ... WHERE'
+PARTIAL_INDEXES = ('postgresql', 'sqlite')
+
+
+def version_indexes(model):
+    """ indexes a versioned model should have
+
+    :return: [(<name suffix>, [<column>, ...], <only current versions>), ...]
+    """
+    opts = model._meta
+    indexes = [
+        ('at_time', [opts.pk.column, 'starts_at', 'ends_at'], False),
+        ('current', [opts.pk.column], True),
+        ('current_created', ['date_created', opts.pk.column], True),
+    ]
+
+    for field in opts.local_fields:
+        if isinstance(field, models.ForeignKey):
+            indexes.append(('current_' + field.column, [field.column], True))
+
+    for names in getattr(model, 'current_indexes', ()):
+        columns = [opts.get_field(name).column for name in names]
+        indexes.append(('current_' + '_'.join(columns), columns, True))
+
+    return indexes
+
+
+def index_name(model, suffix, using='default'):
+    """ name of an index of a versioned model, see 'version_indexes' """
+    connection = connections[using]
+    return truncate_name('%s_%s' % (model._meta.db_table, suffix),
+                         connection.ops.max_name_length())
+
+
+def existing_indexes(connection, table):
+    """ names of all indexes on a table """
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s",
+                       [table])
+    elif connection.vendor == 'sqlite':
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = %s", [table])
+    elif connection.vendor == 'mysql':
+        cursor.execute("SELECT DISTINCT index_name FROM "
+                       "information_schema.statistics WHERE table_schema = "
+                       "DATABASE() AND table_name = %s", [table])
+    else:
+        raise TypeError('The current database engine is not supported.')
+    return set([row[0] for row in cursor.fetchall()])
+
+
+def index_statements(model, using='default', existing=None):
+    """ SQL to create indexes of a versioned model which do not exist yet """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    if existing is None:
+        existing = existing_indexes(connection, table)
+
+    statements = []
+    for suffix, columns, current in version_indexes(model):
+        name = index_name(model, suffix, using)
+        if name in existing:
+            continue
+
+        where = ''
+        if current and not is_temporal(model):
+            if connection.vendor in PARTIAL_INDEXES:
+                where = " WHERE %s IS NULL" % qn('ends_at')
+            else:
+                columns = columns + ['ends_at']
+
+        statements.append("CREATE INDEX %s ON %s (%s)%s" % (
+            qn(name), qn(table), ", ".join([qn(c) for c in columns]), where
+        ))
+    return statements
+
+
+def create_indexes(model, using='default'):
+    """ creates missing indexes of a versioned model
+
+    :return: executed statements
+    """
+    statements = index_statements(model, using)
+    cursor = connections[using].cursor()
+    for statement in statements:
+        cursor.execute(statement)
+    return statements
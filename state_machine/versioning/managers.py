@@ -15,8 +15,9 @@ class VersionManager(models.Manager):
     _at_time = None
 
     def all(self):
-        """ need to proxy all() to apply versioning filters """
-        return self.get_queryset().all()
+        """ need to proxy all() to apply versioning filters. Not cloned, so
+        that objects prefetched for related managers are kept """
+        return self.get_queryset()
 
     def filter(self, **kwargs):
         """ method is overriden to support object versions. If an object is 
@@ -27,10 +28,15 @@ class VersionManager(models.Manager):
         return self.get_queryset(**timeflt).filter(**kwargs)
 
     def proxy_time(self, proxy_to, **timeflt):
+        """ related managers (and prefetching through them) take the time of
+        the object they are related to """
+        instance = getattr(self, 'instance', None)
         if timeflt.has_key('at_time'):
             proxy_to._at_time = timeflt['at_time']
         elif self._at_time:
             proxy_to._at_time = self._at_time
+        elif getattr(instance, '_at_time', None):
+            proxy_to._at_time = instance._at_time
         return proxy_to
 
 
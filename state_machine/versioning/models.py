@@ -1,10 +1,11 @@
 from django.db import models
+from django.db.models.signals import class_prepared
 from django.utils import timezone
 
-from state_machine.versioning.managers import VersionManager
 from state_machine.versioning.managers import VersionedObjectManager
 from state_machine.versioning.managers import VersionedM2MManager
 
+from state_machine.versioning.registry import versioned_tables
 from gndata_api.utils import base32str
 
 #===============================================================================
@@ -39,25 +40,20 @@ class BaseVersionedObject(models.Model):
     objects = VersionedObjectManager()
     _at_time = None  # indicates an older version for object instance
 
+    # keep closed versions in a separate '<table>_history' table, see temporal
+    temporal = False
+
+    # indexes over current versions, as tuples of field names, in addition to
+    # the ones every versioned table gets, see indexes
+    current_indexes = ()
+
+    # (<days>, 'daily' / 'drop') to thin or drop versions closed before the
+    # last <days>, see retention. All versions are kept by default.
+    retention = None
+
     class Meta:
         abstract = True
 
-    def __getattribute__(self, name):
-        """ wrap getting object attributes to catch calls to related managers,
-        which require '_at_time' parameter to retrieve related objects at time,
-        equal to the original object.
-
-        Direct FK, direct M2M or reverse M2M related manager is requested. By
-        adding '_at_time' attribute we make the related manager support
-        versioning by requesting related objects at the time equal to the
-        original object ('self' in this case). For reverse FKs (like
-        'event.segment') we need to override related descriptor, see
-        'VersionedForeignKey' field class. """
-        attr = object.__getattribute__(self, name)
-        if isinstance(attr, VersionManager) and self._at_time:
-            attr._at_time = self._at_time
-        return attr
-
     def delete(self, using=None):
         """ uses queryset delete() method to perform versioned deletion """
         self.__class__.objects.filter(pk=self.pk).delete()
@@ -94,4 +90,13 @@ class VersionedM2M(BaseVersionedObject):
     objects = VersionedM2MManager()
 
     class Meta:
-        abstract = True
\ No newline at end of file
+        abstract = True
+
+
+def register_versioned_model(sender, **kwargs):
+    """ remembers tables of versioned models as they are prepared, so that
+    queries do not need to inspect models every time """
+    if issubclass(sender, BaseVersionedObject):
+        versioned_tables[sender._meta.db_table] = sender
+
+class_prepared.connect(register_versioned_model)
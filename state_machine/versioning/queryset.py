@@ -1,11 +1,16 @@
-from django.db import connection, transaction
+from django.db import transaction, connections
 from django.db.models.query import QuerySet
 from django.db.models import sql
-from django.db.models import Q
 from django.utils import timezone
 
+from gndata_api import settings
 from gndata_api.utils import *
 from deletion import VersionedCollector
+from registry import versioned_tables, time_filter
+from cache import get_versions_cache, cache_key
+from ids import allocator
+from temporal import is_temporal, versions_view, close_versions, \
+    copy_versions, BATCH_SIZE
 
 import uuid
 
@@ -14,6 +19,30 @@ import uuid
 #===============================================================================
 
 
+class TimeRestrictedJoin(object):
+    """ join field of a LEFT OUTER join to a versioned table, adding version
+    time filters to the join condition """
+
+    def __init__(self, join_field, node):
+        self.join_field = join_field
+        self.node = node
+
+    def __getattr__(self, name):
+        return getattr(self.join_field, name)
+
+    def get_extra_restriction(self, where_class, alias, related_alias):
+        restriction = self.join_field.get_extra_restriction(
+            where_class, alias, related_alias
+        )
+        if restriction is None:
+            return self.node
+
+        node = where_class()
+        node.add(restriction, sql.where.AND)
+        node.add(self.node, sql.where.AND)
+        return node
+
+
 class VersionedQuerySet(QuerySet):
     """ basic extension for every queryset class to support versioning """
     _at_time = None  # proxy version time for related models
@@ -23,19 +52,6 @@ class VersionedQuerySet(QuerySet):
         """ pre-processing versioned queryset before evaluating against database 
         back-end. Inject version time filters for every versioned model (table),
         used in the query. """
-        def update_constraint(node, table):
-            if hasattr(node, 'children') and node.children:
-                for child in node.children:
-                    update_constraint(child, table)
-            else:
-                node[0].alias = table
-
-        def extract_rel_tables(nodes, extracted):
-            for name, inside in nodes.items():
-                extracted.append(name)
-                if inside:
-                    extract_rel_tables(inside, extracted)
-
         if self._time_injected:
             return
 
@@ -46,43 +62,39 @@ class VersionedQuerySet(QuerySet):
         # 'can_filter()'
         self.query.clear_limits()
 
-        # 3. update time filters:
-        # - create time filters as separate where node
-        qry = self.query.__class__(model=self.model)
-        if self._at_time:
-            at_time = self._at_time
-            qry.add_q(Q(starts_at__lte = at_time))
-            qry.add_q(Q(ends_at__gt = at_time) | Q(ends_at__isnull = True))
-        else:
-            qry.add_q(Q(ends_at__isnull = True))
-
+        # 3. add time filters to all versioned models (tables) in use, including
+        # joins made at compile time (ordering, select_related). Filters of
+        # LEFT OUTER joins go to the join condition
         cp = self.query.get_compiler(using=self.db)
         cp.pre_sql_setup()  # thanks god I found that
-        tables = [table for table, rc in cp.query.alias_refcount.items() if rc]
-
-        # - build map of models with tables: {<table name>: <model>}
-        vmodel_map = {}
-        for model in connection.introspection.installed_models(tables):
-            vmodel_map[model._meta.db_table] = model
-
-        # - add node with time filters to all versioned models (tables)
-        for table in tables:
-            # find real table name, not alias
-            real_name = table
-            for mod_name, aliases in self.query.table_map.items():
-                if table in aliases:
-                    real_name = mod_name
+        for alias, rc in self.query.alias_refcount.items():
+            if not rc:
+                continue
 
             # skip non-versioned models,like User: no need to filter by time
-            if vmodel_map.has_key(real_name):
-                superclasses = vmodel_map[real_name].mro()
-                cls_names = [x.__name__ for x in superclasses]
-                if not ('BaseGnodeObject' in cls_names or 'VersionedM2M' in cls_names):
-                    continue
-
-            cloned_node = qry.where.__deepcopy__(memodict=None)
-            update_constraint(cloned_node, table)
-            self.query.where.add(cloned_node, sql.where.AND)
+            join = self.query.alias_map[alias]
+            model = versioned_tables.get(join.table_name)
+            if model is None:
+                continue
+
+            if is_temporal(model):
+                if not self._at_time:
+                    continue  # the table holds current versions only
+
+                # read current and closed versions under the same alias
+                self.query.alias_map[alias] = join._replace(
+                    table_name=versions_view(model)
+                )
+
+            node = time_filter(alias, model, self._at_time)
+            if join.join_type == self.query.LOUTER:
+                # in the ON clause, so that rows without related objects stay
+                join = self.query.alias_map[alias]
+                self.query.alias_map[alias] = join._replace(
+                    join_field=TimeRestrictedJoin(join.join_field, node)
+                )
+            else:
+                self.query.where.add(node, sql.where.AND)
 
         # 4. re-set limits
         self.query.set_limits(low=low_mark, high=high_mark)
@@ -114,11 +126,33 @@ class VersionedQuerySet(QuerySet):
         from the same time, as well as indicates that a different version from
         the current of an object was requested. """
         self.inject_time()
+
+        # results of queries for versions in the past never change
+        cache = get_versions_cache(self._at_time)
+        if cache is not None:
+            compiled = self.query.get_compiler(using=self.db).as_sql()
+            key = cache_key(cache, self.db, *compiled)
+            objs = cache.get(key)
+            if objs is not None:
+                for obj in objs:
+                    yield obj
+                return
+
+        objs = []
+        max_objects = settings.VERSIONS_CONFIG['cache_max_objects']
         for obj in super(VersionedQuerySet, self).iterator():
             if self._at_time:
                 obj._at_time = self._at_time
+
+            if cache is not None and objs is not None:
+                objs.append(obj)
+                if len(objs) > max_objects:
+                    objs = None  # too large to be cached
             yield obj
 
+        if cache is not None and objs is not None:
+            cache.set(key, objs)
+
     def bulk_create(self, objs, batch_size=None):
         """ wrapping around a usual bulk_create to provide version-specific
         information for all objects. As with original bulk creation, reverse
@@ -127,17 +161,6 @@ class VersionedQuerySet(QuerySet):
         objects. Works with BaseVersionedObject's only.
 
         WARNING: has side-effects """
-        def close_records(ids_to_close):
-            query = sql.UpdateQuery(self.model)
-
-            pk_field = query.get_meta().pk
-            query.add_update_values({'ends_at': now})
-            query.where = query.where_class()
-            constr = sql.where.Constraint(None, pk_field.column, pk_field)
-            query.where.add((constr, 'in', ids_to_close), sql.where.AND)
-            query.add_q(Q(ends_at__isnull=True))
-            query.get_compiler(self.db).execute_sql(None)
-
         assert batch_size is None or batch_size > 0
 
         if self.model._meta.parents:
@@ -148,13 +171,15 @@ class VersionedQuerySet(QuerySet):
 
         now = timezone.now()
         ids_to_close = []
+        new_ids = iter(allocator.allocate(len([x for x in objs if not x.pk]),
+                                          self.db))
         for obj in objs:  # this loop modifies given objects
 
             if obj.pk:  # existing object, need to "close" old version later
                 ids_to_close.append(obj.pk)
 
             else:  # new object
-                obj.pk = get_new_local_id()
+                obj.pk = next(new_ids)
                 obj.date_created = now
 
             obj.starts_at = now
@@ -165,7 +190,7 @@ class VersionedQuerySet(QuerySet):
         with transaction.commit_on_success_unless_managed(using=self.db):
 
             # close old records by setting 'ends_at' to 'now', must be first
-            close_records(ids_to_close)
+            close_versions(self.model, ids_to_close, now, self.db)
 
             # insert records with new / updated objects
             self._batched_insert(list(objs), fields, batch_size)
@@ -173,21 +198,40 @@ class VersionedQuerySet(QuerySet):
         return objs
 
     def update(self, **kwargs):
-        """ update objects with new attrs and FKs """
+        """ update objects with new attrs and FKs. New versions are made in the
+        database by copying current ones, objects are not loaded. Fields are
+        given by name or attname (like 'owner_id'), others are ignored.
+
+        :return: number of updated objects """
         assert self.query.can_filter(), \
             "Cannot update a query once a slice has been taken."
 
-        test = lambda x: (not x.primary_key) and x.editable
-        allowed = [f.name for f in self.model._meta.local_fields if test(f)]
+        if self.model._meta.parents:
+            raise ValueError("Can't update an inherited model")
 
-        if kwargs:
-            objs = self._clone()
-            for obj in objs:
-                for name, value in kwargs.items():
-                    if name in allowed:
-                        setattr(obj, name, value)
-            return self.bulk_create(objs)
-        return self
+        connection = connections[self.db]
+        test = lambda x: (not x.primary_key) and x.editable
+        allowed = {}
+        for f in self.model._meta.local_fields:
+            if test(f):
+                allowed[f.name] = allowed[f.attname] = f
+
+        values = {}
+        for name, value in kwargs.items():
+            if name in allowed:
+                field = allowed[name]
+                if hasattr(value, 'prepare_database_save'):
+                    value = value.prepare_database_save(field)
+                values[field.column] = field.get_db_prep_save(value, connection)
+
+        if not values:
+            return 0
+
+        # current versions of selected objects are copied
+        self._for_write = True
+        with transaction.commit_on_success_unless_managed(using=self.db):
+            return copy_versions(self.model, self.selection(), values,
+                                 timezone.now(), self.db)
 
     def delete(self):
         """ a special versioned delete, which removes appropriate direct and
@@ -212,26 +256,67 @@ class VersionedQuerySet(QuerySet):
         del_query.query.clear_ordering(force_empty=True)
 
         collector = VersionedCollector(using=del_query.db)
-        collector.collect(del_query)
-        collector.delete()
+        if collector.can_cascade(del_query.model):
+            collector.cascade(del_query.model, del_query.selection())
+        else:
+            collector.collect(del_query)
+            collector.delete()
 
         # Clear the result cache, in case this QuerySet gets reused.
         self._result_cache = None
 
+    def selection(self):
+        """ SQL query selecting local IDs of objects in this queryset, to be
+        used as a subquery in bulk statements
+
+        :return: (sql, params)
+        """
+        qs = self._clone()
+        qs.query.clear_ordering(force_empty=True)
+        qs.inject_time()
+        qs = qs.values_list('pk', flat=True)
+        return qs.query.get_compiler(using=qs.db).as_sql()
+
     def count(self):
         """ need to inject version time (or ends_at = NULL) before executing
         against database. No tables are in alias_refcount if no other filters
         are set, so the time injection doesn't work.. workaround here: inject a
         meaningless filter, which doesn't change the *count* query. """
+        if self._result_cache is not None:  # like prefetched objects
+            return len(self._result_cache)
+
         q = self.filter()
         q.inject_time()
         return super(VersionedQuerySet, q).count()
 
     def exists(self):
         """ exists if there is at least one record with ends_at = NULL """
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+
         q = self.filter()
         q.inject_time()
         return super(VersionedQuerySet, q).exists()
 
-    def in_bulk(self):
-        raise NotImplementedError("Not implemented for versioned objects")
+    def in_bulk(self, id_list, at_time=None):
+        """ objects with given local IDs, current or at a given time, with one
+        query per BATCH_SIZE IDs
+
+        :return: {<local_id>: <object>}
+        """
+        assert self.query.can_filter(), \
+            "Cannot use 'limit' or 'offset' with in_bulk"
+
+        id_list = list(set(id_list))
+        if not id_list:
+            return {}
+
+        qs = self.order_by()
+        if at_time is not None:
+            qs = qs.filter(at_time=at_time)
+
+        objects = {}
+        for start in range(0, len(id_list), BATCH_SIZE):
+            batch = id_list[start:start + BATCH_SIZE]
+            objects.update([(obj.pk, obj) for obj in qs.filter(pk__in=batch)])
+        return objects
@@ -0,0 +1,50 @@
+from django.db.models.sql.where import WhereNode, Constraint, AND, OR
+
+#===============================================================================
+# Registry of versioned models, filled when models are prepared (see models)
+#===============================================================================
+
+# versioned models by table name: {<db_table>: <model>}
+versioned_tables = {}
+
+# where node templates with version time filters: {(alias, table): node}
+_current_nodes = {}
+
+# time constraints for a table alias: {(alias, table): (starts_at, ends_at)}
+_constraints = {}
+
+
+def get_constraints(alias, model):
+    key = (alias, model._meta.db_table)
+    if not key in _constraints:
+        opts = model._meta
+        _constraints[key] = (
+            Constraint(alias, 'starts_at', opts.get_field('starts_at')),
+            Constraint(alias, 'ends_at', opts.get_field('ends_at'))
+        )
+    return _constraints[key]
+
+
+def time_filter(alias, model, at_time=None):
+    """ builds a where node with version time filters for a versioned table
+    used in a query under a given alias: only current versions (ends_at is
+    NULL) or versions valid at a given time. Nodes for current versions are
+    built once and cloned. """
+    if at_time is None:
+        key = (alias, model._meta.db_table)
+        if not key in _current_nodes:
+            starts, ends = get_constraints(alias, model)
+            node = WhereNode()
+            node.add((ends, 'isnull', True), AND)
+            _current_nodes[key] = node
+        return _current_nodes[key].clone()
+
+    starts, ends = get_constraints(alias, model)
+    period = WhereNode(connector=OR)
+    period.add((ends, 'gt', at_time), OR)
+    period.add((ends, 'isnull', True), OR)
+
+    node = WhereNode()
+    node.add((starts, 'lte', at_time), AND)
+    node.add(period, AND)
+    return node
@@ -0,0 +1,141 @@
+from datetime import timedelta
+
+from django.db import connections, transaction
+from django.utils import timezone
+from state_machine.models import Snapshot
+from state_machine.versioning import cache as versions_cache
+from state_machine.versioning.temporal import BATCH_SIZE, closed_versions
+from state_machine.versioning.temporal import is_temporal, history_table
+
+#===============================================================================
+# Retention of closed versions. A versioned model may set a policy
+#
+#   retention = (<days>, <mode>)
+#
+# to keep all versions closed within the last <days> and, for older ones,
+# either keep one version per object and day ('daily') or drop them ('drop').
+# Only versions closed before the start of the retained window are touched,
+# so queries 'at_time' inside the window give the same results as before.
+#
+# 'daily' keeps the last version of an object started on a day and extends it
+# back to the start of the first one, so that versions of an object still
+# follow each other without gaps.
+#
+# Versions valid at the time of a named snapshot are always kept, as reads
+# through snapshots may be cached forever.
+#===============================================================================
+
+DAILY = 'daily'
+DROP = 'drop'
+
+
+def thin_daily(versions):
+    """ versions to remove and new start times of versions to keep, so that
+    one version per object and (UTC) day remains
+
+    :param versions:    [(local_id, guid, starts_at, ends_at), ...] of closed
+                        versions, ordered by local ID and start time. Only
+                        versions following each other are merged.
+    :return:            [<guid>, ...], {<guid>: <starts_at>}
+    """
+    removed, extended = [], {}
+    first = previous = None
+    for version in versions:
+        local_id, guid, starts_at, ends_at = version
+        day = timezone.localtime(starts_at, timezone.utc).date()
+        if previous and previous[0] == local_id and previous[3] == day and \
+                previous[4] == starts_at:
+            removed.append(previous[1])
+            extended[guid] = first
+        else:
+            first = starts_at
+        previous = (local_id, guid, starts_at, day, ends_at)
+
+    for guid in removed:
+        extended.pop(guid, None)
+    return removed, extended
+
+
+def prune(model, policy=None, now=None, using='default'):
+    """ enforces the retention policy of a versioned model, in batches of
+    objects, each in a transaction
+
+    :param policy:  (<days>, <mode>), the 'retention' of the model by default
+    :return:        number of removed versions
+    """
+    policy = policy or getattr(model, 'retention', None)
+    if not policy:
+        return 0
+
+    days, mode = policy
+    if not mode in (DAILY, DROP):
+        raise ValueError("Unknown retention mode %s" % mode)
+
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    candidates = closed_versions(model, using).filter(ends_at__lt=cutoff)
+
+    # versions pinned by snapshots are excluded in one correlated subquery
+    qn = connections[using].ops.quote_name
+    table = qn(model._meta.db_table)
+    candidates = candidates.extra(where=[
+        "NOT EXISTS (SELECT 1 FROM %s snapshot WHERE snapshot.%s < %%s AND "
+        "snapshot.%s >= %s.%s AND snapshot.%s < %s.%s)" % (
+            qn(Snapshot._meta.db_table), qn('at_time'), qn('at_time'), table,
+            qn('starts_at'), qn('at_time'), table, qn('ends_at')
+        )
+    ], params=[cutoff])
+
+    removed, last = 0, None
+    while True:
+        objects = candidates
+        if last is not None:
+            objects = objects.filter(local_id__gt=last)
+        objects = list(objects.order_by('local_id').values_list(
+            'local_id', flat=True
+        ).distinct()[:BATCH_SIZE])
+        if not objects:
+            break
+        last = objects[-1]
+
+        versions = candidates.filter(local_id__in=objects).order_by(
+            'local_id', 'starts_at'
+        ).values_list('local_id', 'guid', 'starts_at', 'ends_at')
+
+        if mode == DROP:
+            guids, extended = [v[1] for v in versions], {}
+        else:
+            guids, extended = thin_daily(versions)
+
+        with transaction.atomic(using=using):
+            remove_versions(model, guids, extended, using)
+        removed += len(guids)
+
+    # results 'at_time' before the window may have changed
+    if removed:
+        versions_cache.invalidate()
+    return removed
+
+
+def remove_versions(model, guids, extended, using='default'):
+    """ deletes closed versions with given guids and sets new start times of
+    given other closed versions """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = qn(history_table(model) if is_temporal(model) else
+               model._meta.db_table)
+    starts_at = model._meta.get_field('starts_at')
+
+    cursor = connection.cursor()
+    if extended:
+        cursor.executemany(
+            "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                table, qn('starts_at'), qn('guid')
+            ), [(starts_at.get_db_prep_value(value, connection), guid)
+                for guid, value in extended.items()]
+        )
+
+    for start in range(0, len(guids), BATCH_SIZE):
+        batch = guids[start:start + BATCH_SIZE]
+        cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+            table, qn('guid'), ", ".join(["%s"] * len(batch))
+        ), batch)
@@ -0,0 +1,264 @@
+from django.db import connections
+from django.db.models import Q
+from django.db.models.query import QuerySet
+
+#===============================================================================
+# Temporal table mode: current versions of objects are kept in the table of a
+# model, closed versions are moved to a '<table>_history' table. Queries for
+# current versions scan live rows only; queries 'at_time' read a view over
+# both tables. Switched on with 'temporal = True' on a versioned model.
+#
+# Plain (non-versioned) querysets of such models see current versions only.
+#
+# Versions are closed and copied here for all versioned models, so that bulk
+# changes run as a few statements in the database.
+#===============================================================================
+
+# max number of IDs in a single statement
+BATCH_SIZE = 100
+
+# expressions for new random version IDs, by database vendor
+GUID_SQL = {
+    'postgresql': "md5(random()::text || clock_timestamp()::text)",
+    'mysql': "REPLACE(UUID(), '-', '')",
+    'sqlite': "lower(hex(randomblob(16)))",
+}
+
+
+def is_temporal(model):
+    return getattr(model, 'temporal', False)
+
+
+def history_table(model):
+    return model._meta.db_table + '_history'
+
+
+def versions_view(model):
+    """ view over current and closed versions of a model """
+    return model._meta.db_table + '_versions'
+
+
+def all_versions(model, using=None):
+    """ plain queryset over all versions of objects of a model, current and
+    closed, without version time filters """
+    qs = QuerySet(model, using=using)
+    if is_temporal(model):
+        alias = qs.query.get_initial_alias()
+        qs.query.alias_map[alias] = qs.query.alias_map[alias]._replace(
+            table_name=versions_view(model)
+        )
+    return qs
+
+
+def closed_versions(model, using=None):
+    """ plain queryset over closed versions of objects of a model """
+    qs = QuerySet(model, using=using)
+    if is_temporal(model):
+        alias = qs.query.get_initial_alias()
+        qs.query.alias_map[alias] = qs.query.alias_map[alias]._replace(
+            table_name=history_table(model)
+        )
+    return qs.filter(ends_at__isnull=False)
+
+
+def object_versions(model, local_id, start=None, end=None, using=None):
+    """ versions of an object valid at any time in [start, end), oldest first.
+    Read by a single range scan of the (local_id, starts_at, ends_at) index. """
+    qs = all_versions(model, using).filter(local_id=local_id)
+    if start is not None:
+        qs = qs.filter(Q(ends_at__isnull=True) | Q(ends_at__gt=start))
+    if end is not None:
+        qs = qs.filter(starts_at__lt=end)
+    return qs.order_by('starts_at')
+
+
+def create_history(model, using='default'):
+    """ creates the history table (same columns, no constraints, as local IDs
+    repeat), if it does not exist yet, and the view over all versions. The
+    table of the model itself should exist.
+
+    Columns added to the model are added to an existing history table. Closed
+    versions found in the table of the model (kept there before the model was
+    temporal) are moved to the history table.
+
+    :raises: ValueError if the history table has columns the model has not,
+             like after a column was removed or renamed; the history table
+             should then be migrated together with the table of the model
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    existing = connection.introspection.table_names(cursor)
+
+    table, history = model._meta.db_table, history_table(model)
+    fields = model._meta.local_fields
+    columns = ", ".join([qn(f.column) for f in fields])
+    statements = []
+    if not history in existing:
+        statements.append("CREATE TABLE %s AS SELECT %s FROM %s WHERE 1 = 0" %
+                          (qn(history), columns, qn(table)))
+        statements.append("CREATE INDEX %s ON %s (%s, %s)" % (
+            qn(history + '_versions'), qn(history), qn('local_id'),
+            qn('starts_at')
+        ))
+
+    else:
+        found = [x[0] for x in connection.introspection.get_table_description(
+            cursor, history
+        )]
+        extra = set(found) - set([f.column for f in fields])
+        if extra:
+            raise ValueError("History table %s has columns %s, not found in "
+                             "the model %s" % (history, ", ".join(extra),
+                                               model._meta.object_name))
+
+        for field in [f for f in fields if not f.column in found]:
+            statements.append("ALTER TABLE %s ADD COLUMN %s %s NULL" % (
+                qn(history), qn(field.column), field.db_type(connection)
+            ))
+
+    statements.append("INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s IS NOT "
+                      "NULL" % (qn(history), columns, columns, qn(table),
+                                qn('ends_at')))
+    statements.append("DELETE FROM %s WHERE %s IS NOT NULL" % (
+        qn(table), qn('ends_at')
+    ))
+
+    # re-created every time, to follow changes of columns
+    statements.append("DROP VIEW IF EXISTS %s" % qn(versions_view(model)))
+    statements.append(
+        "CREATE VIEW %s AS SELECT %s FROM %s UNION ALL SELECT %s FROM %s" %
+        (qn(versions_view(model)), columns, qn(table), columns, qn(history))
+    )
+
+    for statement in statements:
+        cursor.execute(statement)
+
+
+def drop_history(model, using='default'):
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("DROP VIEW IF EXISTS %s" % qn(versions_view(model)))
+    cursor.execute("DROP TABLE IF EXISTS %s" % qn(history_table(model)))
+
+
+def close_versions(model, pk_list, now, using='default'):
+    """ closes current versions of objects with given local IDs by setting
+    'ends_at' to 'now'. In temporal mode closed versions are moved to the
+    history table. """
+    qn = connections[using].ops.quote_name
+    for start in range(0, len(pk_list), BATCH_SIZE):
+        batch = list(pk_list[start:start + BATCH_SIZE])
+        where = "%s IN (%s)" % (
+            qn(model._meta.pk.column), ", ".join(["%s"] * len(batch))
+        )
+        close_matching(model, where, batch, now, using)
+
+
+def close_matching(model, where, params, now, using='default'):
+    """ closes current versions of objects matching an SQL condition on the
+    table of the model, see close_versions
+
+    :return: number of closed versions """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    where = "(%s) AND %s IS NULL" % (where, qn('ends_at'))
+    ends_at = model._meta.get_field('ends_at').get_db_prep_value(
+        now, connection
+    )
+
+    cursor = connection.cursor()
+    if not is_temporal(model):
+        cursor.execute("UPDATE %s SET %s = %%s WHERE %s" % (
+            table, qn('ends_at'), where
+        ), [ends_at] + list(params))
+        return cursor.rowcount
+
+    columns = [f.column for f in model._meta.local_fields]
+    selected = ["%s" if c == 'ends_at' else qn(c) for c in columns]
+    cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s" % (
+        qn(history_table(model)), ", ".join([qn(c) for c in columns]),
+        ", ".join(selected), table, where
+    ), [ends_at] + list(params))
+    cursor.execute("DELETE FROM %s WHERE %s" % (table, where), list(params))
+    return cursor.rowcount
+
+
+def closed_at(model, now, using='default'):
+    """ query selecting local IDs of objects with versions closed at a given
+    time, like by a delete running at this time
+
+    :return: (sql, params)
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = history_table(model) if is_temporal(model) else \
+        model._meta.db_table
+    ends_at = model._meta.get_field('ends_at').get_db_prep_value(
+        now, connection
+    )
+    return "SELECT %s FROM %s WHERE %s = %%s" % (
+        qn(model._meta.pk.column), qn(table), qn('ends_at')
+    ), [ends_at]
+
+
+def new_guid_sql(connection):
+    """ SQL expression giving a new random 32-digit hex ID for every row """
+    return GUID_SQL[connection.vendor]
+
+
+def copy_versions(model, selection, values, now, using='default'):
+    """
+    Set-based update of versioned objects: current versions of selected
+    objects are copied with new values, a new guid and 'starts_at' = 'now' by
+    a single INSERT ... SELECT, then the old versions are closed. No objects
+    are loaded from the database.
+
+    :param selection:   (sql, params) of a query selecting local IDs of objects
+    :param values:      {<column>: <value prepared for the database>}
+    :return:            number of updated objects
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    table, pk = qn(opts.db_table), qn(opts.pk.column)
+    starts_at = opts.get_field('starts_at').get_db_prep_value(now, connection)
+
+    columns, selected, params = [], [], []
+    for field in opts.local_fields:
+        columns.append(qn(field.column))
+        if field.name == 'guid':
+            selected.append(new_guid_sql(connection))
+        elif field.name == 'starts_at':
+            selected.append("%s")
+            params.append(starts_at)
+        elif field.name == 'ends_at':
+            selected.append("NULL")
+        elif field.column in values:
+            selected.append("%s")
+            params.append(values[field.column])
+        else:
+            selected.append(qn(field.column))
+
+    sql, selection_params = selection
+    cursor = connection.cursor()
+    cursor.execute(
+        "INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s IN "
+        "(SELECT %s FROM (%s) %s) AND %s IS NULL" % (
+            table, ", ".join(columns), ", ".join(selected), table, pk,
+            pk, sql, qn('selected'), qn('ends_at')
+        ), params + list(selection_params)
+    )
+    count = cursor.rowcount
+
+    # previous versions: current ones of objects just given a new version.
+    # The derived table lets MySQL select from the table being updated.
+    where = "%s IN (SELECT %s FROM (SELECT %s FROM %s WHERE %s = %%s) %s) " \
+            "AND %s < %%s" % (
+                pk, pk, pk, table, qn('starts_at'), qn('replaced'),
+                qn('starts_at')
+            )
+    close_matching(model, where, [starts_at, starts_at], now, using)
+    return count